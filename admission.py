@@ -0,0 +1,118 @@
+import asyncio
+from typing import Any, Dict
+from fastapi import HTTPException
+from utils import get_query_pool_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class Admission:
+    """A reserved slot in the query queue; `async with` waits for an execution slot."""
+
+    def __init__(self, controller: "AdmissionController", kb: str):
+        self.controller = controller
+        self.kb = kb
+        self._queued = True
+        self._running = False
+
+    async def acquire(self) -> "Admission":
+        """Wait for an execution slot; returns at once if this admission holds one."""
+        if self._running:
+            return self
+        controller = self.controller
+        kb_semaphore = controller._kb_semaphore(self.kb)
+        await kb_semaphore.acquire()
+        try:
+            await controller._global.acquire()
+        except BaseException:
+            kb_semaphore.release()
+            raise
+        self._dequeue()
+        self._running = True
+        controller.active += 1
+        return self
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def _dequeue(self) -> None:
+        if self._queued:
+            self._queued = False
+            self.controller.queued -= 1
+
+    def close(self) -> None:
+        """Release the slot. Idempotent, also used when the response is never started."""
+        self._dequeue()
+        if self._running:
+            self._running = False
+            controller = self.controller
+            controller.active -= 1
+            controller._global.release()
+            controller._kb_semaphore(self.kb).release()
+
+
+class AdmissionController:
+    """Global and per-KB concurrency limits in front of a bounded wait queue."""
+
+    def __init__(
+        self, max_concurrency: int, max_per_kb: int, max_queue: int, retry_after: int
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_per_kb = max_per_kb
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._per_kb: Dict[str, asyncio.Semaphore] = {}
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def _kb_semaphore(self, kb: str) -> asyncio.Semaphore:
+        semaphore = self._per_kb.get(kb)
+        if semaphore is None:
+            semaphore = self._per_kb[kb] = asyncio.Semaphore(self.max_per_kb)
+        return semaphore
+
+    def admit(self, kb: str) -> Admission:
+        """Reserve a queue slot or fail fast with 429 (KB saturated) / 503 (server saturated)."""
+        must_wait = self._global.locked() or self._kb_semaphore(kb).locked()
+        if must_wait and self.queued >= self.max_queue:
+            self.rejected += 1
+            kb_saturated = not self._global.locked()
+            logger.warning(
+                f"Rejecting query for '{kb}': {self.active} active, {self.queued} queued"
+            )
+            raise HTTPException(
+                status_code=429 if kb_saturated else 503,
+                detail=(
+                    f"Too many concurrent queries for knowledge base '{kb}'"
+                    if kb_saturated
+                    else "Query queue is full, please retry later"
+                ),
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        self.queued += 1
+        return Admission(self, kb)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_per_kb": self.max_per_kb,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
+
+
+_settings = get_query_pool_settings()
+query_admission = AdmissionController(
+    max_concurrency=_settings["max_concurrency"],
+    max_per_kb=_settings["max_per_kb"],
+    max_queue=_settings["max_queue"],
+    retry_after=_settings["retry_after"],
+)
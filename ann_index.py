@@ -0,0 +1,307 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from utils import get_ann_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# <kb>/output 下的索引目录；位于子目录中，不影响 output_signature
+ANN_DIR = "ann"
+FORMAT_VERSION = 1
+# 实体向量重新生成时该产物一定会被改写，用它判断索引是否过期
+SOURCE_ARTIFACT = "create_final_entities.parquet"
+ASSIGN_CHUNK = 65536
+
+
+def _source_fingerprint(output_dir: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(os.path.join(output_dir, SOURCE_ARTIFACT))
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _normalize(vectors):
+    import numpy as np
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _nearest(vectors, centroids):
+    """Index of the most similar centroid for each (unit-length) vector."""
+    import numpy as np
+
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        chunk = vectors[start : start + ASSIGN_CHUNK]
+        assign[start : start + ASSIGN_CHUNK] = (chunk @ centroids.T).argmax(axis=1)
+    return assign
+
+
+def _kmeans(sample, nlist: int, iterations: int, seed: int):
+    """Spherical k-means: centroids stay unit length so scoring is a dot product."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+        # 空簇保留原来的中心
+        filled = counts > 0
+        centroids[filled] = _normalize(sums[filled])
+    return centroids
+
+
+def _read_embeddings(root: str, config) -> Tuple[Any, Any]:
+    """
+    Entity description embeddings and their ids from the KB's vector store, as
+    unit-length float32 rows. Only LanceDB stores can be read back in bulk.
+    """
+    import numpy as np
+    from engine import _open_description_embedding_store
+
+    store = _open_description_embedding_store(config, root)
+    table = getattr(store, "document_collection", None)
+    if table is None or not hasattr(table, "to_arrow"):
+        raise ValueError(f"{type(store).__name__} cannot be exported for ANN search")
+    data = table.to_arrow().select(["id", "vector"])
+    if data.num_rows == 0:
+        raise ValueError("The entity description vector store is empty")
+    ids = np.array(data.column("id").to_pylist(), dtype=str)
+    # 展平后整体转换，避免逐行生成数百万个小数组
+    flat = data.column("vector").combine_chunks().flatten()
+    vectors = flat.to_numpy(zero_copy_only=False).reshape(data.num_rows, -1)
+    return ids, _normalize(vectors.astype(np.float32, copy=False))
+
+
+def build_ann_index(root: str, config=None) -> Dict[str, Any]:
+    """
+    Build an IVF index over a KB's entity description embeddings into
+    <kb>/output/ann. Vectors are clustered with k-means and stored grouped by
+    list in one float32 file, so a query scans only the `nprobe` closest lists.
+    Blocking, run it from a worker thread after indexing.
+    """
+    import numpy as np
+    from engine import load_config
+
+    settings = get_ann_settings()
+    output_dir = os.path.join(root, "output")
+    started = time.perf_counter()
+    ids, vectors = _read_embeddings(root, config or load_config(root))
+    count, dim = vectors.shape
+    # 实体较少时只用一个列表，即对内存映射矩阵做精确搜索
+    if count < settings["min_entities"]:
+        nlist = 1
+    else:
+        nlist = max(1, int(np.sqrt(count) * settings["lists_factor"]))
+    if nlist > 1:
+        rng = np.random.default_rng(settings["seed"])
+        sample_size = min(count, nlist * settings["train_per_list"])
+        sample = vectors[np.sort(rng.choice(count, sample_size, replace=False))]
+        centroids = _kmeans(sample, nlist, settings["iterations"], settings["seed"])
+        assign = _nearest(vectors, centroids)
+    else:
+        centroids = np.zeros((1, dim), dtype=np.float32)
+        assign = np.zeros(count, dtype=np.int32)
+    order = np.argsort(assign, kind="stable")
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+
+    # 先写入临时目录再替换，查询进程不会读到写了一半的索引
+    target = os.path.join(output_dir, ANN_DIR)
+    tmp = f"{target}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "centroids.npy"), centroids.astype(np.float32))
+    np.save(os.path.join(tmp, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp, "vectors.npy"), vectors[order])
+    np.save(os.path.join(tmp, "ids.npy"), ids[order])
+    meta = {
+        "version": FORMAT_VERSION,
+        "count": int(count),
+        "dim": int(dim),
+        "nlist": nlist,
+        "source": _source_fingerprint(output_dir),
+        "built_at": time.time(),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+    logger.info(
+        f"Built ANN index for '{os.path.basename(root)}': {count} entities, "
+        f"{nlist} lists in {meta['seconds']:.2f}s"
+    )
+    return meta
+
+
+class ANNIndex:
+    """An IVF index opened read-only via mmap; the page cache is shared across processes."""
+
+    def __init__(self, path: str, meta: Dict[str, Any]):
+        import numpy as np
+
+        self.path = path
+        self.meta = meta
+        self.centroids = np.load(os.path.join(path, "centroids.npy"))
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+
+    def search(self, query, k: int, nprobe: int) -> List[Tuple[str, float]]:
+        """(id, cosine similarity) of the approximate top-k entities."""
+        import numpy as np
+
+        if k <= 0:
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows, scores = [], []
+        for cluster in lists:
+            start, end = self.offsets[cluster], self.offsets[cluster + 1]
+            if start < end:
+                rows.append(np.arange(start, end))
+                scores.append(self.vectors[start:end] @ query)
+        if not rows:
+            return []
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(str(self.ids[rows[i]]), float(scores[i])) for i in top]
+
+
+def open_ann_index(root: str) -> Optional[ANNIndex]:
+    """The KB's ANN index, or None if missing or older than its entity embeddings."""
+    output_dir = os.path.join(root, "output")
+    path = os.path.join(output_dir, ANN_DIR)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta.get("version") != FORMAT_VERSION:
+        return None
+    if meta.get("source") != _source_fingerprint(output_dir):
+        logger.warning(f"ANN index in {path} is stale, using the vector store")
+        return None
+    return ANNIndex(path, meta)
+
+
+class _LRU:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ANNVectorStore:
+    """
+    Stands in for graphrag's entity description vector store in local search:
+    similarity search goes to the ANN index and top-k results are cached per
+    query embedding. Everything else is delegated to the original store.
+    """
+
+    def __init__(self, index: ANNIndex, store: Any, nprobe: int, cache_size: int):
+        self.index = index
+        self.store = store
+        self.nprobe = nprobe
+        self._results = _LRU(cache_size)
+        # 本地搜索每次都会为问题文本计算向量，相同问题可直接复用
+        self._embeddings = _LRU(cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name: str):
+        return getattr(self.store, name)
+
+    def similarity_search_by_vector(
+        self, query_embedding: List[float], k: int = 10, **kwargs: Any
+    ) -> List[Any]:
+        from graphrag.vector_stores.base import (
+            VectorStoreDocument,
+            VectorStoreSearchResult,
+        )
+        import numpy as np
+
+        vector = np.asarray(query_embedding, dtype=np.float32)
+        key = (hashlib.sha1(vector.tobytes()).hexdigest(), k)
+        matches = self._results.get(key)
+        if matches is None:
+            self.misses += 1
+            matches = self.index.search(vector, k, self.nprobe)
+            self._results.put(key, matches)
+        else:
+            self.hits += 1
+        return [
+            VectorStoreSearchResult(
+                document=VectorStoreDocument(id=id, text=None, vector=None),
+                score=score,
+            )
+            for id, score in matches
+        ]
+
+    def similarity_search_by_text(
+        self, text: str, text_embedder: Callable[[str], Any], k: int = 10, **kwargs
+    ) -> List[Any]:
+        embedding = self._embeddings.get(text)
+        if embedding is None:
+            embedding = text_embedder(text)
+            if not embedding:
+                return []
+            self._embeddings.put(text, embedding)
+        return self.similarity_search_by_vector(embedding, k)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entities": self.index.meta["count"],
+            "lists": self.index.meta["nlist"],
+            "nprobe": self.nprobe,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def wrap_store(root: str, store: Any) -> Any:
+    """Put the KB's ANN index in front of its vector store when one is available."""
+    settings = get_ann_settings()
+    if not settings["enabled"]:
+        return store
+    try:
+        index = open_ann_index(root)
+    except Exception as e:
+        logger.error(f"Failed to open ANN index for {root}: {str(e)}")
+        return store
+    if index is None:
+        return store
+    return ANNVectorStore(index, store, settings["nprobe"], settings["cache_size"])
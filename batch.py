@@ -0,0 +1,301 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+import engine
+from models import ChatCompletionRequest, QueryOptions
+from query import execution_mode, query_deltas
+from result_cache import normalize_query
+from utils import get_batch_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+BATCH_MODEL = "graphrag-batch"
+GroupKey = Tuple[str, str, Optional[int]]
+
+
+@dataclass
+class BatchItem:
+    index: int
+    id: str
+    query: str
+    selected_folder: str
+    query_type: str
+    community_level: Optional[int]
+    # 参与结果缓存键，与交互式查询使用相同的 model 才能共享缓存
+    model: str = BATCH_MODEL
+    # 同一组内相同（规范化后）问题共享的键
+    key: str = ""
+    duplicates: List["BatchItem"] = field(default_factory=list)
+
+    @property
+    def group(self) -> GroupKey:
+        return self.selected_folder, self.query_type, self.community_level
+
+    def result(self, **fields: Any) -> Dict[str, Any]:
+        return {
+            "type": "result",
+            "index": self.index,
+            "id": self.id,
+            "query": self.query,
+            "selected_folder": self.selected_folder,
+            "query_type": self.query_type,
+            "community_level": self.community_level,
+            "model": self.model,
+            **fields,
+        }
+
+
+def item_key(group: GroupKey, model: str, query: str) -> str:
+    payload = json.dumps([*group, model, normalize_query(query)])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def parse_batch(
+    lines: List[str], defaults: Dict[str, Any], max_items: int
+) -> List[BatchItem]:
+    """
+    Parse JSONL questions. Each line is either a JSON string (the query) or an
+    object with `query` and optional `id`, `selected_folder`, `query_type`,
+    `community_level` and `model`; missing fields fall back to `defaults`.
+    """
+    items: List[BatchItem] = []
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=400, detail=f"Line {number} is not valid JSON: {str(e)}"
+            )
+        if isinstance(entry, str):
+            entry = {"query": entry}
+        if not isinstance(entry, dict) or not entry.get("query"):
+            raise HTTPException(status_code=400, detail=f"Line {number} has no 'query'")
+        options = {**defaults, **entry}
+        if not options.get("selected_folder"):
+            raise HTTPException(
+                status_code=400, detail=f"Line {number} has no 'selected_folder'"
+            )
+        index = len(items)
+        items.append(
+            BatchItem(
+                index=index,
+                id=str(entry.get("id", index)),
+                query=entry["query"],
+                selected_folder=options["selected_folder"],
+                query_type=options.get("query_type") or "local",
+                community_level=options.get("community_level"),
+                model=options.get("model") or BATCH_MODEL,
+            )
+        )
+        if len(items) > max_items:
+            raise HTTPException(
+                status_code=413, detail=f"A batch may hold at most {max_items} queries"
+            )
+    if not items:
+        raise HTTPException(status_code=400, detail="The batch is empty")
+    for item in items:
+        item.key = item_key(item.group, item.model, item.query)
+    return items
+
+
+class BatchStore:
+    """
+    Completed batch answers in SQLite so an interrupted batch can be resumed with
+    the same batch id. Blocking; call through asyncio.to_thread.
+    """
+
+    def __init__(self, path: str, retention: float):
+        self.path = path
+        self.retention = retention
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS batch_results ("
+                "batch_id TEXT NOT NULL, key TEXT NOT NULL, answer TEXT NOT NULL, "
+                "created REAL NOT NULL, PRIMARY KEY (batch_id, key))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_batch_results_created "
+                "ON batch_results (created)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def completed(self, batch_id: str) -> Dict[str, str]:
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM batch_results WHERE created < ?",
+                (time.time() - self.retention,),
+            )
+            rows = conn.execute(
+                "SELECT key, answer FROM batch_results WHERE batch_id = ?", (batch_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def save(self, batch_id: str, key: str, answer: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO batch_results VALUES (?, ?, ?, ?)",
+                (batch_id, key, answer, time.time()),
+            )
+
+
+async def _answer(item: BatchItem, max_retries: int) -> str:
+    """Run one question through the query pipeline and collect its answer."""
+    request = ChatCompletionRequest(
+        model=item.model,
+        query=item.query,
+        stream=False,
+        query_options=QueryOptions(
+            query_type=item.query_type,
+            community_level=item.community_level,
+            selected_folder=item.selected_folder,
+        ),
+    )
+    for attempt in range(max_retries + 1):
+        try:
+            deltas = await query_deltas(request)
+            break
+        except HTTPException as e:
+            # 准入队列已满时按 Retry-After 等待后重试
+            if e.status_code not in (429, 503) or attempt == max_retries:
+                raise
+            retry_after = float((e.headers or {}).get("Retry-After", 1))
+            await asyncio.sleep(retry_after)
+    return "".join([delta async for delta in deltas])
+
+
+async def _warm(group: GroupKey) -> None:
+    """Load the group's KB once before its questions fan out."""
+    folder, query_type, community_level = group
+    options = QueryOptions(
+        query_type=query_type,
+        community_level=community_level,
+        selected_folder=folder,
+    )
+    request = ChatCompletionRequest(model=BATCH_MODEL, query="", query_options=options)
+    if execution_mode(request) != "inprocess":
+        return
+    context = await engine.get_kb_context(folder)
+    await asyncio.to_thread(
+        engine.get_search_engine, context, query_type, community_level
+    )
+
+
+async def run_batch(
+    items: List[BatchItem],
+    batch_id: str,
+    store: BatchStore,
+    parallelism: int,
+    max_retries: int,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Answer a batch, yielding one result per input line as it completes and a
+    final summary. Questions are grouped by (selected_folder, query_type,
+    community_level) and groups run one after another so each KB is loaded once;
+    repeated questions within a group are answered once.
+    """
+    started = time.perf_counter()
+    done = await asyncio.to_thread(store.completed, batch_id)
+    groups: Dict[GroupKey, Dict[str, BatchItem]] = {}
+    for item in items:
+        unique = groups.setdefault(item.group, {})
+        if item.key in unique:
+            unique[item.key].duplicates.append(item)
+        else:
+            unique[item.key] = item
+    summary = {
+        "total": len(items),
+        "succeeded": 0,
+        "failed": 0,
+        "resumed": 0,
+        "deduplicated": len(items) - sum(len(g) for g in groups.values()),
+    }
+
+    def results(item: BatchItem, **fields: Any) -> List[Dict[str, Any]]:
+        ok = fields.get("status") == "ok"
+        summary["succeeded" if ok else "failed"] += 1 + len(item.duplicates)
+        first = item.result(**fields)
+        return [first] + [
+            dup.result(**fields, duplicate_of=item.index) for dup in item.duplicates
+        ]
+
+    for group, unique in groups.items():
+        pending: List[BatchItem] = []
+        for item in unique.values():
+            if item.key in done:
+                summary["resumed"] += 1 + len(item.duplicates)
+                for result in results(
+                    item, status="ok", answer=done[item.key], resumed=True
+                ):
+                    yield result
+            else:
+                pending.append(item)
+        if not pending:
+            continue
+        try:
+            await _warm(group)
+        except Exception as e:
+            logger.error(f"Failed to load '{group[0]}' for batch {batch_id}: {e}")
+            for item in pending:
+                for result in results(item, status="error", error=str(e)):
+                    yield result
+            continue
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def worker(todo: List[BatchItem]) -> None:
+            while todo:
+                item = todo.pop()
+                item_started = time.perf_counter()
+                try:
+                    answer = await _answer(item, max_retries)
+                    await asyncio.to_thread(store.save, batch_id, item.key, answer)
+                    fields = {"status": "ok", "answer": answer}
+                except Exception as e:
+                    detail = e.detail if isinstance(e, HTTPException) else str(e)
+                    fields = {"status": "error", "error": detail}
+                fields["elapsed"] = round(time.perf_counter() - item_started, 3)
+                await queue.put(results(item, **fields))
+
+        todo = list(reversed(pending))
+        workers = [
+            asyncio.create_task(worker(todo))
+            for _ in range(min(parallelism, len(pending)))
+        ]
+        try:
+            for _ in range(len(pending)):
+                for result in await queue.get():
+                    yield result
+        finally:
+            # 客户端断开时停止剩余问题，已完成的答案已保存，可用同一 batch_id 续跑
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    yield {
+        "type": "summary",
+        "batch_id": batch_id,
+        **summary,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def new_batch_id() -> str:
+    return uuid.uuid4().hex
+
+
+_settings = get_batch_settings()
+batch_store = BatchStore(_settings["path"], _settings["retention"])
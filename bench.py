@@ -0,0 +1,412 @@
+"""
+Benchmark harness and load generator for the query, upload and index endpoints.
+
+By default it starts the stub LLM server (stub_llm.py) and the API (main.py) on a
+throwaway KB_ROOT, creates a synthetic knowledge base, uploads and indexes it and
+then drives /v1/chat/completions at each concurrency level. Results are printed
+(or written with --output) as JSON so runs can be compared.
+
+    python bench.py --concurrency 1,4,16 --requests 32 --output bench.json
+    python bench.py --api http://127.0.0.1:8012 --api-pid 1234 --kb existing --skip-index
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+import httpx
+from profiling import process_tree_usage
+
+WORDS = (
+    "network supply market energy policy research vessel harbor council archive "
+    "treaty factory river mission laboratory contract festival railway"
+).split()
+NAMES = (
+    "Avalon Brightwater Corvina Delmont Everhart Falkreach Grisham Halvard Ithaca "
+    "Juniper Kestrel Lumen Marrow Northgate Orrin Pellucid Quarry Rowan Sable Tamsin"
+).split()
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    def ms(value: Optional[float]) -> Optional[float]:
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        "p50_ms": ms(percentile(values, 50)),
+        "p95_ms": ms(percentile(values, 95)),
+        "p99_ms": ms(percentile(values, 99)),
+        "max_ms": ms(max(values) if values else None),
+    }
+
+
+def synthetic_document(rng: random.Random, words: int) -> str:
+    """Sentences that mention a few capitalised names, so entity extraction finds some."""
+    sentences = []
+    while sum(len(s.split()) for s in sentences) < words:
+        names = rng.sample(NAMES, 2)
+        filler = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14)))
+        sentences.append(f"{names[0]} works with {names[1]} on the {filler}.")
+    return " ".join(sentences)
+
+
+class ResourceMonitor:
+    """Tracks peak RSS and process count of the API process tree between resets."""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_processes = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def reset(self) -> None:
+        self.peak_rss = 0
+        self.peak_processes = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        if self.pid is None or not os.path.isdir("/proc"):
+            return {"peak_rss_mb": None, "peak_processes": None}
+        return {
+            "peak_rss_mb": round(self.peak_rss / 1024**2, 1),
+            "peak_processes": self.peak_processes,
+        }
+
+    def start(self) -> None:
+        if self.pid is not None and os.path.isdir("/proc"):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            rss, count = await asyncio.to_thread(process_tree_usage, self.pid)
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_processes = max(self.peak_processes, count)
+            await asyncio.sleep(self.interval)
+
+
+def _spawn(cmd: List[str], env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "wb")
+    return subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def _wait_ready(client: httpx.AsyncClient, url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code < 500:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+
+async def bench_upload(
+    client: httpx.AsyncClient, args, monitor: ResourceMonitor
+) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    documents = [
+        (f"doc_{i:04d}.txt", synthetic_document(rng, args.doc_words).encode())
+        for i in range(args.docs)
+    ]
+    monitor.reset()
+    latencies: List[float] = []
+    started = time.perf_counter()
+    for name, content in documents:
+        t0 = time.perf_counter()
+        response = await client.post(
+            "/v1/upload/",
+            params={"root_path": args.kb},
+            files={"file": (name, content, "text/plain")},
+        )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    total = sum(len(content) for _, content in documents)
+    return {
+        "files": len(documents),
+        "bytes": total,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(total / 1024**2 / elapsed, 3) if elapsed else None,
+        "latency": summarize(latencies),
+        **monitor.snapshot(),
+    }
+
+
+async def bench_index(
+    client: httpx.AsyncClient, args, monitor: ResourceMonitor
+) -> Dict[str, Any]:
+    payload = {
+        "api_key": "stub",
+        "llm_model": "stub-chat",
+        "embed_model": "stub-embed",
+        "llm_api_base": f"{args.llm_base}/v1",
+        "embed_api_base": f"{args.llm_base}/v1",
+        "root": args.kb,
+        "mode": "full",
+    }
+    monitor.reset()
+    started = time.perf_counter()
+    response = await client.post("/v1/index", json=payload)
+    response.raise_for_status()
+    task_id = response.json()["task_id"]
+    status: Dict[str, Any] = {}
+    while time.perf_counter() - started < args.index_timeout:
+        status = (await client.get(f"/v1/index_status/{task_id}")).json()
+        if status["status"] in ("success", "failed", "cancelled"):
+            break
+        await asyncio.sleep(1)
+    result = status.get("result") or {}
+    return {
+        "task_id": task_id,
+        "status": status.get("status"),
+        "error": status.get("error"),
+        "seconds": round(time.perf_counter() - started, 3),
+        "report": result.get("report") if isinstance(result, dict) else None,
+        **monitor.snapshot(),
+    }
+
+
+async def _query_once(
+    client: httpx.AsyncClient, args, method: str, stream: bool, n: int
+) -> Dict[str, Any]:
+    query = args.query if args.repeat_query else f"{args.query} (#{n})"
+    payload = {
+        "model": f"graphrag-{method}-search:latest",
+        "query": query,
+        "stream": stream,
+        "query_options": {
+            "query_type": method,
+            "selected_folder": args.kb,
+            "community_level": args.community_level,
+        },
+    }
+    started = time.perf_counter()
+    ttft = None
+    try:
+        if not stream:
+            response = await client.post("/v1/chat/completions", json=payload)
+            response.raise_for_status()
+            ttft = time.perf_counter() - started
+        else:
+            async with client.stream(
+                "POST", "/v1/chat/completions", json=payload
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    event = json.loads(line[len("data: ") :])
+                    if "error" in event:
+                        raise RuntimeError(event["error"])
+                    delta = event["choices"][0].get("delta") or {}
+                    if ttft is None and delta.get("content"):
+                        ttft = time.perf_counter() - started
+    except (httpx.HTTPError, RuntimeError, ValueError) as e:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        return {"ok": False, "error": status or type(e).__name__}
+    return {"ok": True, "latency": time.perf_counter() - started, "ttft": ttft}
+
+
+async def bench_queries(
+    client: httpx.AsyncClient,
+    args,
+    monitor: ResourceMonitor,
+    method: str,
+    stream: bool,
+    concurrency: int,
+) -> Dict[str, Any]:
+    counter = iter(range(args.requests))
+    results: List[Dict[str, Any]] = []
+
+    async def worker():
+        for n in counter:
+            results.append(await _query_once(client, args, method, stream, n))
+
+    monitor.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    ok = [r for r in results if r["ok"]]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            errors[str(r["error"])] = errors.get(str(r["error"]), 0) + 1
+    return {
+        "method": method,
+        "stream": stream,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "succeeded": len(ok),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else None,
+        "latency": summarize([r["latency"] for r in ok]),
+        "ttft": summarize([r["ttft"] for r in ok if r["ttft"] is not None]),
+        **monitor.snapshot(),
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    processes: List[subprocess.Popen] = []
+    workdir = tempfile.mkdtemp(prefix="graphrag-bench-")
+    api_pid = args.api_pid
+    try:
+        if args.llm_base is None:
+            args.llm_base = f"http://127.0.0.1:{args.stub_port}"
+            processes.append(
+                _spawn(
+                    [
+                        sys.executable,
+                        "stub_llm.py",
+                        "--port",
+                        str(args.stub_port),
+                        "--latency",
+                        str(args.stub_latency),
+                        *shlex.split(args.stub_args),
+                    ],
+                    dict(os.environ),
+                    os.path.join(workdir, "stub_llm.log"),
+                )
+            )
+        if args.api is None:
+            args.api = f"http://127.0.0.1:{args.api_port}"
+            env = dict(os.environ)
+            env.setdefault("KB_ROOT", os.path.join(workdir, "kbs"))
+            env.setdefault("STATE_DIR", os.path.join(workdir, "state"))
+            api = _spawn(
+                [sys.executable, "main.py", "--port", str(args.api_port)],
+                env,
+                os.path.join(workdir, "api.log"),
+            )
+            processes.append(api)
+            api_pid = api.pid
+        timeout = httpx.Timeout(args.request_timeout)
+        limits = httpx.Limits(max_connections=max(args.concurrency) * 2)
+        async with httpx.AsyncClient(
+            base_url=args.api, timeout=timeout, limits=limits
+        ) as client:
+            await _wait_ready(client, "/v1/health", 60)
+            await _wait_ready(client, f"{args.llm_base}/v1/models", 30)
+            monitor = ResourceMonitor(api_pid)
+            monitor.start()
+            results: Dict[str, Any] = {
+                "started": time.time(),
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "settings": dict(vars(args)),
+                "workdir": workdir,
+            }
+            try:
+                if not args.skip_index:
+                    response = await client.post("/v1/init", json={"root": args.kb})
+                    if response.status_code not in (200, 409):
+                        response.raise_for_status()
+                    results["upload"] = await bench_upload(client, args, monitor)
+                    results["index"] = await bench_index(client, args, monitor)
+                    if results["index"]["status"] != "success":
+                        return results
+                results["queries"] = [
+                    await bench_queries(
+                        client, args, monitor, method, stream, concurrency
+                    )
+                    for method in args.methods
+                    for stream in (False, True)
+                    for concurrency in args.concurrency
+                ]
+                pool_stats = await client.get("/v1/query_pool/stats")
+                if pool_stats.status_code == 200:
+                    results["query_pool"] = pool_stats.json()
+                stub_stats = await client.get(f"{args.llm_base}/v1/stub/stats")
+                if stub_stats.status_code == 200:
+                    results["llm_stub"] = stub_stats.json()
+            finally:
+                await monitor.stop()
+            return results
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the GraphRAG API")
+    parser.add_argument(
+        "--api", type=str, default=None, help="Use a running API instead of main.py"
+    )
+    parser.add_argument(
+        "--api-pid", type=int, default=None, help="Pid of --api, for RSS sampling"
+    )
+    parser.add_argument("--api-port", type=int, default=8013)
+    parser.add_argument(
+        "--llm-base",
+        type=str,
+        default=None,
+        help="OpenAI-compatible base URL used for indexing; starts stub_llm.py if unset",
+    )
+    parser.add_argument("--stub-port", type=int, default=8900)
+    parser.add_argument("--stub-latency", type=float, default=0.0)
+    parser.add_argument(
+        "--stub-args",
+        type=str,
+        default="",
+        help='Extra stub_llm.py options, e.g. "--tokens-per-second 40 --rpm 600"',
+    )
+    parser.add_argument("--kb", type=str, default="bench")
+    parser.add_argument("--skip-index", action="store_true")
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--doc-words", type=int, default=400)
+    parser.add_argument("--index-timeout", type=float, default=1800)
+    parser.add_argument(
+        "--methods", type=lambda v: v.split(","), default=["local", "global"]
+    )
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 4, 16])
+    parser.add_argument(
+        "--requests", type=int, default=32, help="Queries per concurrency level"
+    )
+    parser.add_argument("--query", type=str, default="What are the main themes?")
+    parser.add_argument(
+        "--repeat-query",
+        action="store_true",
+        help="Send the same query every time (measures caching and coalescing)",
+    )
+    parser.add_argument("--community-level", type=int, default=2)
+    parser.add_argument("--request-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+    report = json.dumps(asyncio.run(run(args)), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print(report)
@@ -0,0 +1,427 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+from itertools import count
+from typing import Any, Dict, Iterator, List, Optional
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import asynccontextmanager
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from metrics import merge_expositions
+from utils import get_cluster_settings, get_kb_cache_max_bytes, get_query_pool_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 正在排空的进程在 503 响应中带上此头，路由器据此改投其他工作进程
+DRAINING_HEADER = "X-Draining"
+NODE_HEADER = "X-Cluster-Node"
+HEALTH_PATH = "/v1/health"
+# 不转发的逐跳头
+HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+# 知识库名在查询参数、路径或请求体中的位置
+AFFINITY_PARAMS = ("selected_folder", "root_path")
+_KB_PATH = re.compile(
+    r"^/v1/(?:knowledge_bases|show_uploaded_files|index_report)/([^/]+)"
+)
+BODY_AFFINITY_PATHS = {"/v1/chat/completions"}
+REPLAYABLE_METHODS = {"GET", "HEAD", "DELETE", "OPTIONS"}
+
+
+class DrainTracker:
+    """Requests in flight in this process, and whether it is shutting down."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.draining = False
+
+    async def wait(self, timeout: float) -> None:
+        """Stop taking new requests and wait up to `timeout` for in-flight ones."""
+        self.draining = True
+        if self.in_flight:
+            logger.info(f"Draining {self.in_flight} in-flight requests")
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.in_flight:
+            logger.warning(f"Drain timed out with {self.in_flight} requests in flight")
+
+
+class DrainMiddleware:
+    """
+    Pure ASGI middleware counting in-flight requests until their last body chunk
+    is sent, so streamed responses count as in flight for their whole length.
+    While draining, new HTTP requests get a 503 the router retries elsewhere.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        if scope["type"] == "http" and scope["path"] != HEALTH_PATH and drain.draining:
+            response = JSONResponse(
+                {"detail": "Server is shutting down"},
+                status_code=503,
+                headers={"Retry-After": "1", DRAINING_HEADER: "1"},
+            )
+            await response(scope, receive, send)
+            return
+        drain.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            drain.in_flight -= 1
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, with `replicas` virtual points per node."""
+
+    def __init__(self, nodes: List[str], replicas: int):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def walk(self, key: str) -> Iterator[str]:
+        """Distinct nodes in ring order from `key`: the owner first, then fallbacks."""
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for i in range(len(self._nodes)):
+            node = self._nodes[(start + i) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+
+def affinity_key(path: str, params, body: Optional[bytes]) -> Optional[str]:
+    """The knowledge base a request works on, if it names one."""
+    for name in AFFINITY_PARAMS:
+        if params.get(name):
+            return params[name]
+    match = _KB_PATH.match(path)
+    if match:
+        return match.group(1)
+    if body:
+        try:
+            options = json.loads(body).get("query_options") or {}
+            return options.get("selected_folder")
+        except (ValueError, AttributeError):
+            return None
+    return None
+
+
+class ClusterRouter:
+    """
+    Reverse proxy in front of the API workers. Requests naming a knowledge base
+    go to the worker that owns it on the hash ring, so its context, result cache
+    and coalescing stay warm in one process; when that worker is down or
+    draining the next worker on the ring takes over, and only its keys move.
+    Other requests are spread round-robin: jobs, rate limits, batches and the
+    LLM cache live in SQLite under STATE_DIR and look the same from every worker.
+    /metrics and the */stats endpoints describe a single process, so the router
+    asks every worker instead (see `scrape`).
+    WebSocket routes are not proxied; use the SSE endpoints through the router.
+    """
+
+    def __init__(self, workers: List[str], settings: Dict[str, Any]):
+        self.ring = HashRing(workers, settings["replicas"])
+        self.health_interval = settings["health_interval"]
+        self.connect_timeout = settings["connect_timeout"]
+        self.nodes: Dict[str, Dict[str, Any]] = {
+            node: {"healthy": False, "routed": 0, "failures": 0, "checked": None}
+            for node in workers
+        }
+        self._next = count()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        # 流式响应可能持续很久，只限制连接超时
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(None, connect=self.connect_timeout)
+        )
+        await self._check_all()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def _check(self, node: str) -> None:
+        state = self.nodes[node]
+        try:
+            response = await self._client.get(
+                f"{node}{HEALTH_PATH}", timeout=self.connect_timeout
+            )
+            healthy = response.status_code == 200
+        except httpx.HTTPError:
+            healthy = False
+        if healthy != state["healthy"]:
+            logger.info(f"Worker {node} is {'up' if healthy else 'down'}")
+        state.update(healthy=healthy, checked=time.time())
+
+    async def _check_all(self) -> None:
+        await asyncio.gather(*(self._check(node) for node in self.nodes))
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self._check_all()
+            except Exception as e:
+                logger.error(f"Worker health check failed: {str(e)}")
+
+    def candidates(self, key: Optional[str]) -> List[str]:
+        if key is not None:
+            order = list(self.ring.walk(key))
+        else:
+            nodes = self.ring.nodes
+            start = next(self._next) % len(nodes)
+            order = nodes[start:] + nodes[:start]
+        healthy = [node for node in order if self.nodes[node]["healthy"]]
+        # 健康状态可能过期，全部不可用时仍按顺序尝试
+        return healthy or order
+
+    def _mark_down(self, node: str, reason: str) -> None:
+        logger.warning(f"Worker {node} unavailable: {reason}")
+        self.nodes[node]["healthy"] = False
+        self.nodes[node]["failures"] += 1
+
+    async def proxy(self, request: Request):
+        path = request.url.path
+        body = None
+        if request.method == "POST" and path in BODY_AFFINITY_PATHS:
+            body = await request.body()
+        key = affinity_key(path, request.query_params, body)
+        # 只有请求体已缓存或没有请求体时才能在其他工作进程上重试
+        replayable = body is not None or request.method in REPLAYABLE_METHODS
+        content = body if replayable else request.stream()
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name.lower() not in HOP_HEADERS
+        }
+        query = f"?{request.url.query}" if request.url.query else ""
+        for node in self.candidates(key):
+            upstream = self._client.build_request(
+                request.method, f"{node}{path}{query}", headers=headers, content=content
+            )
+            try:
+                response = await self._client.send(upstream, stream=True)
+            except httpx.TransportError as e:
+                self._mark_down(node, str(e) or type(e).__name__)
+                if replayable:
+                    continue
+                raise HTTPException(status_code=502, detail=f"Worker {node} failed")
+            if (
+                response.status_code == 503
+                and response.headers.get(DRAINING_HEADER)
+                and replayable
+            ):
+                await response.aclose()
+                self._mark_down(node, "draining")
+                continue
+            self.nodes[node]["routed"] += 1
+            response_headers = {
+                name: value
+                for name, value in response.headers.items()
+                if name.lower() not in HOP_HEADERS
+            }
+            response_headers[NODE_HEADER] = node
+            return StreamingResponse(
+                self._relay(response),
+                status_code=response.status_code,
+                headers=response_headers,
+            )
+        raise HTTPException(
+            status_code=503,
+            detail="No worker available",
+            headers={"Retry-After": "1"},
+        )
+
+    @staticmethod
+    async def _relay(response: httpx.Response):
+        # 客户端断开时关闭上游连接，工作进程随之取消查询
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+
+    async def scrape(self, path: str) -> Dict[str, Any]:
+        """GET `path` from every worker; failed workers map to the exception."""
+
+        async def fetch(node: str):
+            response = await self._client.get(
+                f"{node}{path}", timeout=self.connect_timeout
+            )
+            response.raise_for_status()
+            return response
+
+        responses = await asyncio.gather(
+            *(fetch(node) for node in self.nodes), return_exceptions=True
+        )
+        return dict(zip(self.nodes, responses))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "nodes": self.nodes,
+            "in_flight": drain.in_flight,
+            "draining": drain.draining,
+        }
+
+
+def create_router_app(workers: List[str]) -> FastAPI:
+    """The KB-affinity router as an ASGI app over the given worker base URLs."""
+    settings = get_cluster_settings()
+    cluster = ClusterRouter(workers, settings)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await cluster.start()
+        logger.info(f"Routing to {len(workers)} workers")
+        yield
+        await drain.wait(settings["drain_timeout"])
+        await cluster.stop()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.get(HEALTH_PATH)
+    async def health_check():
+        if drain.draining:
+            return JSONResponse({"status": "draining"}, status_code=503)
+        up = sum(1 for state in cluster.nodes.values() if state["healthy"])
+        status = "ok" if up else "unavailable"
+        return JSONResponse(
+            {"status": status, "workers": up}, status_code=200 if up else 503
+        )
+
+    @app.get("/v1/cluster")
+    async def cluster_stats():
+        return cluster.stats()
+
+    @app.get("/metrics")
+    async def metrics():
+        """Every worker's metrics in one exposition, told apart by the `worker` label."""
+        texts = []
+        for node, response in (await cluster.scrape("/metrics")).items():
+            if isinstance(response, Exception):
+                logger.warning(f"Failed to scrape metrics from {node}: {response}")
+            else:
+                texts.append(response.text)
+        return PlainTextResponse(
+            merge_expositions(texts), media_type="text/plain; version=0.0.4"
+        )
+
+    @app.get("/v1/{name}/stats")
+    async def worker_stats(name: str):
+        """A per-process stats endpoint from every worker, keyed by worker URL."""
+        workers = {}
+        for node, response in (await cluster.scrape(f"/v1/{name}/stats")).items():
+            if isinstance(response, Exception):
+                workers[node] = {"error": str(response) or type(response).__name__}
+            else:
+                workers[node] = response.json()
+        return {"workers": workers}
+
+    @app.api_route(
+        "/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "HEAD"]
+    )
+    async def proxy(request: Request):
+        return await cluster.proxy(request)
+
+    app.add_middleware(DrainMiddleware)
+    return app
+
+
+def worker_environ(count: int) -> Dict[str, str]:
+    """
+    Environment for one of `count` local workers. QUERY_MAX_CONCURRENCY,
+    QUERY_QUEUE_SIZE and KB_CACHE_MAX_BYTES stay host-wide totals and are split
+    evenly; QUERY_MAX_PER_KB is kept, as each KB is served by one worker.
+    """
+    pool = get_query_pool_settings()
+    return {
+        **os.environ,
+        "QUERY_MAX_CONCURRENCY": str(max(1, pool["max_concurrency"] // count)),
+        "QUERY_QUEUE_SIZE": str(max(1, pool["max_queue"] // count)),
+        "KB_CACHE_MAX_BYTES": str(get_kb_cache_max_bytes() // count),
+    }
+
+
+def spawn_workers(ports: List[int], drain_timeout: float) -> List[subprocess.Popen]:
+    """Start one API worker per port on localhost, each with its own uvicorn."""
+    environ = worker_environ(len(ports))
+    processes = []
+    for port in ports:
+        # 独立进程组，终端的 Ctrl+C 只发给路由器，由它按顺序停止工作进程
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "uvicorn",
+                    "main:app",
+                    "--host",
+                    "127.0.0.1",
+                    "--port",
+                    str(port),
+                    "--timeout-graceful-shutdown",
+                    str(int(drain_timeout)),
+                ],
+                env={**environ, "CLUSTER_NODE": f"http://127.0.0.1:{port}"},
+                start_new_session=True,
+            )
+        )
+        logger.info(f"Started worker on port {port}")
+    return processes
+
+
+def stop_workers(processes: List[subprocess.Popen], drain_timeout: float) -> None:
+    """SIGTERM the workers so they drain, killing any still running after the timeout."""
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + drain_timeout + 5
+    for process in processes:
+        try:
+            process.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Worker {process.pid} did not stop, killing it")
+            process.kill()
+            process.wait()
+
+
+drain = DrainTracker()
@@ -0,0 +1,300 @@
+import asyncio
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from string import Template
+from typing import Any, AsyncGenerator, Dict, Optional, Tuple
+from dotenv import dotenv_values
+from utils import get_kb_root, get_llm_cache_settings, get_snapshot_settings
+from kb_cache import kb_cache, output_signature
+from ann_index import wrap_store
+from snapshot import read_snapshot
+from rate_limiter import RateLimitedLLM
+from llm_cache import CachedLLM, llm_cache
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 查询所需的 graphrag 输出表
+ARTIFACTS = {
+    "nodes": "create_final_nodes.parquet",
+    "entities": "create_final_entities.parquet",
+    "communities": "create_final_communities.parquet",
+    "community_reports": "create_final_community_reports.parquet",
+    "text_units": "create_final_text_units.parquet",
+    "relationships": "create_final_relationships.parquet",
+}
+OPTIONAL_ARTIFACTS = {"covariates": "create_final_covariates.parquet"}
+SUPPORTED_METHODS = ("global", "local")
+DEFAULT_RESPONSE_TYPE = "Multiple Paragraphs"
+
+# graphrag 按以下顺序查找知识库的配置文件
+SETTINGS_FILES = ("settings.yaml", "settings.yml", "settings.json")
+
+
+@dataclass
+class KBContext:
+    """A knowledge base's loaded config, output tables and search engines."""
+
+    name: str
+    root: str
+    config: Any
+    tables: Dict[str, Any]
+    loaded_at: float = field(default_factory=time.time)
+    engines: Dict[Tuple[str, Optional[int], str], Any] = field(default_factory=dict)
+    description_embedding_store: Any = None
+    engine_lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def table(self, name: str):
+        return self.tables.get(name)
+
+
+def _read_settings(root: str) -> Dict[str, Any]:
+    """
+    The KB's settings file with ${...} resolved from its own .env, falling back
+    to the process environment. os.environ itself is never modified, so
+    concurrent loads and subprocesses cannot see another KB's values.
+    """
+    from ruamel.yaml import YAML
+
+    env_file = os.path.join(root, ".env")
+    values = dotenv_values(env_file) if os.path.exists(env_file) else {}
+    variables = {
+        **os.environ,
+        **{key: value for key, value in values.items() if value is not None},
+    }
+    for name in SETTINGS_FILES:
+        path = os.path.join(root, name)
+        if os.path.exists(path):
+            break
+    else:
+        raise FileNotFoundError(f"No settings.yaml in {root}")
+    with open(path, "r", encoding="utf-8") as f:
+        text = Template(f.read()).substitute(variables)
+    # JSON 也是合法的 YAML
+    return YAML(typ="safe").load(text) or {}
+
+
+def load_config(root: str):
+    """The KB's graphrag config, with ${...} resolved from its own .env."""
+    from graphrag.config.create_graphrag_config import create_graphrag_config
+
+    config = create_graphrag_config(_read_settings(root), root)
+    config.storage.base_dir = os.path.join(root, "output")
+    try:
+        from graphrag.config.resolve_path import resolve_paths
+
+        resolve_paths(config)
+    except ImportError:
+        pass
+    return config
+
+
+def _read_tables(output_dir: str) -> Dict[str, Any]:
+    import pandas as pd
+
+    if get_snapshot_settings()["enabled"]:
+        tables = read_snapshot(output_dir)
+        if tables is not None:
+            missing = [name for name in ARTIFACTS if tables.get(name) is None]
+            if missing:
+                raise FileNotFoundError(f"Missing artifacts {missing} in {output_dir}")
+            return tables
+    tables: Dict[str, Any] = {}
+    for name, filename in ARTIFACTS.items():
+        path = os.path.join(output_dir, filename)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Missing artifact {filename} in {output_dir}")
+        tables[name] = pd.read_parquet(path)
+    for name, filename in OPTIONAL_ARTIFACTS.items():
+        path = os.path.join(output_dir, filename)
+        tables[name] = pd.read_parquet(path) if os.path.exists(path) else None
+    return tables
+
+
+def _open_description_embedding_store(config, root: str):
+    from graphrag.api.query import _get_embedding_store
+    from graphrag.index.config.embeddings import entity_description_embedding
+
+    vector_store_args = dict(config.embeddings.vector_store or {})
+    db_uri = vector_store_args.get("db_uri")
+    if db_uri and not os.path.isabs(db_uri):
+        vector_store_args["db_uri"] = os.path.join(root, db_uri)
+    return _get_embedding_store(
+        config_args=vector_store_args, embedding_name=entity_description_embedding
+    )
+
+
+def load_kb_context(selected_folder: str, kb_root: str = get_kb_root()) -> KBContext:
+    """
+    Load a knowledge base's settings, output tables and vector store once.
+    This is blocking (parquet parsing), call it from a worker thread.
+    """
+    root = os.path.join(kb_root, selected_folder)
+    output_dir = os.path.join(root, "output")
+    if not os.path.isdir(output_dir):
+        raise FileNotFoundError(f"Knowledge base '{selected_folder}' is not indexed")
+    start = time.perf_counter()
+    config = load_config(root)
+    tables = _read_tables(output_dir)
+    context = KBContext(name=selected_folder, root=root, config=config, tables=tables)
+    context.description_embedding_store = wrap_store(
+        root, _open_description_embedding_store(config, root)
+    )
+    logger.info(
+        f"Loaded knowledge base '{selected_folder}' in {time.perf_counter() - start:.2f}s"
+    )
+    return context
+
+
+def preload() -> None:
+    """Import the heavy graphrag query modules ahead of the first request."""
+    import graphrag.api.query  # noqa: F401
+    import graphrag.query.factory  # noqa: F401
+    import graphrag.query.indexer_adapters  # noqa: F401
+
+
+def _build_search_engine(
+    context: KBContext, method: str, community_level: Optional[int], response_type: str
+):
+    from graphrag.query.factory import get_global_search_engine, get_local_search_engine
+    from graphrag.query.indexer_adapters import (
+        read_indexer_communities,
+        read_indexer_covariates,
+        read_indexer_entities,
+        read_indexer_relationships,
+        read_indexer_reports,
+        read_indexer_text_units,
+    )
+
+    nodes = context.table("nodes")
+    reports = context.table("community_reports")
+    entities = read_indexer_entities(
+        nodes, context.table("entities"), community_level=community_level
+    )
+    if method == "global":
+        search_engine = get_global_search_engine(
+            context.config,
+            reports=read_indexer_reports(
+                reports,
+                nodes,
+                community_level=community_level,
+                dynamic_community_selection=False,
+            ),
+            entities=entities,
+            communities=read_indexer_communities(
+                context.table("communities"), nodes, reports
+            ),
+            response_type=response_type,
+            dynamic_community_selection=False,
+        )
+    else:
+        covariates = context.table("covariates")
+        search_engine = get_local_search_engine(
+            config=context.config,
+            reports=read_indexer_reports(reports, nodes, community_level),
+            text_units=read_indexer_text_units(context.table("text_units")),
+            entities=entities,
+            relationships=read_indexer_relationships(context.table("relationships")),
+            covariates={
+                "claims": (
+                    read_indexer_covariates(covariates)
+                    if covariates is not None
+                    else []
+                )
+            },
+            description_embedding_store=context.description_embedding_store,
+            response_type=response_type,
+        )
+    search_engine.llm = wrap_llm(search_engine.llm, context.config)
+    return search_engine
+
+
+def wrap_llm(llm: Any, config) -> Any:
+    """Put a query LLM behind the shared rate limit and the shared LLM cache."""
+    # 查询的 LLM 调用与其他查询及索引任务共享同一份限流预算
+    settings = config.llm
+    llm = RateLimitedLLM(llm, settings.api_base, settings.model)
+    if llm_cache.enabled and get_llm_cache_settings()["queries"]:
+        # 命中共享缓存的调用不占用限流预算
+        llm = CachedLLM(llm, settings.model)
+    return llm
+
+
+def build_chat_llm(root: str) -> Any:
+    """The KB's configured chat model as a wrapped query LLM. Blocking."""
+    from graphrag.query.llm.get_client import get_llm
+
+    config = load_config(root)
+    return wrap_llm(get_llm(config), config)
+
+
+def get_search_engine(
+    context: KBContext,
+    method: str,
+    community_level: Optional[int],
+    response_type: str = DEFAULT_RESPONSE_TYPE,
+):
+    """Return the search engine for (method, community_level), building it on first use."""
+    if method not in SUPPORTED_METHODS:
+        raise ValueError(f"Unsupported in-process query method: {method}")
+    key = (method, community_level, response_type)
+    with context.engine_lock:
+        engine = context.engines.get(key)
+        if engine is None:
+            engine = _build_search_engine(
+                context, method, community_level, response_type
+            )
+            context.engines[key] = engine
+        return engine
+
+
+_context_locks: Dict[str, asyncio.Lock] = {}
+
+
+async def get_kb_context(selected_folder: str) -> KBContext:
+    """Return the warm context for a knowledge base, loading it on a cache miss."""
+    context = kb_cache.get(selected_folder)
+    if context is not None:
+        return context
+    lock = _context_locks.setdefault(selected_folder, asyncio.Lock())
+    async with lock:
+        context = kb_cache.get(selected_folder)
+        if context is None:
+            # 加载前记录产物签名，加载期间的重新索引会在下次访问时被发现
+            signature = output_signature(selected_folder)
+            context = await asyncio.to_thread(load_kb_context, selected_folder)
+            kb_cache.put(selected_folder, context, signature)
+        return context
+
+
+def drop_kb_context(selected_folder: str) -> None:
+    kb_cache.invalidate(selected_folder)
+
+
+async def search(
+    selected_folder: str, method: str, community_level: Optional[int], query: str
+) -> str:
+    context = await get_kb_context(selected_folder)
+    engine = await asyncio.to_thread(
+        get_search_engine, context, method, community_level
+    )
+    result = await engine.asearch(query=query)
+    return result.response
+
+
+async def stream_search(
+    selected_folder: str, method: str, community_level: Optional[int], query: str
+) -> AsyncGenerator[str, None]:
+    context = await get_kb_context(selected_folder)
+    engine = await asyncio.to_thread(
+        get_search_engine, context, method, community_level
+    )
+    first = True
+    async for chunk in engine.astream_search(query=query):
+        # 第一个块是检索上下文，而不是回答内容
+        if first:
+            first = False
+            continue
+        yield chunk
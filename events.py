@@ -0,0 +1,194 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncGenerator, Dict, List, Optional
+from utils import get_index_event_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# graphrag 默认索引流水线中的工作流，用于估算整体进度
+DEFAULT_WORKFLOWS = [
+    "create_base_text_units",
+    "create_final_documents",
+    "extract_graph",
+    "compute_communities",
+    "create_final_entities",
+    "create_final_relationships",
+    "create_final_nodes",
+    "create_final_communities",
+    "create_final_covariates",
+    "create_final_text_units",
+    "create_final_community_reports",
+    "generate_text_embeddings",
+]
+
+_ANSI = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+_WORKFLOW = re.compile(
+    r"(?:Running workflow|Starting workflow|Executing workflow)[:\s]+([a-z_]+)"
+)
+_WORKFLOW_DONE = re.compile(r"🚀\s*([a-z_]+)")
+_PERCENT = re.compile(r"(\d{1,3})%")
+_ROWS = re.compile(r"(\d+)\s*/\s*(\d+)")
+_ERROR = re.compile(r"(❌|\berror\b|Traceback|Exception)", re.IGNORECASE)
+
+LOG, STEP_START, STEP_PROGRESS, STEP_END, ERROR, STATUS = (
+    "log",
+    "step_start",
+    "step_progress",
+    "step_end",
+    "error",
+    "status",
+)
+
+
+class JobEventLog:
+    """
+    Structured progress events for one indexing job, parsed from graphrag's output.
+    Events are kept in a bounded ring buffer so late subscribers can replay them.
+    """
+
+    def __init__(self, job_id: str, max_events: int):
+        self.job_id = job_id
+        self.events: deque = deque(maxlen=max_events)
+        self.started = time.time()
+        self.finished = False
+        self.seq = 0
+        self.workflow: Optional[str] = None
+        self.workflow_started: Optional[float] = None
+        self.completed_workflows: List[str] = []
+        self.step_timings: Dict[str, float] = {}
+        self.step_percent = 0.0
+        # 每产生一个事件就设置并换成新的 Event，等待中的订阅者都会被唤醒
+        self._changed = asyncio.Event()
+
+    @property
+    def percent(self) -> float:
+        total = max(len(DEFAULT_WORKFLOWS), len(self.completed_workflows) + 1)
+        if self.finished:
+            return 100.0
+        done = len(self.completed_workflows) + self.step_percent / 100
+        return round(min(99.0, done / total * 100), 1)
+
+    def _emit(self, event_type: str, **fields: Any) -> Dict[str, Any]:
+        now = time.time()
+        self.seq += 1
+        event = {
+            "seq": self.seq,
+            "job_id": self.job_id,
+            "type": event_type,
+            "time": now,
+            "elapsed": round(now - self.started, 3),
+            "workflow": self.workflow,
+            "percent": self.percent,
+            **fields,
+        }
+        self.events.append(event)
+        self._changed.set()
+        self._changed = asyncio.Event()
+        return event
+
+    def _end_step(self) -> None:
+        if self.workflow is None:
+            return
+        elapsed = time.time() - self.workflow_started
+        self.step_timings[self.workflow] = round(elapsed, 3)
+        if self.workflow not in self.completed_workflows:
+            self.completed_workflows.append(self.workflow)
+        self.step_percent = 0.0
+        self._emit(STEP_END, step_elapsed=round(elapsed, 3))
+        self.workflow = None
+
+    def _start_step(self, workflow: str) -> None:
+        if self.workflow == workflow:
+            return
+        self._end_step()
+        self.workflow = workflow
+        self.workflow_started = time.time()
+        self._emit(STEP_START)
+
+    def feed(self, line: str) -> None:
+        """Parse one line of graphrag output into events."""
+        line = _ANSI.sub("", line).strip()
+        if not line:
+            return
+        started = _WORKFLOW.search(line)
+        done = _WORKFLOW_DONE.search(line)
+        if started:
+            self._start_step(started.group(1))
+        elif done:
+            # rich/print 报告器在工作流结束时输出 "🚀 <workflow>"
+            if self.workflow != done.group(1):
+                self._start_step(done.group(1))
+            self._end_step()
+            return
+        if _ERROR.search(line):
+            self._emit(ERROR, message=line)
+            return
+        percent = _PERCENT.search(line)
+        rows = _ROWS.search(line)
+        if percent or rows:
+            fields: Dict[str, Any] = {"message": line}
+            if percent:
+                self.step_percent = min(100.0, float(percent.group(1)))
+                fields["step_percent"] = self.step_percent
+            if rows:
+                fields["rows_processed"] = int(rows.group(1))
+                fields["rows_total"] = int(rows.group(2))
+            if self.workflow_started is not None:
+                fields["step_elapsed"] = round(time.time() - self.workflow_started, 3)
+            self._emit(STEP_PROGRESS, **fields)
+            return
+        self._emit(LOG, message=line)
+
+    def finish(self, status: str, message: Optional[str] = None) -> None:
+        if status == "success":
+            self._end_step()
+        self.finished = True
+        self._emit(
+            STATUS, status=status, message=message, step_timings=self.step_timings
+        )
+
+    def since(self, after: int) -> List[Dict[str, Any]]:
+        """Buffered events with seq > `after`."""
+        return [event for event in self.events if event["seq"] > after]
+
+    async def subscribe(self, after: int = 0) -> AsyncGenerator[Dict[str, Any], None]:
+        """Replay buffered events with seq > `after`, then follow new ones until the job ends."""
+        position = after
+        while True:
+            for event in self.since(position):
+                position = event["seq"]
+                yield event
+            if self.finished and position >= self.seq:
+                return
+            changed = self._changed
+            if self.seq <= position and not self.finished:
+                await changed.wait()
+
+
+class JobEventRegistry:
+    """Event logs of jobs run by this process; the most recent finished ones are kept."""
+
+    def __init__(self, max_events: int, max_jobs: int):
+        self.max_events = max_events
+        self.max_jobs = max_jobs
+        self._logs: "OrderedDict[str, JobEventLog]" = OrderedDict()
+
+    def create(self, job_id: str) -> JobEventLog:
+        log = JobEventLog(job_id, self.max_events)
+        self._logs[job_id] = log
+        while len(self._logs) > self.max_jobs:
+            oldest = next(iter(self._logs))
+            if not self._logs[oldest].finished:
+                break
+            self._logs.pop(oldest)
+        return log
+
+    def get(self, job_id: str) -> Optional[JobEventLog]:
+        return self._logs.get(job_id)
+
+
+_settings = get_index_event_settings()
+job_events = JobEventRegistry(_settings["max_events"], _settings["max_jobs"])
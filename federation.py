@@ -0,0 +1,145 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional
+from fastapi import HTTPException
+import engine
+from models import ChatCompletionRequest, FederatedQueryRequest, QueryOptions
+from query import query_deltas
+from utils import get_kb_root
+from metrics import error
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+REDUCE_PROMPT = (
+    "You are given answers to the same question from several separate knowledge "
+    "bases. Merge them into one answer to the question. Keep facts that only one "
+    "knowledge base reports, point out where they disagree, and attribute each "
+    "point to its knowledge base by name. Ignore answers that say they have no "
+    "relevant information."
+)
+
+
+def _event(name: str, data: Dict[str, Any]) -> str:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _query_kb(
+    request: FederatedQueryRequest, kb: str, queue: asyncio.Queue
+) -> Optional[str]:
+    """Answer on one KB through query_deltas, pushing its events to `queue`."""
+    started = time.perf_counter()
+    kb_request = ChatCompletionRequest(
+        model=request.model,
+        query=request.query,
+        stream=request.stream,
+        query_options=QueryOptions(
+            query_type=request.query_type,
+            community_level=request.community_level,
+            selected_folder=kb,
+        ),
+    )
+    parts: List[str] = []
+    try:
+        async for delta in await query_deltas(kb_request):
+            parts.append(delta)
+            if request.stream:
+                await queue.put(_event("kb_delta", {"kb": kb, "content": delta}))
+    except Exception as e:
+        message = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Federated query failed on '{kb}': {message}")
+        await queue.put(_event("kb_error", {"kb": kb, "error": message}))
+        return None
+    answer = "".join(parts)
+    elapsed = round(time.perf_counter() - started, 3)
+    await queue.put(_event("kb_done", {"kb": kb, "answer": answer, "elapsed": elapsed}))
+    return answer
+
+
+async def _reduce(
+    request: FederatedQueryRequest, answers: Dict[str, str]
+) -> AsyncGenerator[str, None]:
+    """
+    Stream a merged answer from the chat model of `reduce_kb` (or the first KB),
+    through the same rate limit and LLM cache as in-process queries.
+    """
+    reduce_kb = request.reduce_kb or next(iter(answers))
+    llm = await asyncio.to_thread(
+        engine.build_chat_llm, os.path.join(get_kb_root(), reduce_kb)
+    )
+    sections = "\n\n".join(
+        f"## Knowledge base: {kb}\n{answer}" for kb, answer in answers.items()
+    )
+    messages = [
+        {"role": "system", "content": REDUCE_PROMPT},
+        {"role": "user", "content": f"Question: {request.query}\n\n{sections}"},
+    ]
+    params = {"temperature": request.temperature, "max_tokens": request.max_tokens}
+    params = {name: value for name, value in params.items() if value is not None}
+    async for chunk in llm.astream_generate(messages, **params):
+        if chunk:
+            yield chunk
+
+
+async def run_federated_query(
+    request: FederatedQueryRequest, parallelism: int
+) -> AsyncGenerator[str, None]:
+    """
+    Ask one question on several KBs at once and stream tagged SSE events:
+    `kb_delta` / `kb_done` / `kb_error` per KB as they arrive, then `reduce_delta`
+    and `reduce_done` for the merged answer when requested, and a final `done`.
+    Each KB goes through run_graphrag_query, so caching, coalescing and admission
+    apply per KB; total latency follows the slowest KB.
+    """
+    started = time.perf_counter()
+    queue: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(parallelism)
+    answers: Dict[str, Optional[str]] = {}
+
+    async def run(kb: str) -> None:
+        async with semaphore:
+            answers[kb] = await _query_kb(request, kb, queue)
+        await queue.put(None)
+
+    tasks = [asyncio.create_task(run(kb)) for kb in request.selected_folders]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await queue.get()
+            if event is None:
+                remaining -= 1
+            else:
+                yield event
+    finally:
+        # 客户端断开时取消尚未完成的知识库查询
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    # 按请求中的顺序合并，结果与完成先后无关
+    succeeded = {
+        kb: answers[kb]
+        for kb in request.selected_folders
+        if answers.get(kb) is not None
+    }
+    if request.reduce and succeeded:
+        parts: List[str] = []
+        try:
+            async for delta in _reduce(request, succeeded):
+                parts.append(delta)
+                yield _event("reduce_delta", {"content": delta})
+            yield _event("reduce_done", {"answer": "".join(parts)})
+        except Exception as e:
+            logger.error(f"Federated reduce failed: {str(e)}")
+            error("federated_reduce_failed")
+            yield _event("reduce_error", {"error": str(e)})
+    yield _event(
+        "done",
+        {
+            "kbs": len(request.selected_folders),
+            "succeeded": len(succeeded),
+            "failed": len(request.selected_folders) - len(succeeded),
+            "seconds": round(time.perf_counter() - started, 3),
+        },
+    )
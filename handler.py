@@ -1,19 +1,51 @@
+import asyncio
+import json
 import os
-from typing import Dict
-import uuid
-from fastapi import APIRouter, BackgroundTasks, HTTPException, UploadFile
+from typing import Any, Dict, List, Optional
+from fastapi import (
+    APIRouter,
+    Header,
+    HTTPException,
+    Request,
+    UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from logger import get_logger
 
 # from fastapi.responses import JSONResponse
-from models import ChatCompletionRequest, IndexingRequest, InitRequest
-from query import run_graphrag_query
-from index import run_indexing, indexing_logs, run_indexing_with_status
+from models import (
+    ChatCompletionRequest,
+    FederatedQueryRequest,
+    IndexingRequest,
+    InitRequest,
+    RateLimitRequest,
+)
+from query import coalescing_stats, run_graphrag_query
+from jobs import job_event_stream, job_runner, job_store
+from incremental import plan_indexing
+from index import build_query_artifacts
+from profiling import load_report
 from init import run_init
-from upload import upload_file
+from upload import upload_archive, upload_file, upload_files
 from utils import get_kb_root
+from kb_cache import kb_cache
+from result_cache import result_cache
+from admission import query_admission
+from worker_pool import worker_pool
+from lifecycle import lifecycle_stats
+from metrics import registry
+from model_catalog import model_catalog
+from kb_repository import MAX_PAGE_SIZE, kb_repository
+from batch import batch_store, new_batch_id, parse_batch, run_batch
+from utils import get_batch_settings, get_federation_settings
+from federation import run_federated_query
+from rate_limiter import rate_limiter
+from llm_cache import llm_cache
+from cluster import DRAINING_HEADER, drain
 
 # from settings import load_settings
-# from utils import fetch_available_models
 
 router = APIRouter()
 logger = get_logger(__name__)
@@ -43,36 +75,289 @@ async def chat_completions(request: ChatCompletionRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/v1/batch/queries")
+async def batch_queries(
+    request: Request,
+    batch_id: Optional[str] = None,
+    selected_folder: Optional[str] = None,
+    query_type: str = "local",
+    community_level: Optional[int] = 2,
+    model: Optional[str] = None,
+    parallelism: Optional[int] = None,
+    format: Optional[str] = None,
+):
+    """
+    Answer a JSONL batch of questions. Results are streamed as JSONL (default) or
+    SSE (`format=sse` or `Accept: text/event-stream`) in completion order, each
+    tagged with its input `index`, followed by a summary. Resubmitting with the
+    returned `batch_id` skips questions that were already answered. Pass the
+    `model` your chat completions use so answers share their result cache.
+    """
+    settings = get_batch_settings()
+    body = (await request.body()).decode("utf-8")
+    defaults = {
+        "selected_folder": selected_folder,
+        "query_type": query_type,
+        "community_level": community_level,
+        "model": model,
+    }
+    items = parse_batch(body.splitlines(), defaults, settings["max_items"])
+    batch_id = batch_id or new_batch_id()
+    # 并行度不超过单个知识库的准入上限，避免同组问题互相挤占排队
+    limit = min(settings["max_parallel"], query_admission.max_per_kb)
+    parallelism = max(1, min(parallelism or limit, limit))
+    sse = format == "sse" or (
+        format is None and "text/event-stream" in request.headers.get("accept", "")
+    )
+    logger.info(
+        f"Starting batch {batch_id} with {len(items)} queries, parallelism {parallelism}"
+    )
+
+    async def generate():
+        results = run_batch(
+            items, batch_id, batch_store, parallelism, settings["max_retries"]
+        )
+        seq = 0
+        async for result in results:
+            if sse:
+                yield f"id: {seq}\nevent: {result['type']}\ndata: {json.dumps(result)}\n\n"
+            else:
+                yield json.dumps(result) + "\n"
+            seq += 1
+
+    return StreamingResponse(
+        generate(),
+        media_type=(
+            "text/event-stream; charset=utf-8" if sse else "application/x-ndjson"
+        ),
+        headers={"X-Batch-Id": batch_id},
+    )
+
+
+@router.post("/v1/federated/query")
+async def federated_query(request: FederatedQueryRequest):
+    """
+    Ask one question on several knowledge bases concurrently. Per-KB results are
+    streamed as tagged SSE events, optionally followed by a merged answer.
+    """
+    settings = get_federation_settings()
+    kbs = list(dict.fromkeys(request.selected_folders))
+    if not kbs:
+        raise HTTPException(status_code=400, detail="selected_folders is empty")
+    if len(kbs) > settings["max_kbs"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A federated query may target at most {settings['max_kbs']} knowledge bases",
+        )
+    if request.reduce_kb and request.reduce_kb not in kbs:
+        raise HTTPException(
+            status_code=400, detail="reduce_kb must be one of selected_folders"
+        )
+    request.selected_folders = kbs
+    parallelism = min(request.parallelism or len(kbs), settings["max_parallel"])
+    logger.info(
+        f"Starting federated query on {len(kbs)} knowledge bases, parallelism {parallelism}"
+    )
+    return StreamingResponse(
+        run_federated_query(request, max(1, parallelism)),
+        media_type="text/event-stream; charset=utf-8",
+    )
+
+
 @router.get("/v1/health")
 async def health_check():
+    # 排空期间报告不可用，路由器不再向本进程分配请求
+    if drain.draining:
+        return JSONResponse(
+            {"status": "draining"}, status_code=503, headers={DRAINING_HEADER: "1"}
+        )
     return {"status": "ok"}
 
 
-task_status: Dict[str, str] = {}
+@router.get("/metrics")
+async def metrics():
+    """
+    Prometheus text exposition of request latency, TTFT, spawn time, queue
+    depths, indexing jobs, upload throughput, cache hit ratios and errors
+    """
+    # 采集器会读取 SQLite 中的任务计数，放到线程中执行
+    body = await asyncio.to_thread(registry.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
 
 
-@router.post("/v1/index")
-async def start_indexing(request: IndexingRequest, background_tasks: BackgroundTasks):
-    task_id = str(uuid.uuid4())  # 生成唯一任务ID
-    task_status[task_id] = "running"  # 初始化任务状态为运行中
-    background_tasks.add_task(run_indexing_with_status, request, task_id, task_status)
+@router.get("/v1/provider_models")
+async def list_provider_models(
+    api_base: str,
+    api_type: str = "openai",
+    refresh: bool = False,
+    authorization: Optional[str] = Header(None),
+):
+    """
+    列出模型服务提供的模型，结果按 (api_base, api_type) 缓存并在后台刷新
+    """
+    api_key = None
+    if authorization and authorization.lower().startswith("bearer "):
+        api_key = authorization[len("bearer ") :]
+    return await model_catalog.get(api_base, api_type, api_key, refresh)
+
+
+@router.get("/v1/provider_models/stats")
+async def get_provider_models_stats():
+    return model_catalog.stats()
+
+
+@router.get("/v1/rate_limits")
+async def get_rate_limits():
+    """
+    各 (api_base, model) 的限流预算：上限、AIMD 系数、索引任务租用的份额和用量
+    """
+    return await asyncio.to_thread(rate_limiter.usage)
+
+
+@router.put("/v1/rate_limits")
+async def set_rate_limits(request: RateLimitRequest):
+    if request.rpm < 0 or request.tpm < 0:
+        raise HTTPException(status_code=400, detail="rpm and tpm must be >= 0")
+    await asyncio.to_thread(
+        rate_limiter.set_limits,
+        request.api_base,
+        request.model,
+        request.rpm,
+        request.tpm,
+    )
+    return {"status": "success"}
+
+
+@router.get("/v1/llm_cache/stats")
+async def get_llm_cache_stats():
+    """
+    全局 LLM 缓存：大小、条目数、淘汰次数、索引新增条目和查询命中率
+    """
+    return await asyncio.to_thread(llm_cache.stats)
+
+
+@router.get("/v1/kb_cache/stats")
+async def get_kb_cache_stats():
+    return kb_cache.stats()
+
+
+@router.get("/v1/result_cache/stats")
+async def get_result_cache_stats():
+    return result_cache.stats()
+
+
+@router.get("/v1/query_pool/stats")
+async def get_query_pool_stats():
     return {
-        "status": "started",
+        "admission": query_admission.stats(),
+        "workers": worker_pool.stats(),
+        "coalescing": coalescing_stats(),
+        "executions": lifecycle_stats(),
+    }
+
+
+@router.post("/v1/index")
+async def start_indexing(request: IndexingRequest):
+    task_id = await asyncio.to_thread(
+        job_store.enqueue, request.root, request.model_dump(), request.priority
+    )
+    job_runner.wake()
+    response = {
+        "status": "queued",
         "task_id": task_id,
-        "message": "Indexing process has been started in the background",
+        "message": "Indexing job has been queued",
     }
+    target_path = os.path.join(get_kb_root(), request.root)
+    if await kb_repository.run(os.path.isdir, os.path.join(target_path, "input")):
+        # 预览当前 input 目录相对上次索引的变化，实际计划在任务执行时重新计算
+        plan, _ = await asyncio.to_thread(plan_indexing, target_path, request.mode)
+        response["plan"] = plan.to_dict()
+    return response
 
 
 @router.get("/v1/index_status/{task_id}")
 async def get_indexing_status(task_id: str):
-    status = task_status.get(task_id, "unknown")
+    job = await asyncio.to_thread(job_store.get, task_id)
+    if job is None:
+        return {"task_id": task_id, "status": "unknown", "error": None}
     return {
         "task_id": task_id,
-        "status": "failed" if status.startswith("failed:") else status,
-        "error": status[7:] if status.startswith("failed:") else None,
+        "kb": job["kb"],
+        "status": job["status"],
+        "error": job["error"],
+        "priority": job["priority"],
+        "progress": job["progress"],
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"],
+        "worker": job["worker"],
+        "result": job["result"],
     }
 
 
+@router.get("/v1/index_report/{kb_name}")
+async def get_indexing_report(kb_name: str, task_id: Optional[str] = None):
+    """
+    返回知识库最近一次（或指定任务）索引的性能报告
+    """
+    target_path = os.path.join(get_kb_root(), kb_name)
+    report = await asyncio.to_thread(load_report, target_path, task_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="No performance report found")
+    return report
+
+
+@router.get("/v1/index_events/{task_id}")
+async def stream_indexing_events(
+    task_id: str, after: int = 0, last_event_id: Optional[str] = Header(None)
+):
+    """
+    以 SSE 推送索引任务的结构化进度事件，重连时根据 Last-Event-ID 回放之后的事件
+    """
+    job = await asyncio.to_thread(job_store.get, task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task: {task_id}")
+    if last_event_id and last_event_id.isdigit():
+        after = max(after, int(last_event_id))
+
+    async def generate():
+        async for event in job_event_stream(job_store, task_id, after):
+            event_id = f"id: {event['seq']}\n" if "seq" in event else ""
+            yield f"{event_id}event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream; charset=utf-8")
+
+
+@router.websocket("/v1/ws/index_events/{task_id}")
+async def websocket_indexing_events(websocket: WebSocket, task_id: str, after: int = 0):
+    await websocket.accept()
+    try:
+        async for event in job_event_stream(job_store, task_id, after):
+            await websocket.send_json(event)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
+@router.post("/v1/index/{task_id}/cancel")
+async def cancel_indexing(task_id: str):
+    status = await asyncio.to_thread(job_store.request_cancel, task_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task: {task_id}")
+    return {"task_id": task_id, "status": status}
+
+
+@router.get("/v1/index_jobs")
+async def list_indexing_jobs(
+    kb: Optional[str] = None, status: Optional[str] = None, limit: int = 100
+):
+    jobs = await asyncio.to_thread(job_store.list, kb, status, limit)
+    # 任务列表中不返回请求里的 api_key
+    for job in jobs:
+        job["request"].pop("api_key", None)
+    return jobs
+
+
 @router.post("/v1/init")
 async def init(request: InitRequest):
     logger.info(f"Received init request: {request}")
@@ -82,32 +367,101 @@ async def init(request: InitRequest):
 
 
 @router.post("/v1/upload/")
-async def handle_upload(file: UploadFile, root_path: str) -> Dict[str, str]:
+async def handle_upload(file: UploadFile, root_path: str) -> Dict[str, Any]:
     """
     处理文件上传的API接口
     """
     if not file:
         raise HTTPException(status_code=400, detail="没有文件被上传")
-    success = await upload_file(file, root_path)
-    if success:
-        return {"message": f"文件 {file.filename} 上传成功"}
+    stats = await upload_file(file, root_path)
+    kb_repository.invalidate(root_path)
+    if stats:
+        return {"message": f"文件 {file.filename} 上传成功", **stats}
     else:
         raise HTTPException(
             status_code=400, detail="文件上传失败，请确保上传的是txt格式文件"
         )
 
 
+@router.post("/v1/upload_files/")
+async def handle_upload_files(files: List[UploadFile], root_path: str):
+    """
+    一次上传多个txt文件
+    """
+    if not files:
+        raise HTTPException(status_code=400, detail="没有文件被上传")
+    results = await upload_files(files, root_path)
+    kb_repository.invalidate(root_path)
+    return {"files": results}
+
+
+@router.post("/v1/upload_archive/")
+async def handle_upload_archive(file: UploadFile, root_path: str):
+    """
+    上传 zip/tar.gz 归档，解压其中的txt文件到 input 目录
+    """
+    if not file:
+        raise HTTPException(status_code=400, detail="没有文件被上传")
+    result = await upload_archive(file, root_path)
+    kb_repository.invalidate(root_path)
+    return result
+
+
 @router.get("/v1/list_knowledge_bases")
 async def list_knowledge_bases():
-    # check all files in kb_root and return a list of available knowledge bases
-    kb_root = get_kb_root()
-    files = os.listdir(kb_root)
-    return [f for f in files if os.path.isdir(os.path.join(kb_root, f))]
+    # 从内存中的知识库目录返回，不再每次请求都列出 KB_ROOT
+    return await kb_repository.names()
+
+
+@router.get("/v1/knowledge_bases")
+async def get_knowledge_bases():
+    """
+    知识库目录：文件数、大小、是否已索引及最近索引时间
+    """
+    return await kb_repository.catalog()
+
+
+@router.get("/v1/knowledge_bases/{kb_name}")
+async def get_knowledge_base(kb_name: str):
+    info = await kb_repository.get(kb_name)
+    if info is None:
+        raise HTTPException(
+            status_code=404, detail=f"Knowledge base '{kb_name}' not found"
+        )
+    return info
+
+
+@router.get("/v1/knowledge_bases/{kb_name}/files")
+async def list_knowledge_base_files(kb_name: str, offset: int = 0, limit: int = 100):
+    """
+    分页列出知识库 input 目录中的文件（按文件名排序）
+    """
+    if offset < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"offset must be >= 0 and limit between 1 and {MAX_PAGE_SIZE}",
+        )
+    return await kb_repository.list_files(kb_name, offset, limit)
+
+
+@router.post("/v1/knowledge_bases/{kb_name}/query_artifacts")
+async def rebuild_query_artifacts(kb_name: str):
+    """
+    为已索引的知识库（重新）生成查询快照和实体向量的 ANN 索引
+    """
+    info = await kb_repository.get(kb_name)
+    if info is None or not info["indexed"]:
+        raise HTTPException(
+            status_code=404, detail=f"Knowledge base '{kb_name}' is not indexed"
+        )
+    result = await build_query_artifacts(os.path.join(get_kb_root(), kb_name))
+    # 已加载的上下文仍在使用旧的表和向量存储
+    kb_cache.invalidate(kb_name)
+    return result
 
 
 @router.get("/v1/show_uploaded_files/{kb_name}")
 async def show_uploaded_files(kb_name: str):
-    kb_root = get_kb_root()
-    kb_path = os.path.join(kb_root, kb_name, "input")
-    files = os.listdir(kb_path)
-    return [f for f in files if os.path.isfile(os.path.join(kb_path, f))]
+    # 跳过上传过程中的临时文件
+    listing = await kb_repository.list_files(kb_name)
+    return [f["name"] for f in listing["files"]]
@@ -0,0 +1,45 @@
+from typing import Optional
+import httpx
+from utils import get_http_client_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class SharedHTTPClient:
+    """
+    One pooled, keep-alive httpx.AsyncClient for all outbound provider calls.
+    Opened and closed by the application lifespan.
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def start(self) -> None:
+        settings = get_http_client_settings()
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                settings["timeout"], connect=settings["connect_timeout"]
+            ),
+            limits=httpx.Limits(
+                max_connections=int(settings["max_connections"]),
+                max_keepalive_connections=int(settings["max_keepalive"]),
+                keepalive_expiry=settings["keepalive_expiry"],
+            ),
+            follow_redirects=True,
+        )
+        logger.info("Shared HTTP client started")
+
+    async def stop(self) -> None:
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("Shared HTTP client is not started")
+        return self._client
+
+
+http_client = SharedHTTPClient()
@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+MANIFEST_FILE = "index_manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+FULL, INCREMENTAL, SKIP = "full", "incremental", "skip"
+# graphrag update 的 update_index_storage 目录（相对知识库根目录）
+UPDATE_OUTPUT = "update_output"
+# 这些配置改变后已有输出（抽取结果、分块、嵌入空间）与新文档不再一致，需要全量重建
+INDEX_SETTINGS_KEYS = (
+    "llm.model",
+    "embeddings.llm.model",
+    "chunks.size",
+    "chunks.overlap",
+    "chunks.group_by_columns",
+    "chunks.encoding_model",
+)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def manifest_path(target_path: str) -> str:
+    return os.path.join(target_path, MANIFEST_FILE)
+
+
+def _read_manifest(target_path: str) -> Optional[Dict[str, Any]]:
+    path = manifest_path(target_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if not isinstance(manifest.get("files"), dict):
+            raise ValueError("no files entry")
+        return manifest
+    except (ValueError, AttributeError) as e:
+        logger.warning(f"Ignoring unreadable manifest {path}: {str(e)}")
+        return None
+
+
+def load_manifest(target_path: str) -> Optional[Dict[str, Dict]]:
+    manifest = _read_manifest(target_path)
+    return manifest["files"] if manifest is not None else None
+
+
+def save_manifest(
+    target_path: str,
+    files: Dict[str, Dict],
+    settings: Optional[Dict[str, Any]] = None,
+) -> None:
+    path = manifest_path(target_path)
+    tmp_path = f"{path}.tmp"
+    manifest: Dict[str, Any] = {"files": files}
+    if settings is not None:
+        manifest["settings"] = settings
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def clear_update_output(target_path: str) -> None:
+    shutil.rmtree(os.path.join(target_path, UPDATE_OUTPUT), ignore_errors=True)
+
+
+def promote_update_output(target_path: str) -> bool:
+    """
+    Move the tables merged by `graphrag update` from
+    update_output/<timestamp>/output into output/, where queries read them.
+    Returns False if the update left no merged tables.
+    """
+    base = os.path.join(target_path, UPDATE_OUTPUT)
+    if not os.path.isdir(base):
+        return False
+    runs = sorted(
+        name
+        for name in os.listdir(base)
+        if os.path.isdir(os.path.join(base, name, "output"))
+    )
+    if not runs:
+        return False
+    merged = os.path.join(base, runs[-1], "output")
+    tables = [
+        name
+        for name in os.listdir(merged)
+        if os.path.isfile(os.path.join(merged, name))
+    ]
+    if not tables:
+        return False
+    output = os.path.join(target_path, "output")
+    os.makedirs(output, exist_ok=True)
+    for name in tables:
+        os.replace(os.path.join(merged, name), os.path.join(output, name))
+    logger.info(f"Promoted {len(tables)} merged tables from {merged} to {output}")
+    # delta 和 previous 是完整副本，合并完成后不再需要
+    clear_update_output(target_path)
+    return True
+
+
+def _read_settings(target_path: str) -> Dict[str, Any]:
+    from ruamel.yaml import YAML
+
+    path = os.path.join(target_path, "settings.yaml")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return YAML(typ="safe").load(f) or {}
+
+
+def llm_settings(target_path: str) -> Dict[str, Any]:
+    """The `llm` section of the KB's settings.yaml (type, api_version, deployment_name...)."""
+    llm = _read_settings(target_path).get("llm")
+    return llm if isinstance(llm, dict) else {}
+
+
+def index_settings(target_path: str) -> Dict[str, Any]:
+    """The values of INDEX_SETTINGS_KEYS in the KB's settings.yaml (None if unset)."""
+    config = _read_settings(target_path)
+    values: Dict[str, Any] = {}
+    for key in INDEX_SETTINGS_KEYS:
+        value = config
+        for part in key.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        values[key] = value
+    return values
+
+
+def fingerprint_inputs(
+    input_path: str, previous: Optional[Dict[str, Dict]] = None
+) -> Dict[str, Dict]:
+    """
+    Content hash of every file in input/. Files whose size and mtime match the
+    previous manifest reuse its hash instead of being re-read.
+    """
+    previous = previous or {}
+    files: Dict[str, Dict] = {}
+    for entry in os.scandir(input_path):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        known = previous.get(entry.name)
+        unchanged = (
+            known is not None
+            and known["size"] == stat.st_size
+            and known["mtime_ns"] == stat.st_mtime_ns
+        )
+        if unchanged:
+            sha256 = known["sha256"]
+        else:
+            sha256 = file_sha256(entry.path)
+        files[entry.name] = {
+            "sha256": sha256,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+    return files
+
+
+def indexed_settings(
+    target_path: str, settings_before: Optional[Dict[str, Any]] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    The index settings the KB's current output was built with, or None if it has
+    never been indexed. Manifests that predate the settings record fall back to
+    `settings_before`.
+    """
+    manifest = _read_manifest(target_path)
+    if manifest is None:
+        return None
+    return manifest.get("settings", settings_before)
+
+
+@dataclass
+class IndexPlan:
+    mode: str
+    reason: str
+    new: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    settings_changed: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+def plan_indexing(
+    target_path: str,
+    requested_mode: str = "auto",
+    settings: Optional[Dict[str, Any]] = None,
+    settings_before: Optional[Dict[str, Any]] = None,
+) -> Tuple[IndexPlan, Dict]:
+    """
+    Compare input/ against the KB's manifest and decide how to index it.
+    graphrag's incremental update only appends documents it has not seen, so any
+    changed or removed document still requires a full rebuild, as does a change
+    of `settings` (see index_settings) since the last index. Manifests that
+    predate the settings record are compared against `settings_before`, the
+    KB's settings before this request updated them.
+    Returns the plan and the current fingerprints, to be saved on success.
+    """
+    input_path = os.path.join(target_path, "input")
+    manifest = _read_manifest(target_path)
+    previous = manifest["files"] if manifest is not None else None
+    current = fingerprint_inputs(input_path, previous)
+    indexed = os.path.isdir(os.path.join(target_path, "output")) and bool(
+        os.listdir(os.path.join(target_path, "output"))
+    )
+    if previous is None or not indexed:
+        return IndexPlan(FULL, "no previous index", new=sorted(current)), current
+    new = sorted(name for name in current if name not in previous)
+    changed = sorted(
+        name
+        for name in current
+        if name in previous and current[name]["sha256"] != previous[name]["sha256"]
+    )
+    removed = sorted(name for name in previous if name not in current)
+    skipped = sorted(
+        name for name in current if name not in new and name not in changed
+    )
+    indexed_settings = manifest.get("settings", settings_before)
+    settings_changed = []
+    if settings is not None and indexed_settings is not None:
+        settings_changed = sorted(
+            key for key in settings if settings[key] != indexed_settings.get(key)
+        )
+    plan = IndexPlan(
+        FULL,
+        "",
+        new=new,
+        changed=changed,
+        removed=removed,
+        skipped=skipped,
+        settings_changed=settings_changed,
+    )
+    if requested_mode == FULL:
+        plan.reason = "full rebuild requested"
+    elif settings_changed:
+        plan.reason = f"index settings changed: {', '.join(settings_changed)}"
+    elif changed or removed:
+        plan.reason = "documents were changed or removed"
+    elif not new:
+        plan.mode, plan.reason = SKIP, "no new or changed documents"
+    else:
+        plan.mode, plan.reason = INCREMENTAL, "only new documents"
+    return plan, current
@@ -1,49 +1,262 @@
 # Global variable to store the latest indexing logs
 import asyncio
-from collections import deque
 import os
-from typing import Any, Dict
+import re
+import signal
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from fastapi import HTTPException
-from settings import update_env_file, update_yaml_config
-from utils import get_kb_root
+from kb_repository import kb_repository
+from utils import get_ann_settings, get_kb_root, get_snapshot_settings
+from kb_cache import kb_cache
+from result_cache import result_cache
 from logger import get_logger
 from models import IndexingRequest
+from events import JobEventLog
+from metrics import SUBPROCESS_SPAWN, error
+from profiling import ProcessSampler, build_report, log_offset, save_report
+from incremental import (
+    FULL,
+    INCREMENTAL,
+    SKIP,
+    UPDATE_OUTPUT,
+    clear_update_output,
+    index_settings,
+    indexed_settings,
+    llm_settings,
+    plan_indexing,
+    promote_update_output,
+    save_manifest,
+)
+from ann_index import build_ann_index
+from rate_limiter import UNLIMITED, rate_limiter
+from llm_cache import llm_cache
+from tuning import resolve_profile
+from snapshot import write_snapshot
 
-indexing_logs = deque(maxlen=100)
+# graphrag 日志中提供方返回的限流错误（openai 客户端的异常和 HTTP 状态行），
+# 不匹配进度计数或配置回显中的 "429"、"rate limit"
+_RATE_LIMITED = re.compile(
+    r"\bRateLimitError\b|Error code: 429\b|\b429 Too Many Requests\b"
+)
 logger = get_logger(__name__)
-indexing_status = {"status": "idle", "logs": []}
 
 
-async def run_indexing(request: IndexingRequest, kb_root: str = get_kb_root()):
-    cmd = ["graphrag", "index"]
-    target_path = os.path.join(kb_root, request.root)
-    input_path = os.path.join(target_path, "input")
-    if not os.path.exists(input_path):
-        raise HTTPException(status_code=400, detail="Input path does not exist")
-    # if there is no file in the input path, raise an error
-    if not os.listdir(input_path):
-        raise HTTPException(status_code=400, detail="Input path is empty")
+def build_index_cmd(request: IndexingRequest, target_path: str, mode: str):
+    # graphrag update 只处理新增文档，合并后的表写入 update_index_storage
+    cmd = ["graphrag", "update" if mode == INCREMENTAL else "index"]
     cmd.extend(["--root", target_path])
     if request.verbose:
         cmd.append("--verbose")
     if request.nocache:
         cmd.append("--nocache")
-    if request.resume:
+    if request.resume and mode == FULL:
         cmd.extend(["--resume", request.resume])
     cmd.extend(["--reporter", request.reporter])
     cmd.extend(["--emit", ",".join(request.emit)])
+    return cmd
+
+
+async def build_query_artifacts(target_path: str) -> Dict[str, Any]:
+    """
+    Post-index steps that speed up queries: the memory-mapped table snapshot and
+    the entity ANN index. A failure only costs query speed, never the index.
+    """
+    steps = []
+    if get_snapshot_settings()["enabled"]:
+        steps.append(("snapshot", write_snapshot))
+    if get_ann_settings()["enabled"]:
+        steps.append(("ann_index", build_ann_index))
+    results: Dict[str, Any] = {}
+    for name, step in steps:
+        try:
+            results[name] = await asyncio.to_thread(step, target_path)
+        except Exception as e:
+            logger.error(f"Failed to build {name} for {target_path}: {str(e)}")
+            error(f"{name}_build_failed")
+            results[name] = {"error": str(e)}
+    return results
+
+
+async def run_indexing(
+    request: IndexingRequest,
+    kb_root: str = get_kb_root(),
+    events: Optional[JobEventLog] = None,
+    on_spawn: Optional[Callable[[int], Awaitable[None]]] = None,
+):
+    target_path = os.path.join(kb_root, request.root)
+    input_path = os.path.join(target_path, "input")
+    if not await kb_repository.run(os.path.exists, input_path):
+        raise HTTPException(status_code=400, detail="Input path does not exist")
+    # if there is no file in the input path, raise an error
+    if not await kb_repository.run(os.listdir, input_path):
+        raise HTTPException(status_code=400, detail="Input path is empty")
+    # 索引子进程内的 LLM 调用无法拦截，为它租用一份共享预算并写入 settings.yaml
+    async with rate_limiter.background_lease(
+        request.llm_api_base, request.llm_model, f"index:{request.root}"
+    ) as lease:
+        return await _index(request, target_path, events, lease, on_spawn)
+
+
+async def _sweep_llm_cache(request: IndexingRequest) -> Optional[Dict[str, Any]]:
+    if not llm_cache.enabled or request.nocache:
+        return None
+    try:
+        return await asyncio.to_thread(llm_cache.sweep)
+    except Exception as e:
+        logger.error(f"Failed to sweep LLM cache: {str(e)}")
+        return None
+
+
+async def _record_llm_cache(
+    request: IndexingRequest, before: Optional[Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    """Entries this run added to the shared LLM cache, i.e. its cache misses."""
+    after = await _sweep_llm_cache(request)
+    if before is None or after is None:
+        return None
+    added = max(0, after["entries"] - before["entries"])
+    await asyncio.to_thread(llm_cache.record_index, added)
+    return {"entries_added": added, **after}
+
+
+def _lease_limits(lease: Dict[str, Any]) -> List[Tuple[str, int]]:
+    """
+    settings.yaml throttling for the leased budget. Unlimited budgets write
+    nothing, so limits configured in the KB stay in effect.
+    """
+    updates = []
+    for key, name in (("rpm", "requests_per_minute"), ("tpm", "tokens_per_minute")):
+        if lease[key] != UNLIMITED:
+            # 份额很小时也至少保留 1（graphrag 中 0 表示不限速）
+            updates.append((f"llm.{name}", max(1, int(lease[key]))))
+    return updates
+
+
+async def _run_graphrag(
+    request: IndexingRequest,
+    cmd: List[str],
+    env: Dict[str, Any],
+    events: Optional[JobEventLog],
+    on_spawn: Optional[Callable[[int], Awaitable[None]]] = None,
+) -> Tuple[int, ProcessSampler]:
+    """
+    Run a graphrag command in its own process group, feeding its output to
+    `events`. `on_spawn` receives the group id once the process has started.
+    """
+    logger.info(f"Executing indexing command: {' '.join(cmd)}")
+    with SUBPROCESS_SPAWN.time("index"):
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+    sampler = ProcessSampler(
+        process.pid, lambda: events.workflow if events is not None else None
+    )
+    sampler.start()
+    if on_spawn is not None:
+        try:
+            await on_spawn(process.pid)
+        except Exception as e:
+            logger.error(f"Failed to record graphrag process group: {str(e)}")
+
+    async def read_stream(stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            line = line.decode().strip()
+            if _RATE_LIMITED.search(line):
+                await rate_limiter.record(request.llm_api_base, request.llm_model, True)
+            if events is not None:
+                events.feed(line)
+            logger.info(line)
+
+    try:
+        await asyncio.gather(read_stream(process.stdout), read_stream(process.stderr))
+        await process.wait()
+    except asyncio.CancelledError:
+        # 任务被取消，结束整个 graphrag 进程组
+        logger.info(f"Indexing of '{request.root}' cancelled")
+        if process.returncode is None:
+            os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+        raise
+    finally:
+        await sampler.stop()
+    return process.returncode, sampler
+
+
+async def _index(
+    request: IndexingRequest,
+    target_path: str,
+    events: Optional[JobEventLog],
+    lease: Dict[str, Any],
+    on_spawn: Optional[Callable[[int], Awaitable[None]]] = None,
+):
     # Set environment variables for LLM and embedding models
-    env_path = os.path.join(target_path, ".env")
-    settings_path = os.path.join(target_path, "settings.yaml")
     updates = [
         ("llm.model", request.llm_model),
         ("llm.api_base", request.llm_api_base),
         ("embeddings.llm.model", request.embed_model),
         ("embeddings.llm.api_base", request.embed_api_base),
+        # graphrag update 的合并结果写在这里，成功后由 promote_update_output 移回 output/
+        ("update_index_storage.type", "file"),
+        ("update_index_storage.base_dir", UPDATE_OUTPUT),
+        *_lease_limits(lease),
+        *llm_cache.settings_updates(),
     ]
-    update_env_file("GRAPHRAG_API_KEY", request.api_key, env_path)
-    if not update_yaml_config(updates, settings_path):
+    settings_before = await asyncio.to_thread(index_settings, target_path)
+    indexed = await asyncio.to_thread(indexed_settings, target_path, settings_before)
+    # 先不探测延迟，计划为跳过时不需要花一次 LLM 调用
+    profile_updates, profile = await resolve_profile(
+        request, lease, probe=False, indexed=indexed
+    )
+    updates.extend(profile_updates)
+    if not await kb_repository.apply_index_settings(
+        target_path, request.api_key, updates
+    ):
         raise HTTPException(status_code=500, detail="Failed to update settings.yaml")
+    # 对比 input 目录与上次索引的清单，决定全量、增量或跳过
+    # 断点续跑只能基于全量索引
+    requested_mode = FULL if request.resume else request.mode
+    settings = await asyncio.to_thread(index_settings, target_path)
+    plan, fingerprints = await asyncio.to_thread(
+        plan_indexing, target_path, requested_mode, settings, settings_before
+    )
+    logger.info(
+        f"Indexing plan for '{request.root}': {plan.mode} ({plan.reason}), "
+        f"{len(plan.new)} new, {len(plan.changed)} changed, "
+        f"{len(plan.removed)} removed, {len(plan.skipped)} unchanged"
+    )
+    if profile is not None:
+        profile["applied"] = plan.mode != SKIP
+    if plan.mode == SKIP:
+        return {
+            "status": "success",
+            "message": "Index is up to date, no new or changed documents",
+            "documents": plan.to_dict(),
+            "performance": profile,
+        }
+    inputs = (profile or {}).get("inputs", {})
+    if inputs.get("latency_source") == "default":
+        # 没有观测到的延迟时才探测；并发度不影响计划，重新写入即可
+        llm_config = await asyncio.to_thread(llm_settings, target_path)
+        profile_updates, profile = await resolve_profile(
+            request, lease, probe=True, llm_config=llm_config, indexed=indexed
+        )
+        profile["applied"] = True
+        if not await kb_repository.apply_index_settings(
+            target_path, request.api_key, updates + profile_updates
+        ):
+            raise HTTPException(
+                status_code=500, detail="Failed to update settings.yaml"
+            )
+    cmd = build_index_cmd(request, target_path, plan.mode)
+    cache_before = await _sweep_llm_cache(request)
     env: Dict[str, Any] = os.environ.copy()
     # update .env file with the new api key
     # env["GRAPHRAG_API_KEY"] = request.api_key
@@ -62,49 +275,73 @@ async def run_indexing(request: IndexingRequest, kb_root: str = get_kb_root()):
     # # Add custom CLI arguments
     # if request.custom_args:
     #     cmd.extend(request.custom_args.split())
-    logger.info(f"Executing indexing command: {' '.join(cmd)}")
     logger.info(f"Environment variables: {env}")
+    job_id = events.job_id if events is not None else f"run-{int(time.time())}"
+    offset = log_offset(target_path)
+    started = time.time()
     try:
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            env=env,
+        if plan.mode == INCREMENTAL:
+            # 清掉之前的更新目录，合并结果只可能来自本次运行
+            await asyncio.to_thread(clear_update_output, target_path)
+        returncode, sampler = await _run_graphrag(request, cmd, env, events, on_spawn)
+        if returncode == 0 and plan.mode == INCREMENTAL:
+            if not await asyncio.to_thread(promote_update_output, target_path):
+                # 合并后的表没有写回 output/，查询看不到新文档，改为全量重建
+                logger.warning(
+                    f"graphrag update left no merged output for '{request.root}', "
+                    "rebuilding in full"
+                )
+                plan.mode = FULL
+                plan.reason += "; incremental update produced no merged output"
+                cmd = build_index_cmd(request, target_path, FULL)
+                returncode, sampler = await _run_graphrag(
+                    request, cmd, env, events, on_spawn
+                )
+        report = await asyncio.to_thread(
+            build_report,
+            job_id,
+            target_path,
+            started,
+            time.time(),
+            returncode,
+            sampler,
+            events.step_timings if events is not None else {},
+            offset,
+            {"mode": plan.mode, "documents": len(fingerprints)},
         )
-
-        async def read_stream(stream):
-            while True:
-                line = await stream.readline()
-                if not line:
-                    break
-                line = line.decode().strip()
-                indexing_logs.append(line)
-                logger.info(line)
-
-        await asyncio.gather(read_stream(process.stdout), read_stream(process.stderr))
-        await process.wait()
-        if process.returncode == 0:
+        report_path = await asyncio.to_thread(save_report, target_path, report)
+        cache_usage = await _record_llm_cache(request, cache_before)
+        artifacts = None
+        if returncode == 0:
+            artifacts = await build_query_artifacts(target_path)
+        # 输出产物已被改写，丢弃已加载的知识库
+        kb_cache.invalidate(request.root)
+        result_cache.invalidate_kb(request.root)
+        kb_repository.invalidate(request.root)
+        if returncode == 0:
+            await asyncio.to_thread(save_manifest, target_path, fingerprints, settings)
             logger.info("Indexing completed successfully")
-            return {"status": "success", "message": "Indexing completed successfully"}
+            return {
+                "status": "success",
+                "message": "Indexing completed successfully",
+                "documents": plan.to_dict(),
+                "report": report_path,
+                "query_artifacts": artifacts,
+                "rate_limit": {"rpm": lease["rpm"], "tpm": lease["tpm"]},
+                "llm_cache": cache_usage,
+                "performance": profile,
+            }
         else:
             logger.error("Indexing failed")
+            error("index_failed")
             return {
                 "status": "error",
                 "message": "Indexing failed. Check logs for details.",
+                "documents": plan.to_dict(),
+                "report": report_path,
+                "performance": profile,
             }
     except Exception as e:
         logger.error(f"Indexing failed: {str(e)}")
+        error("index_error")
         return {"status": "error", "message": f"Indexing failed: {str(e)}"}
-
-
-async def run_indexing_with_status(
-    request: IndexingRequest, task_id: str, task_status: Dict[str, str]
-):
-    try:
-        result = await run_indexing(request)
-        if result["status"] == "error":
-            task_status[task_id] = f"failed: {result['message']}"
-        else:
-            task_status[task_id] = "success"
-    except Exception as e:
-        task_status[task_id] = f"failed: {str(e)}"
@@ -2,6 +2,7 @@ import asyncio
 import os
 from fastapi import Depends, HTTPException
 from utils import get_kb_root
+from kb_repository import kb_repository
 from models import InitRequest
 from logger import get_logger
 
@@ -12,12 +13,13 @@ async def run_init(request: InitRequest, kb_root: str = get_kb_root()):
     try:
         target_path = os.path.join(kb_root, request.root)
         inputpath = os.path.join(target_path, "input")
-        os.makedirs(inputpath, mode=0o777, exist_ok=False)
+        await kb_repository.makedirs(inputpath, exist_ok=False)
         cmd = ["graphrag", "init"]
         cmd.extend(["--root", f"{target_path}"])
         logger.info(f"running command: {' '.join(cmd)}")
         process = await asyncio.create_subprocess_exec(*cmd)
         await process.wait()
+        kb_repository.invalidate(request.root)
         if process.returncode != 0:
             raise HTTPException(status_code=500, detail="Failed to initialize")
         return {"status": "success"}
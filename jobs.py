@@ -0,0 +1,564 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import sqlite3
+import time
+import uuid
+from typing import Any, AsyncGenerator, Dict, List, Optional
+from utils import get_state_dir, get_indexing_job_settings
+from events import STATUS, JobEventLog, job_events
+from metrics import INDEX_DURATION
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+QUEUED, RUNNING, SUCCESS, FAILED, CANCELLED = (
+    "queued",
+    "running",
+    "success",
+    "failed",
+    "cancelled",
+)
+FINISHED = (SUCCESS, FAILED, CANCELLED)
+
+
+class JobStore:
+    """
+    Indexing jobs persisted in a local SQLite database so that every uvicorn
+    worker sees the same queue and status, and jobs survive restarts.
+    All methods are blocking; call them through asyncio.to_thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kb TEXT NOT NULL, status TEXT NOT NULL, "
+                "priority INTEGER NOT NULL DEFAULT 0, request TEXT NOT NULL, "
+                "result TEXT, error TEXT, progress REAL, created REAL NOT NULL, "
+                "started REAL, finished REAL, worker TEXT, heartbeat REAL, "
+                "cancel_requested INTEGER NOT NULL DEFAULT 0, pgid INTEGER)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "pgid" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN pgid INTEGER")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, priority)"
+            )
+            # 进度事件也写入共享库，任意工作进程都能向客户端推送
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                "job_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, "
+                "PRIMARY KEY (job_id, seq))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _to_dict(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        job["request"] = json.loads(job["request"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def enqueue(self, kb: str, request: Dict[str, Any], priority: int = 0) -> str:
+        job_id = str(uuid.uuid4())
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kb, status, priority, request, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kb, QUEUED, priority, json.dumps(request), time.time()),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    def list(
+        self, kb: Optional[str] = None, status: Optional[str] = None, limit: int = 100
+    ) -> List[Dict[str, Any]]:
+        query, params = "SELECT * FROM jobs WHERE 1 = 1", []
+        if kb is not None:
+            query += " AND kb = ?"
+            params.append(kb)
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY created DESC LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def claim_next(self, worker: str, max_running: int) -> Optional[Dict[str, Any]]:
+        """
+        Atomically move the highest-priority queued job to running, honouring the
+        global concurrency limit and at most one running job per knowledge base.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            running = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (RUNNING,)
+            ).fetchone()[0]
+            if running >= max_running:
+                conn.execute("COMMIT")
+                return None
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND kb NOT IN "
+                "(SELECT kb FROM jobs WHERE status = ?) "
+                "ORDER BY priority DESC, created ASC LIMIT 1",
+                (QUEUED, RUNNING),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started = ?, heartbeat = ? "
+                "WHERE id = ?",
+                (RUNNING, worker, now, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        job = self._to_dict(row)
+        job.update(status=RUNNING, worker=worker, started=now, heartbeat=now)
+        return job
+
+    def heartbeat(self, job_id: str, progress: Optional[float] = None) -> bool:
+        """Refresh a running job's heartbeat; returns whether cancellation was requested."""
+        with self._connect() as conn:
+            if progress is None:
+                conn.execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET heartbeat = ?, progress = ? WHERE id = ?",
+                    (time.time(), progress, job_id),
+                )
+            row = conn.execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def set_pgid(self, job_id: str, worker: str, pgid: int) -> None:
+        """Record the process group of the graphrag run a worker started for a job."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET pgid = ? WHERE id = ? AND worker = ?",
+                (pgid, job_id, worker),
+            )
+
+    def finish(
+        self,
+        job_id: str,
+        worker: str,
+        status: str,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None,
+    ) -> bool:
+        """
+        Record a job's outcome. Only the worker still running it may do so: a job
+        requeued after a stale heartbeat, claimed elsewhere or already finished is
+        left alone and False is returned.
+        """
+        with self._connect() as conn:
+            return (
+                conn.execute(
+                    "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? "
+                    "WHERE id = ? AND worker = ? AND status = ?",
+                    (
+                        status,
+                        json.dumps(result) if result is not None else None,
+                        error,
+                        time.time(),
+                        job_id,
+                        worker,
+                        RUNNING,
+                    ),
+                ).rowcount
+                > 0
+            )
+
+    def requeue(self, job_id: str, worker: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, started = NULL, pgid = NULL "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (QUEUED, job_id, worker, RUNNING),
+            )
+
+    def request_cancel(self, job_id: str) -> Optional[str]:
+        """Cancel a queued job immediately or flag a running one; returns the resulting status."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED),
+            )
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                (job_id, RUNNING),
+            )
+            row = conn.execute(
+                "SELECT status FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def append_events(
+        self, job_id: str, events: List[Dict[str, Any]], keep: int
+    ) -> None:
+        """Store a job's new progress events, keeping its most recent `keep`."""
+        if not events:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO job_events VALUES (?, ?, ?)",
+                [(job_id, event["seq"], json.dumps(event)) for event in events],
+            )
+            conn.execute(
+                "DELETE FROM job_events WHERE job_id = ? AND seq <= ?",
+                (job_id, events[-1]["seq"] - keep),
+            )
+
+    def events(
+        self, job_id: str, after: int = 0, limit: int = 1000
+    ) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT event FROM job_events WHERE job_id = ? AND seq > ? "
+                "ORDER BY seq LIMIT ?",
+                (job_id, after, limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def last_event_seq(self, job_id: str) -> int:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MAX(seq) FROM job_events WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return row[0] or 0
+
+    def requeue_stale(self, stale_after: float, host: str) -> int:
+        """
+        Return running jobs whose worker stopped heartbeating (e.g. crashed) to the
+        queue. The graphrag process group of a crashed worker can outlive it, so a
+        job that recorded one is only requeued by a runner on the same `host`, once
+        the group is gone or has been killed; otherwise two indexers would write
+        the same output/.
+        """
+        cutoff = time.time() - stale_after
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, worker, pgid FROM jobs WHERE status = ? AND heartbeat < ?",
+                (RUNNING, cutoff),
+            ).fetchall()
+        requeued = 0
+        for row in rows:
+            if row["pgid"] is not None:
+                if (row["worker"] or "").rsplit(":", 1)[0] != host:
+                    continue
+                if not _stop_process_group(row["pgid"]):
+                    logger.warning(
+                        f"Indexing job {row['id']} still has a live graphrag "
+                        f"process group {row['pgid']}, not requeueing it"
+                    )
+                    continue
+            with self._connect() as conn:
+                # 条件中再次检查心跳，期间恢复心跳的任务不会被抢走
+                requeued += conn.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL, started = NULL, "
+                    "pgid = NULL WHERE id = ? AND status = ? AND heartbeat < ?",
+                    (QUEUED, row["id"], RUNNING, cutoff),
+                ).rowcount
+        return requeued
+
+
+def _group_runs_graphrag(pgid: int) -> Optional[bool]:
+    """Whether a live process in the group runs graphrag; None without /proc to check."""
+    if not os.path.isdir("/proc"):
+        return None
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            # 僵尸进程已经退出，只是还没有被回收
+            if int(fields[2]) != pgid or fields[0] == "Z":
+                continue
+            with open(f"/proc/{name}/cmdline", "rb") as f:
+                if b"graphrag" in f.read():
+                    return True
+        except (OSError, IndexError, ValueError):
+            continue
+    return False
+
+
+def _stop_process_group(pgid: int, timeout: float = 5.0) -> bool:
+    """
+    Kill a crashed worker's graphrag process group; returns whether it is gone.
+    A group id reused by an unrelated process is treated as gone and not killed.
+    """
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    if _group_runs_graphrag(pgid) is False:
+        return True
+    logger.warning(f"Killing orphaned graphrag process group {pgid}")
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return True
+        if _group_runs_graphrag(pgid) is False:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+class IndexingJobRunner:
+    """Claims jobs from the shared store and runs them in this process."""
+
+    def __init__(self, store: JobStore, settings: Dict[str, Any]):
+        self.store = store
+        self.max_running = settings["max_concurrent"]
+        self.poll_interval = settings["poll_interval"]
+        self.stale_after = settings["stale_after"]
+        self.host = socket.gethostname()
+        self.worker = f"{self.host}:{os.getpid()}"
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._loop_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._loop_task = asyncio.create_task(self._run())
+        logger.info(f"Indexing job runner {self.worker} started")
+
+    async def stop(self) -> None:
+        # 关闭时中断的任务重新排队，由其他工作进程或下次启动继续执行
+        self._stopping = True
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+        for job_id, task in list(self._tasks.items()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def wake(self) -> None:
+        """Check the queue now instead of waiting for the next poll."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                requeued = await asyncio.to_thread(
+                    self.store.requeue_stale, self.stale_after, self.host
+                )
+                if requeued:
+                    logger.warning(f"Requeued {requeued} stale indexing jobs")
+                while True:
+                    job = await asyncio.to_thread(
+                        self.store.claim_next, self.worker, self.max_running
+                    )
+                    if job is None:
+                        break
+                    self._tasks[job["id"]] = asyncio.create_task(self._execute(job))
+            except Exception as e:
+                logger.error(f"Indexing job runner error: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _execute(self, job: Dict[str, Any]) -> None:
+        from index import run_indexing
+        from models import IndexingRequest
+
+        job_id = job["id"]
+        logger.info(f"Running indexing job {job_id} for '{job['kb']}'")
+        events = job_events.create(job_id)
+        # 重新排队的任务接着已存储事件的序号编号，重连的订阅者不会漏掉事件
+        events.seq = await asyncio.to_thread(self.store.last_event_seq, job_id)
+        flushed = events.seq
+
+        async def on_spawn(pgid: int) -> None:
+            await asyncio.to_thread(self.store.set_pgid, job_id, self.worker, pgid)
+
+        task = asyncio.create_task(
+            run_indexing(
+                IndexingRequest(**job["request"]), events=events, on_spawn=on_spawn
+            )
+        )
+        status, message = FAILED, None
+        started = time.perf_counter()
+        try:
+            while not task.done():
+                done, _ = await asyncio.wait({task}, timeout=self.poll_interval)
+                if done:
+                    break
+                cancel = await asyncio.to_thread(
+                    self.store.heartbeat, job_id, events.percent
+                )
+                flushed = await self._flush_events(events, flushed)
+                if cancel:
+                    logger.info(f"Cancelling indexing job {job_id}")
+                    task.cancel()
+            result = await task
+            message = result["message"]
+            if result["status"] == "error":
+                finished = await asyncio.to_thread(
+                    self.store.finish,
+                    job_id,
+                    self.worker,
+                    FAILED,
+                    result,
+                    result["message"],
+                )
+            else:
+                status = SUCCESS
+                finished = await asyncio.to_thread(
+                    self.store.finish, job_id, self.worker, SUCCESS, result
+                )
+            if not finished:
+                logger.warning(
+                    f"Indexing job {job_id} was taken over by another worker, "
+                    "not recording its result"
+                )
+        except asyncio.CancelledError:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            if self._stopping:
+                status = QUEUED
+                await asyncio.to_thread(self.store.requeue, job_id, self.worker)
+            else:
+                status = CANCELLED
+                await asyncio.to_thread(
+                    self.store.finish, job_id, self.worker, CANCELLED
+                )
+        except Exception as e:
+            message = str(e)
+            await asyncio.to_thread(
+                self.store.finish, job_id, self.worker, FAILED, None, str(e)
+            )
+        finally:
+            events.finish(status, message)
+            try:
+                await self._flush_events(events, flushed)
+            except Exception as e:
+                logger.error(f"Failed to store events of job {job_id}: {str(e)}")
+            if status != QUEUED:
+                INDEX_DURATION.observe(time.perf_counter() - started, status)
+            self._tasks.pop(job_id, None)
+            self.wake()
+
+    async def _flush_events(self, events: JobEventLog, flushed: int) -> int:
+        """Copy events newer than `flushed` to the store; returns the new high mark."""
+        pending = events.since(flushed)
+        if pending:
+            await asyncio.to_thread(
+                self.store.append_events, events.job_id, pending, job_events.max_events
+            )
+            flushed = pending[-1]["seq"]
+        return flushed
+
+    @property
+    def running(self) -> List[str]:
+        return list(self._tasks)
+
+
+def _status_event(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "job_id": job["id"],
+        "type": STATUS,
+        "time": time.time(),
+        "status": job["status"],
+        "percent": 100.0 if job["status"] == SUCCESS else job["progress"],
+        "message": job["error"],
+    }
+
+
+async def job_event_stream(
+    store: JobStore, job_id: str, after: int = 0, poll_interval: float = 1.0
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Progress events of a job. Jobs run by this process stream their parsed events
+    live; jobs running in another worker are followed through the events it
+    copies to the store on every heartbeat.
+    """
+    events = job_events.get(job_id)
+    if events is not None:
+        async for event in events.subscribe(after):
+            yield event
+        return
+    last = None
+    while True:
+        job = await asyncio.to_thread(store.get, job_id)
+        if job is None:
+            return
+        stored = await asyncio.to_thread(store.events, job_id, after)
+        for event in stored:
+            after = event["seq"]
+            yield event
+            if event["type"] == STATUS and event["status"] in FINISHED:
+                return
+        snapshot = (job["status"], job["progress"])
+        if after == 0 and snapshot != last:
+            # 任务还没有事件（排队中）时推送状态快照
+            last = snapshot
+            yield _status_event(job)
+        if job["status"] in FINISHED:
+            # 最终事件在任务结束后才写入；从未运行或执行进程已退出时以任务状态结束
+            grace = max(job_runner.poll_interval * 2, poll_interval)
+            if job["started"] is None or time.time() - job["finished"] > grace:
+                if after:
+                    yield _status_event(job)
+                return
+        # 任务可能刚被本进程领取
+        events = job_events.get(job_id)
+        if events is not None:
+            async for event in events.subscribe(after):
+                yield event
+            return
+        await asyncio.sleep(poll_interval)
+
+
+job_store = JobStore(os.path.join(get_state_dir(), "jobs.db"))
+job_runner = IndexingJobRunner(job_store, get_indexing_job_settings())
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from utils import get_kb_root, get_kb_cache_max_bytes
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+Signature = Tuple[Tuple[str, int, int], ...]
+# 命中时最多每隔这么多秒重新检查一次产物签名，避免每次查询都在事件循环中扫描目录
+SIGNATURE_CHECK_INTERVAL = 2.0
+
+
+def output_signature(selected_folder: str, kb_root: str = get_kb_root()) -> Signature:
+    """(name, mtime_ns, size) of every artifact under <kb>/output, used to detect re-indexing."""
+    output_dir = os.path.join(kb_root, selected_folder, "output")
+    try:
+        entries = [
+            (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+            for entry in os.scandir(output_dir)
+            if entry.is_file()
+        ]
+    except FileNotFoundError:
+        return ()
+    return tuple(sorted(entries))
+
+
+def estimate_size(context: Any) -> int:
+    """Approximate resident size of a loaded KB context in bytes."""
+    size = 0
+    for table in getattr(context, "tables", {}).values():
+        if table is None:
+            continue
+        try:
+            size += int(table.memory_usage(index=True, deep=True).sum())
+        except AttributeError:
+            size += getattr(table, "nbytes", 0)
+    return size
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    size: int
+    signature: Signature
+    checked_at: float = field(default_factory=time.monotonic)
+
+
+class KBCache:
+    """LRU cache of loaded knowledge bases bounded by an approximate byte budget."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            due = (
+                entry is not None
+                and time.monotonic() - entry.checked_at >= SIGNATURE_CHECK_INTERVAL
+            )
+        # 重新索引后 index.py 会显式失效缓存，签名检查只兜底外部修改
+        signature = output_signature(key) if due else None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if signature is not None:
+                entry.checked_at = time.monotonic()
+            if signature is not None and entry.signature != signature:
+                # output/ 下的产物发生了变化，说明已重新索引
+                logger.info(f"Knowledge base '{key}' changed on disk, dropping cache")
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def put(self, key: str, value: Any, signature: Optional[Signature] = None) -> None:
+        size = estimate_size(value)
+        if signature is None:
+            signature = output_signature(key)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CacheEntry(value=value, size=size, signature=signature)
+            self.current_bytes += size
+            # 至少保留刚放入的条目，即使它本身超出预算
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted, entry = next(iter(self._entries.items()))
+                self._remove(evicted)
+                self.evictions += 1
+                logger.info(
+                    f"Evicted knowledge base '{evicted}' ({entry.size} bytes) from cache"
+                )
+
+    def invalidate(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            self.invalidations += 1
+            return True
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._entries)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self.current_bytes -= entry.size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "max_bytes": self.max_bytes,
+                "current_bytes": self.current_bytes,
+                "entries": {key: entry.size for key, entry in self._entries.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+kb_cache = KBCache(get_kb_cache_max_bytes())
@@ -0,0 +1,253 @@
+import asyncio
+import functools
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from fastapi import HTTPException
+from incremental import MANIFEST_FILE
+from settings import update_env_file, update_yaml_config
+from utils import get_kb_repository_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 最后生成的核心产物，存在即认为知识库已完成索引
+INDEXED_MARKER = "create_final_community_reports.parquet"
+MAX_PAGE_SIZE = 1000
+
+
+@dataclass
+class KBInfo:
+    name: str
+    input_files: int
+    input_bytes: int
+    indexed: bool
+    last_indexed: Optional[float]
+    scanned_at: float
+
+
+def _mtime_ns(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _is_input_file(entry: os.DirEntry) -> bool:
+    # 跳过上传过程中的临时文件
+    return not entry.name.startswith(".") and entry.is_file()
+
+
+def _scan_kb(kb_root: str, name: str) -> KBInfo:
+    kb_path = os.path.join(kb_root, name)
+    files, size = 0, 0
+    try:
+        with os.scandir(os.path.join(kb_path, "input")) as entries:
+            for entry in entries:
+                if _is_input_file(entry):
+                    files += 1
+                    size += entry.stat().st_size
+    except FileNotFoundError:
+        pass
+    marker = os.path.join(kb_path, "output", INDEXED_MARKER)
+    indexed = os.path.exists(marker)
+    last_indexed = None
+    for path in (os.path.join(kb_path, MANIFEST_FILE), marker):
+        mtime = _mtime_ns(path)
+        if mtime is not None:
+            last_indexed = mtime / 1e9
+            break
+    return KBInfo(name, files, size, indexed, last_indexed, time.time())
+
+
+def _kb_signature(kb_root: str, name: str) -> Tuple[Optional[int], ...]:
+    """Directory mtimes that change whenever inputs are added/replaced or outputs rewritten."""
+    kb_path = os.path.join(kb_root, name)
+    return (
+        _mtime_ns(kb_path),
+        _mtime_ns(os.path.join(kb_path, "input")),
+        _mtime_ns(os.path.join(kb_path, "output")),
+    )
+
+
+def _list_kb_names(kb_root: str) -> List[str]:
+    try:
+        with os.scandir(kb_root) as entries:
+            return sorted(e.name for e in entries if e.is_dir())
+    except FileNotFoundError:
+        return []
+
+
+def _list_input_files(input_dir: str) -> List[Dict[str, Any]]:
+    files = []
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if _is_input_file(entry):
+                stat = entry.stat()
+                files.append(
+                    {
+                        "name": entry.name,
+                        "size": stat.st_size,
+                        "modified": stat.st_mtime,
+                    }
+                )
+    files.sort(key=lambda f: f["name"])
+    return files
+
+
+class KBRepository:
+    """
+    Filesystem access for knowledge base management, run on a bounded thread
+    pool so slow (e.g. network-mounted) KB_ROOTs never block the event loop.
+    Keeps an in-memory catalogue refreshed by polling directory mtimes, and
+    sorted input listings cached until the input directory changes.
+    """
+
+    def __init__(self, kb_root: str, max_workers: int, poll_interval: float):
+        self.kb_root = kb_root
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="kb-fs"
+        )
+        self._catalog: Dict[str, KBInfo] = {}
+        self._signatures: Dict[str, Tuple[Optional[int], ...]] = {}
+        self._listings: Dict[str, Tuple[Optional[int], List[Dict[str, Any]]]] = {}
+        self._applied_settings: Dict[str, str] = {}
+        self._dirty: Set[str] = set()
+        self._scanned = False
+        self._task: Optional[asyncio.Task] = None
+        # 轮询与请求触发的刷新可能在不同线程中同时执行
+        self._lock = threading.Lock()
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Run blocking filesystem work on the repository's thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    def _refresh(self) -> None:
+        with self._lock:
+            names = _list_kb_names(self.kb_root)
+            dirty, self._dirty = self._dirty, set()
+            for name in set(self._catalog) - set(names):
+                self._catalog.pop(name, None)
+                self._signatures.pop(name, None)
+                self._listings.pop(name, None)
+            for name in names:
+                signature = _kb_signature(self.kb_root, name)
+                if name in dirty or self._signatures.get(name) != signature:
+                    self._catalog[name] = _scan_kb(self.kb_root, name)
+                    self._signatures[name] = signature
+            self._scanned = True
+
+    async def refresh(self) -> None:
+        await self.run(self._refresh)
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh KB catalogue: {str(e)}")
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._task = asyncio.create_task(self._poll())
+        logger.info(f"KB catalogue loaded with {len(self._catalog)} knowledge bases")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._executor.shutdown(wait=False)
+
+    def invalidate(self, name: str) -> None:
+        """Rescan a KB on the next catalogue read, e.g. right after an upload."""
+        self._dirty.add(name)
+
+    async def catalog(self) -> List[Dict[str, Any]]:
+        if self._dirty or not self._scanned:
+            await self.refresh()
+        return [asdict(info) for _, info in sorted(self._catalog.items())]
+
+    async def names(self) -> List[str]:
+        return [info["name"] for info in await self.catalog()]
+
+    async def get(self, name: str) -> Optional[Dict[str, Any]]:
+        if name in self._dirty or name not in self._catalog:
+            await self.refresh()
+        info = self._catalog.get(name)
+        return asdict(info) if info is not None else None
+
+    def _listing(self, name: str) -> List[Dict[str, Any]]:
+        input_dir = os.path.join(self.kb_root, name, "input")
+        mtime = _mtime_ns(input_dir)
+        if mtime is None:
+            raise FileNotFoundError(input_dir)
+        cached = self._listings.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        files = _list_input_files(input_dir)
+        self._listings[name] = (mtime, files)
+        return files
+
+    async def list_files(
+        self, name: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """One page of a KB's input files sorted by name, with the total count."""
+        if not name or os.sep in name or name in (".", ".."):
+            raise HTTPException(status_code=400, detail="Invalid knowledge base name")
+        try:
+            files = await self.run(self._listing, name)
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=404, detail=f"Knowledge base '{name}' not found"
+            )
+        end = len(files) if limit is None else offset + limit
+        return {
+            "total": len(files),
+            "offset": offset,
+            "limit": limit,
+            "files": files[offset:end],
+        }
+
+    async def makedirs(self, path: str, exist_ok: bool = False) -> None:
+        await self.run(os.makedirs, path, mode=0o777, exist_ok=exist_ok)
+
+    def _apply_index_settings(
+        self, target_path: str, api_key: str, updates: List[Tuple[str, Any]]
+    ) -> bool:
+        env_path = os.path.join(target_path, ".env")
+        settings_path = os.path.join(target_path, "settings.yaml")
+
+        def fingerprint() -> str:
+            state = (api_key, updates, _mtime_ns(env_path), _mtime_ns(settings_path))
+            return hashlib.sha256(repr(state).encode()).hexdigest()
+
+        if self._applied_settings.get(target_path) == fingerprint():
+            # 两个文件自上次写入后未被修改且取值相同，跳过 ruamel 的解析和重写
+            return True
+        update_env_file("GRAPHRAG_API_KEY", api_key, env_path)
+        if not update_yaml_config(updates, settings_path):
+            return False
+        self._applied_settings[target_path] = fingerprint()
+        return True
+
+    async def apply_index_settings(
+        self, target_path: str, api_key: str, updates: List[Tuple[str, Any]]
+    ) -> bool:
+        """Write the API key to .env and model settings to settings.yaml, off the event loop."""
+        return await self.run(self._apply_index_settings, target_path, api_key, updates)
+
+
+_settings = get_kb_repository_settings()
+kb_repository = KBRepository(
+    _settings["kb_root"], _settings["max_workers"], _settings["poll_interval"]
+)
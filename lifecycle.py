@@ -0,0 +1,132 @@
+import asyncio
+import os
+import signal
+import time
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator, Dict, Optional
+from metrics import SUBPROCESS_SPAWN
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+STDERR_TAIL_LINES = 200
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+# 查询执行的生命周期计数
+execution_stats: Dict[str, int] = {
+    "started": 0,
+    "completed": 0,
+    "failed": 0,
+    "cancelled": 0,
+    "timed_out": 0,
+    "killed_processes": 0,
+}
+
+
+class ManagedProcess:
+    """
+    A child process started in its own process group whose stderr is drained
+    concurrently into a bounded tail, so a chatty child never blocks on a full pipe.
+    """
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.stderr_tail: deque = deque(maxlen=STDERR_TAIL_LINES)
+        self._stderr_task = (
+            asyncio.create_task(self._drain(process.stderr))
+            if process.stderr is not None
+            else None
+        )
+
+    @classmethod
+    async def start(cls, *cmd: str, kind: str = "query", **kwargs) -> "ManagedProcess":
+        with SUBPROCESS_SPAWN.time(kind):
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+                **kwargs,
+            )
+        return cls(process)
+
+    @property
+    def stdout(self) -> asyncio.StreamReader:
+        return self.process.stdout
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.returncode
+
+    async def _drain(self, stream: asyncio.StreamReader) -> None:
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            self.stderr_tail.append(line.decode(errors="replace").rstrip())
+
+    async def wait(self) -> int:
+        returncode = await self.process.wait()
+        if self._stderr_task is not None:
+            await self._stderr_task
+        return returncode
+
+    def stderr_text(self) -> str:
+        return "\n".join(self.stderr_tail)
+
+    def _signal_group(self, sig: int) -> None:
+        try:
+            os.killpg(self.process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    async def terminate(self, grace: float) -> None:
+        """SIGTERM the whole process group, then SIGKILL it if still alive after `grace` seconds."""
+        if self.process.returncode is not None:
+            return
+        execution_stats["killed_processes"] += 1
+        self._signal_group(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=grace)
+        except asyncio.TimeoutError:
+            logger.warning(f"Process {self.process.pid} ignored SIGTERM, killing")
+            self._signal_group(signal.SIGKILL)
+            await self.process.wait()
+        if self._stderr_task is not None:
+            self._stderr_task.cancel()
+
+
+async def with_deadline(
+    source: AsyncIterator[str], timeout: float
+) -> AsyncGenerator[str, None]:
+    """Re-yield `source`, raising QueryTimeout once `timeout` seconds have elapsed overall."""
+    if timeout <= 0:
+        async for item in source:
+            yield item
+        return
+    deadline = time.monotonic() + timeout
+    iterator = source.__aiter__()
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise QueryTimeout(f"Query exceeded {timeout:.0f}s")
+            try:
+                item = await asyncio.wait_for(iterator.__anext__(), timeout=remaining)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise QueryTimeout(f"Query exceeded {timeout:.0f}s")
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def lifecycle_stats() -> Dict[str, int]:
+    return dict(execution_stats)
@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from utils import get_llm_cache_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 查询阶段的 LLM 回复与 graphrag 索引缓存放在同一目录下的独立命名空间
+QUERY_NAMESPACE = "query"
+# 清理时删到容量上限的这个比例，避免每次写入都触发清理
+LOW_WATERMARK = 0.9
+# 查询命中/未命中计数先在内存中累计，每隔这么多秒写入一次 SQLite
+FLUSH_INTERVAL = 1.0
+
+
+def cache_key(model: Optional[str], messages: Any, params: Dict[str, Any]) -> str:
+    payload = {"model": model, "messages": messages, "params": params}
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class LLMCache:
+    """
+    One content-addressed cache directory for LLM completions and embeddings,
+    shared by every KB, re-index and query on the host. Indexing points graphrag's
+    file cache (keyed by a hash of model, prompt and parameters) at it through
+    cache.base_dir, so overlapping corpora and recreated KBs reuse earlier
+    extractions; in-process queries store their completions under `query/`.
+    The directory is kept under `max_bytes` by evicting least recently used
+    entries. Counters live in SQLite so every worker reports the same stats;
+    query hits and misses are buffered in memory and written once per
+    FLUSH_INTERVAL (and on stop).
+    """
+
+    def __init__(self, base_dir: str, db_path: str, max_bytes: int, enabled: bool):
+        self.base_dir = os.path.abspath(base_dir)
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Dict[str, float] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        os.makedirs(self.base_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                "name TEXT PRIMARY KEY, value REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _add(self, **deltas: float) -> None:
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO counters VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                deltas.items(),
+            )
+
+    def _set(self, **values: float) -> None:
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO counters VALUES (?, ?)", values.items()
+            )
+
+    def settings_updates(self) -> List[Tuple[str, Any]]:
+        """settings.yaml keys that point a KB's graphrag file cache here."""
+        if not self.enabled:
+            return []
+        return [("cache.type", "file"), ("cache.base_dir", self.base_dir)]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.base_dir, QUERY_NAMESPACE, key[:2], f"{key}.json")
+
+    def _get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                response = json.load(f)["response"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        # 更新修改时间，作为 LRU 清理的最近使用时间
+        os.utime(path)
+        return response
+
+    def _put(self, key: str, response: str) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"response": response, "created": time.time()}, f)
+        os.replace(tmp, path)
+
+    async def get(self, key: str) -> Optional[str]:
+        response = await asyncio.to_thread(self._get, key)
+        self._count("query_misses" if response is None else "query_hits")
+        return response
+
+    def _count(self, name: str) -> None:
+        self._pending[name] = self._pending.get(name, 0) + 1
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write the buffered query counters to SQLite."""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await asyncio.to_thread(self._add, **pending)
+        except Exception as e:
+            logger.error(f"Failed to record LLM cache counters: {str(e)}")
+
+    async def put(self, key: str, response: str) -> None:
+        await asyncio.to_thread(self._put, key, response)
+
+    def sweep(self) -> Dict[str, Any]:
+        """
+        Total the cache and, above `max_bytes`, delete least recently used entries
+        down to the low watermark. graphrag reads entries without touching them,
+        so recency is the later of atime and mtime (day-granular under relatime).
+        Blocking.
+        """
+        entries = []
+        for directory, _, files in os.walk(self.base_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        if total > self.max_bytes:
+            entries.sort()
+            target = self.max_bytes * LOW_WATERMARK
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+            logger.info(f"Evicted {evicted} LLM cache entries from {self.base_dir}")
+        result = {"entries": len(entries) - evicted, "bytes": total}
+        self._set(**result, swept_at=time.time())
+        if evicted:
+            self._add(evictions=evicted)
+        return result
+
+    def record_index(self, added: int) -> None:
+        self._add(index_entries_added=added)
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"Failed to sweep LLM cache: {str(e)}")
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float) -> None:
+        if self.enabled:
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._connect() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM counters"))
+        hits = int(counters.get("query_hits", 0))
+        misses = int(counters.get("query_misses", 0))
+        return {
+            "enabled": self.enabled,
+            "base_dir": self.base_dir,
+            "max_bytes": self.max_bytes,
+            "bytes": int(counters.get("bytes", 0)),
+            "entries": int(counters.get("entries", 0)),
+            "swept_at": counters.get("swept_at"),
+            "evictions": int(counters.get("evictions", 0)),
+            "index_entries_added": int(counters.get("index_entries_added", 0)),
+            "query_hits": hits,
+            "query_misses": misses,
+            "query_hit_ratio": hits / (hits + misses) if hits + misses else None,
+        }
+
+
+class CachedLLM:
+    """
+    Wraps a graphrag query LLM so identical calls (model, messages, parameters)
+    are answered from the shared LLM cache. Hits are replayed to streaming
+    callbacks so callers see the same events as for a live call.
+    """
+
+    def __init__(self, llm: Any, model: Optional[str]):
+        self.llm = llm
+        self.model = model
+
+    def __getattr__(self, name: str):
+        return getattr(self.llm, name)
+
+    async def agenerate(self, messages, streaming=True, callbacks=None, **kwargs):
+        key = cache_key(self.model, messages, kwargs)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            for callback in callbacks or []:
+                callback.on_llm_new_token(cached)
+            return cached
+        response = await self.llm.agenerate(
+            messages, streaming=streaming, callbacks=callbacks, **kwargs
+        )
+        if isinstance(response, str) and response:
+            await llm_cache.put(key, response)
+        return response
+
+    async def astream_generate(self, messages, callbacks=None, **kwargs):
+        key = cache_key(self.model, messages, kwargs)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        async for chunk in self.llm.astream_generate(
+            messages, callbacks=callbacks, **kwargs
+        ):
+            parts.append(chunk)
+            yield chunk
+        if parts:
+            await llm_cache.put(key, "".join(parts))
+
+
+_settings = get_llm_cache_settings()
+llm_cache = LLMCache(
+    _settings["base_dir"],
+    _settings["db_path"],
+    _settings["max_bytes"],
+    _settings["enabled"],
+)
@@ -1,11 +1,31 @@
 import argparse
 import os
 from dotenv import load_dotenv
+
+# 各模块在导入时按环境变量创建单例，.env 必须在导入它们之前加载
+load_dotenv(".env")
+
 from logger import get_logger
 from fastapi import FastAPI
 from fastapi.concurrency import asynccontextmanager
 from handler import router
+from metrics import MetricsMiddleware
 from settings import init_kbs
+from kb_repository import kb_repository
+from worker_pool import worker_pool
+from jobs import job_runner
+from http_client import http_client
+from model_catalog import model_catalog
+from llm_cache import llm_cache
+from rate_limiter import rate_limiter
+from cluster import (
+    DrainMiddleware,
+    create_router_app,
+    drain,
+    spawn_workers,
+    stop_workers,
+)
+from utils import get_cluster_settings, get_llm_cache_settings, get_query_mode
 
 logger = get_logger(__name__)
 
@@ -15,18 +35,36 @@ async def lifespan(app: FastAPI):
     # global settings
     try:
         logger.info("Initializing KBs...")
-        load_dotenv(".env")
-        init_kbs(os.getenv("KB_ROOT"))
+        http_client.start()
+        model_catalog.start()
+        await kb_repository.run(init_kbs, os.getenv("KB_ROOT"))
+        await kb_repository.start()
+        if get_query_mode() == "pool":
+            worker_pool.start()
+        job_runner.start()
+        llm_cache.start(get_llm_cache_settings()["sweep_interval"])
         logger.info("Initialized successfully.")
     except Exception as e:
         logger.error(f"Error initializing: {str(e)}")
         raise
     yield
     logger.info("Shutting down...")
+    # 先让进行中的请求（包括流式响应）结束，再停止它们依赖的组件
+    await drain.wait(get_cluster_settings()["drain_timeout"])
+    await job_runner.stop()
+    await rate_limiter.flush()
+    await llm_cache.stop()
+    if worker_pool.started:
+        await worker_pool.stop()
+    await model_catalog.stop()
+    await http_client.stop()
+    await kb_repository.stop()
 
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(router)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(DrainMiddleware)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Launch the GraphRAG API server")
@@ -37,7 +75,52 @@ if __name__ == "__main__":
         "--port", type=int, default=8012, help="Port to bind the server to"
     )
     parser.add_argument("--reload", action="store_true", help="Enable auto-reload mode")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes behind the KB-affinity router; "
+        "workers listen on 127.0.0.1 at the ports following --port",
+    )
+    parser.add_argument(
+        "--router",
+        action="store_true",
+        help="Only run the KB-affinity router in front of CLUSTER_WORKERS",
+    )
     args = parser.parse_args()
+    if args.reload and (args.workers > 1 or args.router):
+        parser.error("--reload runs a single process")
     import uvicorn
 
-    uvicorn.run("main:app", host=args.host, port=args.port, reload=args.reload)
+    settings = get_cluster_settings()
+    drain_timeout = int(settings["drain_timeout"])
+    if args.router:
+        if not settings["workers"]:
+            parser.error("CLUSTER_WORKERS is not set")
+        uvicorn.run(
+            create_router_app(settings["workers"]),
+            host=args.host,
+            port=args.port,
+            timeout_graceful_shutdown=drain_timeout,
+        )
+    elif args.workers > 1:
+        ports = [args.port + 1 + i for i in range(args.workers)]
+        workers = spawn_workers(ports, drain_timeout)
+        try:
+            uvicorn.run(
+                create_router_app([f"http://127.0.0.1:{port}" for port in ports]),
+                host=args.host,
+                port=args.port,
+                timeout_graceful_shutdown=drain_timeout,
+            )
+        finally:
+            # 路由器排空后再停止工作进程
+            stop_workers(workers, drain_timeout)
+    else:
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            reload=args.reload,
+            timeout_graceful_shutdown=drain_timeout,
+        )
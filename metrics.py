@@ -0,0 +1,466 @@
+import bisect
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+from utils import get_cluster_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 覆盖从缓存命中（毫秒级）到长查询（分钟级）的延迟范围
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+SPAWN_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+THROUGHPUT_BUCKETS = (0.5, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+INDEX_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _labels(self, values: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, values))
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            yield self.name, self._labels(labelvalues), value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def inc(self, *labelvalues: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def dec(self, *labelvalues: str, amount: float = 1.0) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            yield self.name, self._labels(labelvalues), value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每个标签组合: [各桶计数（非累计）..., +Inf 桶计数], sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = (
+                    [0] * (len(self.buckets) + 1),
+                    [0.0],
+                )
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def time(self, *labelvalues: str) -> "_Timer":
+        return _Timer(self, labelvalues)
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            values = [(k, list(v[0]), v[1][0]) for k, v in self._values.items()]
+        for labelvalues, counts, total in values:
+            labels = self._labels(labelvalues)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket = {**labels, "le": _format_value(bound)}
+                yield self.name + "_bucket", bucket, cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labelvalues: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labelvalues)
+
+
+class Registry:
+    """
+    A minimal Prometheus registry. Hot paths only touch pre-registered metrics
+    (a dict update under a lock); values that already live elsewhere, such as
+    queue depths and cache statistics, are read by collectors at scrape time.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[
+            Callable[[], Iterable[Tuple[str, str, str, Iterable[Sample]]]]
+        ] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector) -> None:
+        """`collector()` yields (name, type, help, samples) families on every scrape."""
+        self._collectors.append(collector)
+
+    def _families(self):
+        for metric in self._metrics.values():
+            yield metric.name, metric.type, metric.documentation, metric.samples()
+        for collector in self._collectors:
+            try:
+                yield from collector()
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {str(e)}")
+
+    def render(self) -> str:
+        # 多工作进程部署时给每个样本加上 worker 标签，路由器合并后仍可区分
+        node = get_cluster_settings()["node"]
+        worker = {"worker": node} if node else {}
+        lines: List[str] = []
+        for name, metric_type, documentation, samples in self._families():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for sample_name, labels, value in samples:
+                labels = {**worker, **labels}
+                lines.append(
+                    f"{sample_name}{_format_labels(labels)} {_format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def merge_expositions(texts: Iterable[str]) -> str:
+    """Join several processes' /metrics output, keeping one HELP/TYPE per family."""
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for text in texts:
+        samples = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split(" ", 3)[2]
+                header, samples = families.setdefault(name, ([], []))
+                if len(header) < 2 and line not in header:
+                    header.append(line)
+            elif line and samples is not None:
+                samples.append(line)
+    lines: List[str] = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUEST_DURATION = registry.histogram(
+    "graphrag_api_http_request_duration_seconds",
+    "Time from receiving a request until its response body is fully sent",
+    ("method", "endpoint", "status"),
+)
+QUERY_DURATION = registry.histogram(
+    "graphrag_api_query_duration_seconds",
+    "GraphRAG query latency until the last SSE event",
+    ("kb", "query_type", "source"),
+)
+QUERY_TTFT = registry.histogram(
+    "graphrag_api_query_ttft_seconds",
+    "Time from receiving a GraphRAG query until its first answer token is sent",
+    ("kb", "query_type"),
+)
+SUBPROCESS_SPAWN = registry.histogram(
+    "graphrag_api_subprocess_spawn_seconds",
+    "Time to spawn a graphrag subprocess or query worker",
+    ("kind",),
+    buckets=SPAWN_BUCKETS,
+)
+INDEX_DURATION = registry.histogram(
+    "graphrag_api_index_duration_seconds",
+    "Wall-clock duration of indexing jobs run by this process",
+    ("status",),
+    buckets=INDEX_BUCKETS,
+)
+UPLOAD_BYTES = registry.counter(
+    "graphrag_api_upload_bytes_total",
+    "Bytes written to knowledge base input directories",
+    ("kind",),
+)
+UPLOAD_SECONDS = registry.counter(
+    "graphrag_api_upload_seconds_total",
+    "Time spent receiving and writing uploads",
+    ("kind",),
+)
+UPLOAD_THROUGHPUT = registry.histogram(
+    "graphrag_api_upload_throughput_mb_per_second",
+    "Throughput of individual uploads",
+    ("kind",),
+    buckets=THROUGHPUT_BUCKETS,
+)
+ERRORS = registry.counter("graphrag_api_errors_total", "Errors by cause", ("cause",))
+
+
+def _family(name: str, metric_type: str, documentation: str, samples: List[Sample]):
+    return name, metric_type, documentation, samples
+
+
+def _runtime_collector():
+    """Queue depths, worker and cache state read from their owners at scrape time."""
+    from admission import query_admission
+    from jobs import job_runner, job_store
+    from kb_cache import kb_cache
+    from lifecycle import lifecycle_stats
+    from query import coalescing_stats
+    from result_cache import result_cache
+    from worker_pool import worker_pool
+
+    admission = query_admission.stats()
+    coalescing = coalescing_stats()
+    yield _family(
+        "graphrag_api_queries_active",
+        "gauge",
+        "Queries holding an admission slot",
+        [("graphrag_api_queries_active", {}, admission["active"])],
+    )
+    yield _family(
+        "graphrag_api_queries_queued",
+        "gauge",
+        "Queries waiting for an admission slot",
+        [("graphrag_api_queries_queued", {}, admission["queued"])],
+    )
+    yield _family(
+        "graphrag_api_queries_rejected_total",
+        "counter",
+        "Queries rejected by admission control",
+        [("graphrag_api_queries_rejected_total", {}, admission["rejected"])],
+    )
+    yield _family(
+        "graphrag_api_queries_in_flight",
+        "gauge",
+        "Distinct query executions in flight",
+        [("graphrag_api_queries_in_flight", {}, coalescing["in_flight"])],
+    )
+    yield _family(
+        "graphrag_api_queries_coalesced_total",
+        "counter",
+        "Queries that joined an in-flight execution",
+        [("graphrag_api_queries_coalesced_total", {}, coalescing["coalesced"])],
+    )
+    yield _family(
+        "graphrag_api_query_executions_total",
+        "counter",
+        "Query executions by outcome",
+        [
+            ("graphrag_api_query_executions_total", {"outcome": outcome}, value)
+            for outcome, value in lifecycle_stats().items()
+        ],
+    )
+    if worker_pool.started:
+        pool = worker_pool.stats()
+        yield _family(
+            "graphrag_api_query_workers_idle",
+            "gauge",
+            "Idle query worker processes",
+            [("graphrag_api_query_workers_idle", {}, pool["idle"])],
+        )
+        yield _family(
+            "graphrag_api_query_worker_restarts_total",
+            "counter",
+            "Query workers replaced",
+            [("graphrag_api_query_worker_restarts_total", {}, pool["restarts"])],
+        )
+    yield _family(
+        "graphrag_api_index_jobs_running_local",
+        "gauge",
+        "Indexing jobs running in this process",
+        [("graphrag_api_index_jobs_running_local", {}, len(job_runner.running))],
+    )
+    yield _family(
+        "graphrag_api_index_jobs",
+        "gauge",
+        "Indexing jobs in the shared queue by status",
+        [
+            ("graphrag_api_index_jobs", {"status": status}, count)
+            for status, count in job_store.counts().items()
+        ],
+    )
+    caches = {"kb": kb_cache.stats(), "result": result_cache.stats()}
+    for field, metric_type, documentation in (
+        ("hits", "counter", "Cache hits"),
+        ("misses", "counter", "Cache misses"),
+        ("hit_ratio", "gauge", "Cache hit ratio since startup"),
+    ):
+        name = f"graphrag_api_cache_{field}" + (
+            "_total" if metric_type == "counter" else ""
+        )
+        yield _family(
+            name,
+            metric_type,
+            documentation,
+            [(name, {"cache": cache}, stats[field]) for cache, stats in caches.items()],
+        )
+    yield _family(
+        "graphrag_api_kb_cache_bytes",
+        "gauge",
+        "Estimated size of loaded knowledge bases",
+        [("graphrag_api_kb_cache_bytes", {}, caches["kb"]["current_bytes"])],
+    )
+
+
+registry.register_collector(_runtime_collector)
+
+
+def error(cause: str) -> None:
+    ERRORS.inc(cause)
+
+
+def _endpoint(scope: Dict[str, Any]) -> str:
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    return path or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording request latency per route template. It wraps
+    `send` instead of the response body, so streamed chunks pass through untouched
+    and only the final message triggers an observation.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        state = {"status": "500", "recorded": False}
+
+        def record() -> None:
+            state["recorded"] = True
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                _endpoint(scope),
+                state["status"],
+            )
+
+        async def send_wrapper(message):
+            message_type = message["type"]
+            if message_type == "http.response.start":
+                state["status"] = str(message["status"])
+            elif message_type == "http.response.body" and not message.get("more_body"):
+                record()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            error("unhandled_exception")
+            raise
+        finally:
+            # 客户端中途断开时不会发送最后一个 body 消息
+            if not state["recorded"]:
+                record()
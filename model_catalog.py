@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+from fastapi import HTTPException
+from http_client import http_client
+from utils import (
+    get_model_catalog_settings,
+    normalize_api_base,
+    request_available_models,
+)
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# (api_base, api_type, api_key 的哈希)：不同凭据的调用方各自缓存，互不借用密钥
+CatalogKey = Tuple[str, str, str]
+
+
+@dataclass
+class CatalogEntry:
+    models: List[str] = field(default_factory=list)
+    fetched_at: Optional[float] = None
+    expires_at: float = 0.0
+    error: Optional[str] = None
+    last_used: float = field(default_factory=time.time)
+    # 后台刷新需要凭据，只保存在内存中，从不返回给客户端
+    api_key: Optional[str] = None
+    refreshing: Optional[asyncio.Task] = None
+
+
+class ModelCatalog:
+    """
+    Model lists per (api_base, api_type, api_key), served from memory. A missing
+    entry is fetched once for all concurrent callers; an expired one is returned
+    as-is while a single background refresh runs. Recently used entries are also
+    refreshed periodically so the UI rarely waits on a provider. At most
+    `max_entries` are kept, evicting the least recently used.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        error_ttl: float,
+        idle_expiry: float,
+        max_entries: int,
+        allowed_hosts: List[str],
+    ):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.idle_expiry = idle_expiry
+        self.max_entries = max_entries
+        self.allowed_hosts = allowed_hosts
+        self._entries: Dict[CatalogKey, CatalogEntry] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.fetches = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(api_base: str, api_type: str, api_key: Optional[str]) -> CatalogKey:
+        key_hash = hashlib.sha256(api_key.encode()).hexdigest() if api_key else ""
+        return normalize_api_base(api_base), api_type.lower(), key_hash
+
+    def _validate(self, api_base: str) -> None:
+        parts = urlsplit(api_base)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise HTTPException(
+                status_code=400, detail="api_base must be an http(s) URL"
+            )
+        if self.allowed_hosts and parts.hostname not in self.allowed_hosts:
+            raise HTTPException(
+                status_code=400, detail=f"api_base host {parts.hostname} not allowed"
+            )
+
+    def _evict(self) -> None:
+        while len(self._entries) >= self.max_entries:
+            # 正在进行的获取照常完成，只是结果不再缓存
+            key = min(self._entries, key=lambda k: self._entries[k].last_used)
+            del self._entries[key]
+
+    async def _fetch(self, key: CatalogKey, entry: CatalogEntry) -> None:
+        self.fetches += 1
+        settings = {"api_base": key[0], "api_type": key[1], "api_key": entry.api_key}
+        try:
+            models = await request_available_models(settings, http_client.client)
+        except Exception as e:
+            logger.error(f"Error fetching models from {key[0]}: {str(e)}")
+            # 失败时保留上次成功的列表，并在较短时间后重试
+            entry.error = str(e)
+            entry.expires_at = time.time() + self.error_ttl
+            return
+        now = time.time()
+        entry.models = models
+        entry.fetched_at = now
+        entry.expires_at = now + self.ttl
+        entry.error = None
+
+    def _refresh(self, key: CatalogKey, entry: CatalogEntry) -> asyncio.Task:
+        if entry.refreshing is None or entry.refreshing.done():
+            entry.refreshing = asyncio.create_task(self._fetch(key, entry))
+        return entry.refreshing
+
+    async def get(
+        self,
+        api_base: str,
+        api_type: str,
+        api_key: Optional[str] = None,
+        refresh: bool = False,
+    ) -> Dict[str, Any]:
+        self._validate(api_base)
+        key = self.key(api_base, api_type, api_key)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._evict()
+            entry = self._entries[key] = CatalogEntry(api_key=api_key)
+        entry.last_used = time.time()
+        if entry.fetched_at is None or refresh:
+            # 首次请求（或强制刷新）需要等待；并发的相同请求共享同一次获取
+            await asyncio.shield(self._refresh(key, entry))
+        elif time.time() >= entry.expires_at:
+            self._refresh(key, entry)
+            self.hits += 1
+        else:
+            self.hits += 1
+        return self._describe(key, entry)
+
+    def _describe(self, key: CatalogKey, entry: CatalogEntry) -> Dict[str, Any]:
+        return {
+            "api_base": key[0],
+            "api_type": key[1],
+            "models": entry.models,
+            "fetched_at": entry.fetched_at,
+            "stale": time.time() >= entry.expires_at,
+            "error": entry.error,
+        }
+
+    async def _run(self) -> None:
+        interval = max(1.0, min(self.ttl, self.error_ttl) / 2)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.time()
+            for key, entry in list(self._entries.items()):
+                if now - entry.last_used > self.idle_expiry:
+                    del self._entries[key]
+                elif now >= entry.expires_at - interval:
+                    self._refresh(key, entry)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        tasks = [e.refreshing for e in self._entries.values() if e.refreshing]
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": [
+                {k: v for k, v in self._describe(key, entry).items() if k != "models"}
+                for key, entry in self._entries.items()
+            ],
+            "hits": self.hits,
+            "fetches": self.fetches,
+        }
+
+
+_settings = get_model_catalog_settings()
+model_catalog = ModelCatalog(
+    _settings["ttl"],
+    _settings["error_ttl"],
+    _settings["idle_expiry"],
+    _settings["max_entries"],
+    _settings["allowed_hosts"],
+)
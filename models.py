@@ -1,5 +1,5 @@
 import time
-from typing import List, Optional
+from typing import List, Literal, Optional
 import uuid
 from pydantic import BaseModel, Field
 
@@ -28,6 +28,23 @@ class ChatCompletionRequest(BaseModel):
     query_options: Optional[QueryOptions] = None
 
 
+class FederatedQueryRequest(BaseModel):
+    query: str
+    selected_folders: List[str]
+    query_type: str = "global"
+    community_level: Optional[int] = 2
+    model: str = "graphrag-federated"
+    temperature: Optional[float] = 0.7
+    max_tokens: Optional[int] = 4096
+    # 是否转发每个知识库的增量输出；否则每个知识库只发送完整答案
+    stream: bool = True
+    # 同时查询的知识库数量上限，默认使用 FEDERATION_MAX_PARALLEL
+    parallelism: Optional[int] = None
+    # 是否用 LLM 合并各知识库的答案，以及使用哪个知识库配置的模型
+    reduce: bool = False
+    reduce_kb: Optional[str] = None
+
+
 class ChatCompletionResponseChoice(BaseModel):
     index: int
     message: Message
@@ -50,6 +67,18 @@ class ChatCompletionResponse(BaseModel):
     system_fingerprint: Optional[str] = None
 
 
+class PerformanceProfile(BaseModel):
+    # manual: 只应用给出的值；auto: 根据语料大小和提供方延迟选择未给出的值
+    mode: Literal["manual", "auto"] = "manual"
+    embedding_batch_size: Optional[int] = Field(None, gt=0)
+    embedding_batch_max_tokens: Optional[int] = Field(None, gt=0)
+    llm_concurrent_requests: Optional[int] = Field(None, gt=0)
+    embedding_concurrent_requests: Optional[int] = Field(None, gt=0)
+    chunk_size: Optional[int] = Field(None, gt=0)
+    chunk_overlap: Optional[int] = Field(None, ge=0)
+    parallel_workers: Optional[int] = Field(None, gt=0)
+
+
 class IndexingRequest(BaseModel):
     api_key: str
     llm_model: str
@@ -62,6 +91,12 @@ class IndexingRequest(BaseModel):
     resume: Optional[str] = None
     reporter: str = "rich"
     emit: List[str] = ["parquet"]
+    # 排队优先级，数值越大越先执行
+    priority: int = 0
+    # auto: 只有新增文档时增量更新，有修改或删除时全量重建；full: 强制全量重建
+    mode: str = "auto"
+    # 嵌入批量、并发、分块和并行度；不设置时沿用知识库现有配置
+    performance: Optional[PerformanceProfile] = None
     # custom_args: Optional[str] = None
     # llm_params: Dict[str, Any] = Field(default_factory=dict)
     # embed_params: Dict[str, Any] = Field(default_factory=dict)
@@ -69,3 +104,11 @@ class IndexingRequest(BaseModel):
 
 class InitRequest(BaseModel):
     root: str
+
+
+class RateLimitRequest(BaseModel):
+    api_base: str
+    model: str
+    # 每分钟请求数和 token 数上限，0 表示不限制
+    rpm: float = 0
+    tpm: float = 0
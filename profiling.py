@@ -0,0 +1,286 @@
+import asyncio
+import json
+import os
+import re
+import resource
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+REPORT_DIR = "perf_reports"
+LATEST_REPORT = "perf_report.json"
+SAMPLE_INTERVAL = 1.0
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# graphrag（基于 openai 客户端的实现）在 logs/indexing-engine.log 中记录的每次 LLM 调用
+_LLM_PERF = re.compile(
+    r"perf - llm\.(\w+) .*?took (\d+(?:\.\d+)?)\.?\s*"
+    r"input_tokens=(\d+),?\s*output_tokens=(\d+)"
+)
+_LOG_WORKFLOW = re.compile(r"(?:Running|Starting|Executing) workflow[:\s]+([a-z_]+)")
+
+
+def _read_proc_stat(pid: int):
+    """(ppid, cpu_seconds, rss_bytes) for a pid from /proc, or None if it is gone."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (FileNotFoundError, ProcessLookupError, PermissionError, IndexError):
+        return None
+    ppid = int(fields[1])
+    cpu = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    rss = int(fields[21]) * _PAGE_SIZE
+    return ppid, cpu, rss
+
+
+def _process_tree(root_pid: int) -> List[int]:
+    children: Dict[int, List[int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        stat = _read_proc_stat(int(name))
+        if stat is not None:
+            children.setdefault(stat[0], []).append(int(name))
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def process_tree_usage(root_pid: int) -> Tuple[int, int]:
+    """(total rss_bytes, process count) of a process and all of its descendants."""
+    rss_total, count = 0, 0
+    for pid in _process_tree(root_pid):
+        stat = _read_proc_stat(pid)
+        if stat is not None:
+            rss_total += stat[2]
+            count += 1
+    return rss_total, count
+
+
+class ProcessSampler:
+    """
+    Periodically samples CPU time and RSS of a process tree from /proc and
+    attributes them to the workflow reported by `current_workflow`.
+    """
+
+    def __init__(self, pid: int, current_workflow: Callable[[], Optional[str]]):
+        self.pid = pid
+        self.current_workflow = current_workflow
+        self.available = os.path.isdir("/proc")
+        self.workflows: Dict[str, Dict[str, float]] = {}
+        self.peak_rss = 0
+        self._cpu_seen: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def start(self) -> None:
+        if self.available:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.to_thread(self.sample)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    def sample(self) -> None:
+        workflow = self.current_workflow() or "startup"
+        stats = self.workflows.setdefault(
+            workflow, {"cpu_seconds": 0.0, "peak_rss_bytes": 0}
+        )
+        rss_total = 0
+        for pid in _process_tree(self.pid):
+            stat = _read_proc_stat(pid)
+            if stat is None:
+                continue
+            _, cpu, rss = stat
+            rss_total += rss
+            stats["cpu_seconds"] += max(0.0, cpu - self._cpu_seen.get(pid, 0.0))
+            self._cpu_seen[pid] = cpu
+        stats["peak_rss_bytes"] = max(stats["peak_rss_bytes"], rss_total)
+        self.peak_rss = max(self.peak_rss, rss_total)
+
+    def total_cpu_seconds(self) -> float:
+        """CPU time of all waited-for children since the sampler was created."""
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        before = self._usage_before
+        return (usage.ru_utime - before.ru_utime) + (usage.ru_stime - before.ru_stime)
+
+
+def log_offset(target_path: str) -> int:
+    path = os.path.join(target_path, "logs", "indexing-engine.log")
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _llm_stats(target_path: str, offset: int) -> Dict[str, Dict[str, Any]]:
+    """LLM request count, latency and tokens per workflow, from this run's part of the log."""
+    path = os.path.join(target_path, "logs", "indexing-engine.log")
+    stats: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return stats
+    workflow = "startup"
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        f.seek(offset)
+        for line in f:
+            started = _LOG_WORKFLOW.search(line)
+            if started:
+                workflow = started.group(1)
+                continue
+            perf = _LLM_PERF.search(line)
+            if not perf:
+                continue
+            entry = stats.setdefault(
+                workflow,
+                {
+                    "requests": 0,
+                    "latency_total_s": 0.0,
+                    "latency_max_s": 0.0,
+                    "input_tokens": 0,
+                    "output_tokens": 0,
+                    "by_kind": {},
+                },
+            )
+            latency = float(perf.group(2))
+            entry["requests"] += 1
+            entry["latency_total_s"] += latency
+            entry["latency_max_s"] = max(entry["latency_max_s"], latency)
+            entry["input_tokens"] += int(perf.group(3))
+            entry["output_tokens"] += int(perf.group(4))
+            entry["by_kind"][perf.group(1)] = entry["by_kind"].get(perf.group(1), 0) + 1
+    for entry in stats.values():
+        entry["latency_avg_s"] = (
+            entry["latency_total_s"] / entry["requests"] if entry["requests"] else 0.0
+        )
+    return stats
+
+
+def _artifact_sizes(output_dir: str, since: float) -> Dict[str, int]:
+    sizes: Dict[str, int] = {}
+    if not os.path.isdir(output_dir):
+        return sizes
+    for dirpath, _, filenames in os.walk(output_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            if stat.st_mtime < since:
+                continue
+            # lancedb 等目录型产物按顶层目录汇总
+            rel = os.path.relpath(path, output_dir).split(os.sep)[0]
+            sizes[rel] = sizes.get(rel, 0) + stat.st_size
+    return sizes
+
+
+def _graphrag_stats(output_dir: str) -> Dict[str, Any]:
+    path = os.path.join(output_dir, "stats.json")
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def _graphrag_version() -> Optional[str]:
+    try:
+        from importlib.metadata import version
+
+        return version("graphrag")
+    except Exception:
+        return None
+
+
+def _total_cpu_seconds(sampler: Optional[ProcessSampler]) -> Optional[float]:
+    if sampler is None:
+        return None
+    if sampler.available and sampler.workflows:
+        return round(sum(w["cpu_seconds"] for w in sampler.workflows.values()), 3)
+    # 没有 /proc 时退回到所有已回收子进程的 rusage（可能包含并发的查询进程）
+    return round(sampler.total_cpu_seconds(), 3)
+
+
+def build_report(
+    job_id: str,
+    target_path: str,
+    started: float,
+    finished: float,
+    returncode: Optional[int],
+    sampler: Optional[ProcessSampler],
+    step_timings: Dict[str, float],
+    offset: int,
+    extra: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Assemble the machine-readable performance report of one indexing run."""
+    output_dir = os.path.join(target_path, "output")
+    graphrag_stats = _graphrag_stats(output_dir)
+    llm = _llm_stats(target_path, offset)
+    sampled = sampler.workflows if sampler is not None else {}
+    names = list(
+        dict.fromkeys(
+            [*step_timings, *graphrag_stats.get("workflows", {}), *sampled, *llm]
+        )
+    )
+    workflows = {}
+    for name in names:
+        graphrag_timing = graphrag_stats.get("workflows", {}).get(name, {})
+        workflows[name] = {
+            "wall_seconds": graphrag_timing.get("overall", step_timings.get(name)),
+            "cpu_seconds": round(sampled.get(name, {}).get("cpu_seconds", 0.0), 3),
+            "peak_rss_bytes": sampled.get(name, {}).get("peak_rss_bytes"),
+            "llm": llm.get(name),
+        }
+    return {
+        "job_id": job_id,
+        "kb": os.path.basename(os.path.normpath(target_path)),
+        "graphrag_version": _graphrag_version(),
+        "started": started,
+        "finished": finished,
+        "wall_seconds": round(finished - started, 3),
+        "cpu_seconds": _total_cpu_seconds(sampler),
+        "peak_rss_bytes": sampler.peak_rss if sampler and sampler.available else None,
+        "returncode": returncode,
+        "num_documents": graphrag_stats.get("num_documents"),
+        "workflows": workflows,
+        "llm_totals": {
+            key: sum(entry[key] for entry in llm.values())
+            for key in ("requests", "input_tokens", "output_tokens", "latency_total_s")
+        },
+        "artifact_bytes": _artifact_sizes(output_dir, started),
+        **(extra or {}),
+    }
+
+
+def save_report(target_path: str, report: Dict[str, Any]) -> str:
+    report_dir = os.path.join(target_path, REPORT_DIR)
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, f"{report['job_id']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    latest_tmp = os.path.join(target_path, f"{LATEST_REPORT}.tmp")
+    with open(latest_tmp, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    os.replace(latest_tmp, os.path.join(target_path, LATEST_REPORT))
+    return path
+
+
+def load_report(
+    target_path: str, job_id: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    if job_id is None:
+        path = os.path.join(target_path, LATEST_REPORT)
+    else:
+        path = os.path.join(target_path, REPORT_DIR, f"{os.path.basename(job_id)}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -1,119 +1,422 @@
 import asyncio
-from asyncio.subprocess import PIPE
 import json
 import os
+import re
 import time
 import uuid
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
-from utils import get_kb_root
+from utils import (
+    get_kb_root,
+    get_query_limits,
+    get_query_mode,
+    get_stream_flush_interval,
+)
+import engine
+from admission import Admission, query_admission
+from worker_pool import CHUNK, RESULT, worker_pool
+from result_cache import make_key, result_cache
+from streaming import TTFTRecorder, coalesce_deltas, read_text_chunks
+from lifecycle import ManagedProcess, QueryTimeout, execution_stats, with_deadline
+from metrics import QUERY_DURATION, QUERY_TTFT, error
 from models import ChatCompletionRequest
 from logger import get_logger
 
 logger = get_logger(__name__)
 
+# 回放缓存答案时每个 SSE 块包含的单词数
+REPLAY_WORDS_PER_CHUNK = 8
+
+
+def _new_completion_id() -> Tuple[str, int]:
+    return f"chatcmpl-{uuid.uuid4().hex}", int(time.time())
+
+
+def _completion_chunk(
+    request: ChatCompletionRequest,
+    content: Optional[str],
+    completion_id: str,
+    created: int,
+    finish_reason: Optional[str] = None,
+) -> str:
+    response_chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": request.model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {"content": content} if content is not None else {},
+                "finish_reason": finish_reason,
+            }
+        ],
+    }
+    return f"data: {json.dumps(response_chunk)}\n\n"
+
+
+def _completion(
+    request: ChatCompletionRequest, content: str, completion_id: str, created: int
+) -> str:
+    response = {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": request.model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"content": content},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+    return f"data: {json.dumps(response)}\n\n"
+
+
+def execution_mode(request: ChatCompletionRequest) -> str:
+    mode = get_query_mode()
+    if request.query_options.query_type not in engine.SUPPORTED_METHODS:
+        # 其他查询方法（如 drift）只能通过 graphrag CLI 执行
+        return "subprocess"
+    if mode == "pool" and not worker_pool.started:
+        return "inprocess"
+    return mode
+
+
+def _cache_key(request: ChatCompletionRequest, version: str) -> str:
+    query_options = request.query_options
+    return make_key(
+        query_options.selected_folder,
+        query_options.query_type,
+        query_options.community_level,
+        request.query,
+        request.model,
+        version,
+    )
+
+
+async def _admitted(admission: Admission, deltas):
+    try:
+        async with admission:
+            async for delta in deltas:
+                yield delta
+    finally:
+        admission.close()
+
+
+class _Flight:
+    """
+    A single in-flight query execution shared by every identical concurrent request.
+    The source runs in its own task; subscribers replay the deltas produced so far
+    and then follow new ones. The execution is cancelled once nobody is listening.
+    """
+
+    def __init__(self, key, source, on_complete=None):
+        self.key = key
+        self.deltas: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Condition()
+        self._task = asyncio.create_task(self._produce(source, on_complete))
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _produce(self, source, on_complete) -> None:
+        execution_stats["started"] += 1
+        try:
+            async for delta in with_deadline(source, get_query_limits()["timeout"]):
+                self.deltas.append(delta)
+                await self._notify()
+            if on_complete is not None:
+                await on_complete("".join(self.deltas))
+            execution_stats["completed"] += 1
+        except asyncio.CancelledError as e:
+            execution_stats["cancelled"] += 1
+            self.error = e
+        except QueryTimeout as e:
+            execution_stats["timed_out"] += 1
+            logger.warning(f"GraphRAG query timed out: {str(e)}")
+            self.error = e
+        except Exception as e:
+            execution_stats["failed"] += 1
+            self.error = e
+        finally:
+            await source.aclose()
+            self.done = True
+            if _inflight.get(self.key) is self:
+                del _inflight[self.key]
+            await self._notify()
+
+    async def subscribe(self):
+        # 开始迭代时才计数：从未被迭代的响应不会留下无法减回的计数
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                if position < len(self.deltas):
+                    position += 1
+                    yield self.deltas[position - 1]
+                    continue
+                if self.done:
+                    break
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda: position < len(self.deltas) or self.done
+                    )
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                logger.info("All clients left, cancelling GraphRAG query")
+                self._task.cancel()
+
+
+_inflight: Dict[Tuple[str, bool], _Flight] = {}
+_coalescing_stats = {"coalesced": 0}
+
+
+def coalescing_stats() -> Dict[str, int]:
+    return {"in_flight": len(_inflight), **_coalescing_stats}
+
+
+async def _format_sse(
+    request: ChatCompletionRequest, deltas, source: str, started: float
+):
+    """
+    Turn an answer's text deltas into OpenAI-style SSE events. When streaming,
+    deltas are forwarded as they arrive (coalesced on STREAM_FLUSH_INTERVAL) under
+    one completion id; otherwise a single completion is sent at the end.
+    `source` (cache, coalesced or executed) and `started` only feed the metrics.
+    """
+    completion_id, created = _new_completion_id()
+    kb = request.query_options.selected_folder
+    query_type = request.query_options.query_type
+    ttft = TTFTRecorder(f"'{kb}'", started)
+    try:
+        if request.stream:
+            async for delta in coalesce_deltas(deltas, get_stream_flush_interval()):
+                ttft.mark()
+                yield _completion_chunk(request, delta, completion_id, created)
+            yield _completion_chunk(request, None, completion_id, created, "stop")
+        else:
+            parts = []
+            async for delta in deltas:
+                ttft.mark()
+                parts.append(delta)
+            yield _completion(request, "".join(parts), completion_id, created)
+    except Exception as e:
+        # 响应头已经发出，只能以 SSE 错误事件告知客户端
+        message = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"GraphRAG query failed mid-stream: {message}")
+        error("query_timeout" if isinstance(e, QueryTimeout) else "query_failed")
+        yield f"data: {json.dumps({'error': {'message': message, 'type': type(e).__name__}})}\n\n"
+        return
+    # 只在流结束时记录一次，不给每个分块增加开销
+    if ttft.ttft is not None:
+        QUERY_TTFT.observe(ttft.ttft, kb, query_type)
+    QUERY_DURATION.observe(time.perf_counter() - started, kb, query_type, source)
+    yield "data: [DONE]\n\n"
+
+
+async def _replay_deltas(answer: str):
+    """Re-emit a cached answer in small word-aligned pieces."""
+    words = re.findall(r"\S+\s*|\s+", answer)
+    for i in range(0, len(words), REPLAY_WORDS_PER_CHUNK):
+        yield "".join(words[i : i + REPLAY_WORDS_PER_CHUNK])
+
 
 async def run_graphrag_query(
     request: ChatCompletionRequest, kb_root: str = get_kb_root()
 ) -> StreamingResponse:
     """
     Execute a GraphRAG query and return results as a streaming response.
+    Answers are served from the result cache when possible. Otherwise queries run
+    in-process against a warm knowledge base context, on the warm worker pool, or
+    through the graphrag CLI depending on QUERY_MODE, after taking a slot in the
+    admission queue.
     Args:
         request (ChatCompletionRequest): The request object containing query options and messages.
     Returns:
         StreamingResponse: A streaming response containing query results in SSE format.
     Raises:
-        HTTPException: If the query execution fails or encounters an error.
+        HTTPException: If the query execution fails or encounters an error,
+            or 429/503 with Retry-After when the admission queue is full.
     """
-    try:
-        # Extract query options and the latest message content
-        query_options = request.query_options
-        # query = request.messages[-1].content
-        query = request.query
-        # Build the GraphRAG CLI command with required arguments
-        cmd = ["graphrag", "query"]
-        target_path = os.path.join(kb_root, query_options.selected_folder)
-        cmd.extend(["--root", target_path])
-        cmd.extend(["--query", f"{query}"])
-        cmd.extend(["--data", f"{target_path}/output"])
-        cmd.extend(["--method", query_options.query_type])  # 'global' or 'local'
-        # Add streaming flag if specified
-        if request.stream:
-            cmd.append("--streaming")
-        # Add optional command arguments if specified
-        if query_options.community_level:
-            cmd.extend(["--community-level", str(query_options.community_level)])
-        # if query_options.response_type:
-        #     cmd.extend(["--response-type", query_options.response_type])
-        # if query_options.custom_cli_args:
-        #     cmd.extend(query_options.custom_cli_args.split())
-        logger.info(f"Executing GraphRAG query: {' '.join(cmd)}")
-
-        async def generate_response():
-            process = await asyncio.create_subprocess_exec(
-                *cmd, stdout=PIPE, stderr=PIPE
-            )
+    started = time.perf_counter()
+    deltas, source = await _start_query(request, kb_root)
+    return StreamingResponse(
+        _format_sse(request, deltas, source, started),
+        media_type="text/event-stream; charset=utf-8",
+    )
+
+
+async def query_deltas(request: ChatCompletionRequest, kb_root: str = get_kb_root()):
+    """
+    Text deltas of a GraphRAG answer, for callers inside the API that build on it.
+    Goes through the same result cache, coalescing and admission queue as
+    run_graphrag_query. Setup errors raise HTTPException here; errors during
+    execution are raised while iterating.
+    """
+    deltas, _ = await _start_query(request, kb_root)
+    return deltas
+
 
-            async def read_stream(stream):
-                while True:
-                    line = await stream.readline()
-                    if not line:
-                        break
-                    yield line.decode().strip()
-
-            if request.stream:
-                # 流式处理模式
-                async for line in read_stream(process.stdout):
-                    response_chunk = {
-                        "id": f"chatcmpl-{uuid.uuid4().hex}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": request.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {"content": line},
-                                "finish_reason": None,
-                            }
-                        ],
-                    }
-                    yield f"data: {json.dumps(response_chunk)}\n\n"
+async def _start_query(
+    request: ChatCompletionRequest, kb_root: str
+) -> Tuple[AsyncIterator[str], str]:
+    """The answer's deltas and where they come from (cache, coalesced or executed)."""
+    query_options = request.query_options
+    selected_folder = query_options.selected_folder
+    # 索引版本只用于结果缓存；合并进行中的相同查询不需要区分版本
+    version = ""
+    if result_cache.enabled:
+        version = await result_cache.index_version(selected_folder)
+    key = _cache_key(request, version)
+    on_complete = None
+    if result_cache.enabled:
+        cached = await result_cache.get(key)
+        if cached is not None:
+            logger.info(f"Serving cached GraphRAG answer for '{selected_folder}'")
+            return _replay_deltas(cached), "cache"
+
+        async def on_complete(answer: str):
+            if answer:
+                await result_cache.set(key, selected_folder, answer)
+
+    flight_key = (key, request.stream)
+    flight = _inflight.get(flight_key)
+    source = "executed" if flight is None else "coalesced"
+    if flight is None:
+        try:
+            admission = query_admission.admit(selected_folder)
+        except HTTPException:
+            error("query_rejected")
+            raise
+        try:
+            mode = execution_mode(request)
+            if mode == "inprocess":
+                # 先占用执行槽位再加载知识库，冷加载也受并发上限约束；
+                # 在返回流之前加载，使加载错误能以正常的 HTTP 错误返回
+                await admission.acquire()
+                await engine.get_kb_context(selected_folder)
+                deltas = _inprocess_deltas(request)
+            elif mode == "pool":
+                deltas = _pool_deltas(request)
             else:
-                # 非流式处理模式，收集所有输出后一次性返回
-                full_response = []
-                async for line in read_stream(process.stdout):
-                    full_response.append(line)
-                response = {
-                    "id": f"chatcmpl-{uuid.uuid4().hex}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": request.model,
-                    "choices": [
-                        {
-                            "index": 0,
-                            "message": {"content": "\n".join(full_response)},
-                            "finish_reason": "stop",
-                        }
-                    ],
-                }
-                yield f"data: {json.dumps(response)}\n\n"
-            await process.wait()
-            if process.returncode != 0:
-                error_message = await process.stderr.read()
-                logger.error(f"GraphRAG query failed: {error_message.decode()}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"GraphRAG query failed: {error_message.decode()}",
-                )
-            yield "data: [DONE]\n\n"
-
-        return StreamingResponse(
-            generate_response(), media_type="text/event-stream; charset=utf-8"
-        )
-    except Exception as e:
-        # Log and re-raise any unexpected errors
-        logger.error(f"Error in GraphRAG query: {str(e)}")
+                deltas = _subprocess_deltas(request, kb_root)
+        except asyncio.CancelledError:
+            admission.close()
+            raise
+        except FileNotFoundError as e:
+            admission.close()
+            error("kb_not_found")
+            raise HTTPException(status_code=404, detail=str(e))
+        except Exception as e:
+            admission.close()
+            error("query_setup_failed")
+            # Log and re-raise any unexpected errors
+            logger.error(f"Error in GraphRAG query: {str(e)}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"An error occurred during the GraphRAG query: {str(e)}",
+            )
+        # 加载知识库期间可能已有相同的请求开始执行
+        flight = _inflight.get(flight_key)
+        if flight is None:
+            flight = _Flight(flight_key, _admitted(admission, deltas), on_complete)
+            _inflight[flight_key] = flight
+        else:
+            admission.close()
+            await deltas.aclose()
+    else:
+        _coalescing_stats["coalesced"] += 1
+        logger.info(f"Joining in-flight GraphRAG query on '{selected_folder}'")
+    return flight.subscribe(), source
+
+
+async def _pool_deltas(request: ChatCompletionRequest):
+    query_options = request.query_options
+    job = {
+        "selected_folder": query_options.selected_folder,
+        "query_type": query_options.query_type,
+        "community_level": query_options.community_level,
+        "query": request.query,
+        "stream": request.stream,
+    }
+    async for kind, payload in worker_pool.run(job):
+        if kind in (CHUNK, RESULT):
+            yield payload
+
+
+async def _inprocess_deltas(request: ChatCompletionRequest):
+    query_options = request.query_options
+    logger.info(
+        f"Executing in-process GraphRAG {query_options.query_type} query "
+        f"on '{query_options.selected_folder}'"
+    )
+    args = (
+        query_options.selected_folder,
+        query_options.query_type,
+        query_options.community_level,
+        request.query,
+    )
+    if request.stream:
+        async for chunk in engine.stream_search(*args):
+            yield chunk
+    else:
+        yield await engine.search(*args)
+
+
+def _build_query_cmd(request: ChatCompletionRequest, kb_root: str):
+    # Extract query options and the latest message content
+    query_options = request.query_options
+    # query = request.messages[-1].content
+    query = request.query
+    # Build the GraphRAG CLI command with required arguments
+    cmd = ["graphrag", "query"]
+    target_path = os.path.join(kb_root, query_options.selected_folder)
+    cmd.extend(["--root", target_path])
+    cmd.extend(["--query", f"{query}"])
+    cmd.extend(["--data", f"{target_path}/output"])
+    cmd.extend(["--method", query_options.query_type])  # 'global' or 'local'
+    # Add streaming flag if specified
+    if request.stream:
+        cmd.append("--streaming")
+    # Add optional command arguments if specified
+    if query_options.community_level:
+        cmd.extend(["--community-level", str(query_options.community_level)])
+    # if query_options.response_type:
+    #     cmd.extend(["--response-type", query_options.response_type])
+    # if query_options.custom_cli_args:
+    #     cmd.extend(query_options.custom_cli_args.split())
+    return cmd
+
+
+async def _subprocess_deltas(request: ChatCompletionRequest, kb_root: str):
+    cmd = _build_query_cmd(request, kb_root)
+    logger.info(f"Executing GraphRAG query: {' '.join(cmd)}")
+    # 关闭子进程的输出缓冲，使 token 一生成就能被读到
+    env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+    process = await ManagedProcess.start(*cmd, env=env)
+    try:
+        async for text in read_text_chunks(process.stdout):
+            yield text
+        await process.wait()
+    finally:
+        if process.returncode is None:
+            # 客户端已离开或查询超时，停止仍在消耗 LLM token 的查询进程组
+            logger.info("Query abandoned, terminating graphrag process group")
+            await process.terminate(get_query_limits()["kill_grace"])
+    if process.returncode != 0:
+        error_message = process.stderr_text()
+        logger.error(f"GraphRAG query failed: {error_message}")
         raise HTTPException(
             status_code=500,
-            detail=f"An error occurred during the GraphRAG query: {str(e)}",
+            detail=f"GraphRAG query failed: {error_message}",
         )
@@ -0,0 +1,530 @@
+import asyncio
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from utils import get_rate_limit_settings, normalize_api_base
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 没有配置上限的维度不做限制
+UNLIMITED = 0
+# 粗略的 token 估算：约 4 个字符一个 token
+CHARS_PER_TOKEN = 4
+LATENCY_WEIGHT = 0.2
+# 成功调用的结果在内存中累积，按此间隔合并成一次写事务
+FLUSH_INTERVAL = 1.0
+# 不限速判断缓存的秒数，其他进程修改上限后最多这么久生效
+LIMITS_TTL = 5.0
+MAX_PENDING_LATENCIES = 100
+
+
+def estimate_tokens(messages: Any, max_tokens: int = 0) -> int:
+    """Prompt tokens of chat messages (or a plain string) plus the completion allowance."""
+    if isinstance(messages, str):
+        text = messages
+    else:
+        text = "".join(str(m.get("content", "")) for m in messages)
+    return len(text) // CHARS_PER_TOKEN + (max_tokens or 0)
+
+
+def _status_of(exc: BaseException) -> Optional[int]:
+    # openai / httpx 的异常都带有 status_code 或 response.status_code
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+class RateLimiter:
+    """
+    Token buckets for requests/min and tokens/min per (api_base, model), kept in
+    SQLite so every API worker and query worker draws from the same budget.
+
+    Interactive callers (in-process queries) take from the bucket directly.
+    Background indexing runs in graphrag subprocesses the API cannot intercept, so
+    each job leases a share of the budget that is written into its settings.yaml
+    and that share is withheld from interactive callers while the job runs; the
+    rest is always reserved for queries. Limits adapt AIMD-style: every 429 cuts
+    the effective rate multiplicatively, every success adds a little back.
+    Unlimited budgets skip the database on acquire, and successes, latencies and
+    usage are buffered in memory and written once per FLUSH_INTERVAL.
+    All methods except the async ones are blocking.
+    """
+
+    def __init__(self, path: str, settings: Dict[str, float]):
+        self.path = path
+        self.settings = settings
+        self._limits: Dict[Tuple[str, str], Tuple[float, bool]] = {}
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "api_base TEXT NOT NULL, model TEXT NOT NULL, "
+                "rpm REAL NOT NULL, tpm REAL NOT NULL, factor REAL NOT NULL, "
+                "requests REAL NOT NULL, tokens REAL NOT NULL, updated REAL NOT NULL, "
+                "last_decrease REAL NOT NULL DEFAULT 0, "
+                "total_requests INTEGER NOT NULL DEFAULT 0, "
+                "total_tokens INTEGER NOT NULL DEFAULT 0, "
+                "throttled INTEGER NOT NULL DEFAULT 0, "
+                "rate_limited INTEGER NOT NULL DEFAULT 0, latency REAL, "
+                "PRIMARY KEY (api_base, model))"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(buckets)")}
+            if "latency" not in columns:
+                conn.execute("ALTER TABLE buckets ADD COLUMN latency REAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "id TEXT PRIMARY KEY, api_base TEXT NOT NULL, model TEXT NOT NULL, "
+                "owner TEXT, rpm REAL NOT NULL, tpm REAL NOT NULL, "
+                "expires REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def key(api_base: Optional[str], model: Optional[str]) -> Tuple[str, str]:
+        return normalize_api_base(api_base or ""), model or ""
+
+    def _transaction(self, fn, *args):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = fn(conn, *args)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _bucket(self, conn: sqlite3.Connection, key: Tuple[str, str]) -> sqlite3.Row:
+        row = conn.execute(
+            "SELECT * FROM buckets WHERE api_base = ? AND model = ?", key
+        ).fetchone()
+        if row is None:
+            # 新桶从满开始，_refill 会把余量截断到桶容量
+            conn.execute(
+                "INSERT INTO buckets (api_base, model, rpm, tpm, factor, requests, "
+                "tokens, updated) VALUES (?, ?, ?, ?, 1, ?, ?, ?)",
+                (
+                    *key,
+                    self.settings["rpm"],
+                    self.settings["tpm"],
+                    self.settings["rpm"],
+                    self.settings["tpm"],
+                    time.time(),
+                ),
+            )
+            row = conn.execute(
+                "SELECT * FROM buckets WHERE api_base = ? AND model = ?", key
+            ).fetchone()
+        return row
+
+    def _leased(self, conn: sqlite3.Connection, key: Tuple[str, str]):
+        now = time.time()
+        conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+        return conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(rpm), 0), COALESCE(SUM(tpm), 0) "
+            "FROM leases WHERE api_base = ? AND model = ?",
+            key,
+        ).fetchone()
+
+    def _capacity(self, row: sqlite3.Row, leased_rpm: float, leased_tpm: float):
+        """Per-minute request and token rates left for interactive callers."""
+        reserve = 1 - self.settings["background_share"]
+
+        def interactive(limit: float, leased: float) -> float:
+            if limit == UNLIMITED:
+                return UNLIMITED
+            effective = limit * row["factor"]
+            return max(effective - leased, effective * reserve)
+
+        return interactive(row["rpm"], leased_rpm), interactive(row["tpm"], leased_tpm)
+
+    def _refill(self, row: sqlite3.Row, rpm: float, tpm: float, now: float):
+        burst = self.settings["burst_seconds"] / 60
+        elapsed = max(0.0, now - row["updated"])
+        # 桶至少能容纳一个请求，否则很低的 rpm 永远凑不满一个请求
+        size, token_size = max(rpm * burst, 1.0), tpm * burst
+        requests = min(size, row["requests"] + elapsed * rpm / 60)
+        tokens = min(token_size, row["tokens"] + elapsed * tpm / 60)
+        return max(requests, 0.0), max(tokens, 0.0), token_size
+
+    def _try_acquire(self, conn, key: Tuple[str, str], tokens: int) -> float:
+        row = self._bucket(conn, key)
+        _, leased_rpm, leased_tpm = self._leased(conn, key)
+        rpm, tpm = self._capacity(row, leased_rpm, leased_tpm)
+        now = time.time()
+        available, available_tokens, token_size = self._refill(row, rpm, tpm, now)
+        # 单个请求的 token 估算可能超过桶容量，桶满时也允许通过
+        needed = min(tokens, token_size) if tpm != UNLIMITED else 0
+        wait = 0.0
+        if rpm != UNLIMITED and available < 1:
+            wait = (1 - available) * 60 / rpm
+        if needed and available_tokens < needed:
+            wait = max(wait, (needed - available_tokens) * 60 / tpm)
+        if wait > 0:
+            conn.execute(
+                "UPDATE buckets SET requests = ?, tokens = ?, updated = ?, "
+                "throttled = throttled + 1 WHERE api_base = ? AND model = ?",
+                (available, available_tokens, now, *key),
+            )
+            return wait
+        conn.execute(
+            "UPDATE buckets SET requests = ?, tokens = ?, updated = ?, "
+            "total_requests = total_requests + 1, total_tokens = total_tokens + ? "
+            "WHERE api_base = ? AND model = ?",
+            (
+                available - 1 if rpm != UNLIMITED else 0,
+                available_tokens - needed,
+                now,
+                tokens,
+                *key,
+            ),
+        )
+        return 0.0
+
+    def _is_unlimited(self, key: Tuple[str, str]) -> bool:
+        row = None
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT rpm, tpm FROM buckets WHERE api_base = ? AND model = ?", key
+            ).fetchone()
+        finally:
+            conn.close()
+        rpm, tpm = (
+            (row["rpm"], row["tpm"])
+            if row is not None
+            else (self.settings["rpm"], self.settings["tpm"])
+        )
+        return rpm == UNLIMITED and tpm == UNLIMITED
+
+    async def _unlimited(self, key: Tuple[str, str]) -> bool:
+        cached = self._limits.get(key)
+        if cached is None or time.monotonic() - cached[0] > LIMITS_TTL:
+            unlimited = await asyncio.to_thread(self._is_unlimited, key)
+            cached = self._limits[key] = (time.monotonic(), unlimited)
+        return cached[1]
+
+    def _pending_for(self, key: Tuple[str, str]) -> Dict[str, Any]:
+        pending = self._pending.setdefault(
+            key, {"successes": 0, "latencies": [], "requests": 0, "tokens": 0}
+        )
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return pending
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write buffered usage and latency samples to the shared buckets."""
+        pending, self._pending = self._pending, {}
+        for key, values in pending.items():
+            try:
+                await asyncio.to_thread(
+                    self._transaction,
+                    self._record,
+                    key,
+                    False,
+                    values["latencies"],
+                    values["successes"],
+                    values["requests"],
+                    values["tokens"],
+                )
+            except Exception as e:
+                logger.error(f"Failed to record LLM usage for {key}: {str(e)}")
+
+    async def acquire(
+        self, api_base: Optional[str], model: Optional[str], tokens: int
+    ) -> None:
+        """Wait until a request of about `tokens` tokens fits the interactive budget."""
+        key = self.key(api_base, model)
+        if await self._unlimited(key):
+            # 不限速时只在内存中计数，不占用数据库写锁
+            pending = self._pending_for(key)
+            pending["requests"] += 1
+            pending["tokens"] += tokens
+            return
+        while True:
+            wait = await asyncio.to_thread(
+                self._transaction, self._try_acquire, key, tokens
+            )
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, self.settings["max_sleep"]))
+
+    def _record(
+        self,
+        conn,
+        key: Tuple[str, str],
+        rate_limited: bool,
+        latencies: List[float],
+        successes: int = 0,
+        requests: int = 0,
+        tokens: int = 0,
+    ) -> None:
+        row = self._bucket(conn, key)
+        now = time.time()
+        if latencies:
+            # 指数移动平均，供索引自动调优估算所需并发
+            latency = row["latency"]
+            for sample in latencies:
+                latency = (
+                    sample
+                    if latency is None
+                    else latency * (1 - LATENCY_WEIGHT) + sample * LATENCY_WEIGHT
+                )
+            conn.execute(
+                "UPDATE buckets SET latency = ? WHERE api_base = ? AND model = ?",
+                (latency, *key),
+            )
+        if requests:
+            conn.execute(
+                "UPDATE buckets SET total_requests = total_requests + ?, "
+                "total_tokens = total_tokens + ? WHERE api_base = ? AND model = ?",
+                (requests, tokens, *key),
+            )
+        if rate_limited:
+            # 同一波 429 只降一次，避免并发请求把速率一下子压到最低
+            if now - row["last_decrease"] < self.settings["cooldown"]:
+                factor = row["factor"]
+            else:
+                factor = max(
+                    self.settings["min_factor"],
+                    row["factor"] * self.settings["decrease"],
+                )
+                logger.warning(
+                    f"Rate limited by {key[0]} ({key[1]}), "
+                    f"scaling budget to {factor:.0%}"
+                )
+            conn.execute(
+                "UPDATE buckets SET factor = ?, last_decrease = ?, requests = 0, "
+                "rate_limited = rate_limited + 1 WHERE api_base = ? AND model = ?",
+                (
+                    factor,
+                    now if factor != row["factor"] else row["last_decrease"],
+                    *key,
+                ),
+            )
+        elif successes and row["factor"] < 1:
+            conn.execute(
+                "UPDATE buckets SET factor = MIN(1.0, factor + ?) "
+                "WHERE api_base = ? AND model = ?",
+                (self.settings["increase"] * successes, *key),
+            )
+
+    async def record(
+        self,
+        api_base: Optional[str],
+        model: Optional[str],
+        rate_limited: bool,
+        latency: Optional[float] = None,
+    ) -> None:
+        """
+        Feed the outcome (and duration) of one provider call into the budget.
+        429s are written at once; successes are batched.
+        """
+        key = self.key(api_base, model)
+        latencies = [latency] if latency is not None else []
+        if rate_limited:
+            await asyncio.to_thread(
+                self._transaction, self._record, key, True, latencies
+            )
+            return
+        pending = self._pending_for(key)
+        pending["successes"] += 1
+        if latency is not None:
+            pending["latencies"].append(latency)
+            del pending["latencies"][:-MAX_PENDING_LATENCIES]
+
+    def latency(self, api_base: Optional[str], model: Optional[str]) -> Optional[float]:
+        """Moving average of observed call duration in seconds, if any was recorded."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT latency FROM buckets WHERE api_base = ? AND model = ?",
+                self.key(api_base, model),
+            ).fetchone()
+        finally:
+            conn.close()
+        return row["latency"] if row is not None else None
+
+    def _lease_share(self, conn, key: Tuple[str, str]) -> Tuple[float, float]:
+        row = self._bucket(conn, key)
+        count, _, _ = self._leased(conn, key)
+        share = self.settings["background_share"] * row["factor"] / (count + 1)
+        return row["rpm"] * share, row["tpm"] * share
+
+    def _lease(self, conn, key: Tuple[str, str], owner: str) -> Dict[str, Any]:
+        rpm, tpm = self._lease_share(conn, key)
+        lease = {"id": str(uuid.uuid4()), "rpm": rpm, "tpm": tpm}
+        conn.execute(
+            "INSERT INTO leases VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                lease["id"],
+                *key,
+                owner,
+                lease["rpm"],
+                lease["tpm"],
+                time.time() + self.settings["lease_ttl"],
+            ),
+        )
+        return lease
+
+    def _renew(self, lease_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE leases SET expires = ? WHERE id = ?",
+                (time.time() + self.settings["lease_ttl"], lease_id),
+            )
+
+    def _release(self, lease_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM leases WHERE id = ?", (lease_id,))
+
+    @asynccontextmanager
+    async def background_lease(
+        self, api_base: Optional[str], model: Optional[str], owner: str
+    ):
+        """
+        Reserve a share of the budget for a background job for as long as the
+        context is open. Yields the lease's requests/min and tokens/min (0 means
+        unlimited) for the job to configure its own client-side limiter with.
+        """
+        key = self.key(api_base, model)
+        lease = await asyncio.to_thread(self._transaction, self._lease, key, owner)
+
+        async def renew():
+            while True:
+                await asyncio.sleep(self.settings["lease_ttl"] / 3)
+                await asyncio.to_thread(self._renew, lease["id"])
+
+        task = asyncio.create_task(renew())
+        try:
+            yield lease
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await asyncio.to_thread(self._release, lease["id"])
+
+    def _set_limits(self, conn, key: Tuple[str, str], rpm: float, tpm: float):
+        self._bucket(conn, key)
+        conn.execute(
+            "UPDATE buckets SET rpm = ?, tpm = ?, factor = 1 "
+            "WHERE api_base = ? AND model = ?",
+            (rpm, tpm, *key),
+        )
+
+    def set_limits(self, api_base: str, model: str, rpm: float, tpm: float) -> None:
+        key = self.key(api_base, model)
+        self._transaction(self._set_limits, key, rpm, tpm)
+        self._limits.pop(key, None)
+
+    def usage(self) -> List[Dict[str, Any]]:
+        """Live budget per (api_base, model): limits, adaptation, leases and usage."""
+        conn = self._connect()
+        try:
+            now = time.time()
+            conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            leases: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+            for lease in conn.execute("SELECT * FROM leases").fetchall():
+                leases.setdefault((lease["api_base"], lease["model"]), []).append(
+                    {k: lease[k] for k in ("id", "owner", "rpm", "tpm", "expires")}
+                )
+            result = []
+            for row in conn.execute("SELECT * FROM buckets").fetchall():
+                key = (row["api_base"], row["model"])
+                active = leases.get(key, [])
+                rpm, tpm = self._capacity(
+                    row, sum(l["rpm"] for l in active), sum(l["tpm"] for l in active)
+                )
+                requests, tokens, _ = self._refill(row, rpm, tpm, now)
+                result.append(
+                    {
+                        "api_base": row["api_base"],
+                        "model": row["model"],
+                        "rpm": row["rpm"],
+                        "tpm": row["tpm"],
+                        "factor": round(row["factor"], 4),
+                        "interactive_rpm": rpm,
+                        "interactive_tpm": tpm,
+                        "available_requests": requests if rpm else None,
+                        "available_tokens": tokens if tpm else None,
+                        "leases": active,
+                        "total_requests": row["total_requests"],
+                        "total_tokens": row["total_tokens"],
+                        "throttled": row["throttled"],
+                        "rate_limited": row["rate_limited"],
+                        "latency": row["latency"],
+                    }
+                )
+            return result
+        finally:
+            conn.close()
+
+
+class RateLimitedLLM:
+    """
+    Wraps a graphrag query LLM so each call first takes its share of the
+    (api_base, model) budget and reports 429s back to the limiter.
+    """
+
+    def __init__(self, llm: Any, api_base: Optional[str], model: Optional[str]):
+        self.llm = llm
+        self.api_base = api_base
+        self.model = model
+
+    def __getattr__(self, name: str):
+        return getattr(self.llm, name)
+
+    async def _call(self, messages, kwargs: Dict[str, Any]) -> None:
+        tokens = estimate_tokens(messages, kwargs.get("max_tokens", 0))
+        await rate_limiter.acquire(self.api_base, self.model, tokens)
+
+    async def _report(
+        self, exc: Optional[BaseException], started: Optional[float] = None
+    ) -> None:
+        rate_limited = exc is not None and _status_of(exc) == 429
+        if exc is None or rate_limited:
+            latency = time.perf_counter() - started if exc is None else None
+            await rate_limiter.record(self.api_base, self.model, rate_limited, latency)
+
+    async def agenerate(self, messages, *args, **kwargs):
+        await self._call(messages, kwargs)
+        started = time.perf_counter()
+        try:
+            result = await self.llm.agenerate(messages, *args, **kwargs)
+        except Exception as e:
+            await self._report(e)
+            raise
+        await self._report(None, started)
+        return result
+
+    async def astream_generate(self, messages, *args, **kwargs):
+        await self._call(messages, kwargs)
+        started = time.perf_counter()
+        try:
+            async for chunk in self.llm.astream_generate(messages, *args, **kwargs):
+                yield chunk
+        except Exception as e:
+            await self._report(e)
+            raise
+        await self._report(None, started)
+
+
+_settings = get_rate_limit_settings()
+rate_limiter = RateLimiter(_settings["path"], _settings)
@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from kb_cache import SIGNATURE_CHECK_INTERVAL, output_signature
+from utils import get_result_cache_settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """Case-fold and collapse whitespace so trivially different phrasings share an entry."""
+    return re.sub(r"\s+", " ", query).strip().casefold()
+
+
+def make_key(
+    selected_folder: str,
+    query_type: str,
+    community_level: Optional[int],
+    query: str,
+    model: str,
+    version: str,
+) -> str:
+    payload = json.dumps(
+        [
+            selected_folder,
+            query_type,
+            community_level,
+            normalize_query(query),
+            model,
+            version,
+        ]
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[2] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, kb: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (kb, value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_kb(self, kb: str) -> int:
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry[0] == kb]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def size(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_results ("
+                "key TEXT PRIMARY KEY, kb TEXT NOT NULL, value TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_query_results_kb ON query_results (kb)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_query_results_accessed "
+                "ON query_results (accessed)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, created FROM query_results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                conn.execute("DELETE FROM query_results WHERE key = ?", (key,))
+                return None
+            conn.execute(
+                "UPDATE query_results SET accessed = ? WHERE key = ?", (now, key)
+            )
+            return row[0]
+
+    def set(self, key: str, kb: str, value: str) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO query_results VALUES (?, ?, ?, ?, ?)",
+                (key, kb, value, now, now),
+            )
+            conn.execute(
+                "DELETE FROM query_results WHERE created < ?", (now - self.ttl,)
+            )
+            conn.execute(
+                "DELETE FROM query_results WHERE key IN (SELECT key FROM query_results "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def invalidate_kb(self, kb: str) -> int:
+        with self._connect() as conn:
+            return conn.execute(
+                "DELETE FROM query_results WHERE kb = ?", (kb,)
+            ).rowcount
+
+    def size(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM query_results").fetchone()[0]
+
+
+class ResultCache:
+    """Cache of final query answers keyed by KB, query options, query and index version."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        # kb -> (检查时间, 版本)，与 KBCache 的签名检查使用相同的间隔
+        self._versions: Dict[str, Tuple[float, str]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    async def index_version(self, kb: str) -> str:
+        """
+        A short hash of the KB's output artifacts; changes whenever the KB is
+        re-indexed. The directory is scanned off the event loop, at most every
+        SIGNATURE_CHECK_INTERVAL seconds per KB.
+        """
+        now = time.monotonic()
+        cached = self._versions.get(kb)
+        if cached is not None and now - cached[0] < SIGNATURE_CHECK_INTERVAL:
+            return cached[1]
+        signature = await asyncio.to_thread(output_signature, kb)
+        version = hashlib.sha1(repr(signature).encode()).hexdigest()[:16]
+        self._versions[kb] = (now, version)
+        return version
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await asyncio.to_thread(self.backend.get, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, kb: str, value: str) -> None:
+        try:
+            await asyncio.to_thread(self.backend.set, key, kb, value)
+        except Exception as e:
+            logger.error(f"Failed to store query result: {str(e)}")
+
+    def invalidate_kb(self, kb: str) -> None:
+        self._versions.pop(kb, None)
+        if self.enabled:
+            removed = self.backend.invalidate_kb(kb)
+            logger.info(f"Invalidated {removed} cached query results for '{kb}'")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__ if self.enabled else None,
+            "entries": self.backend.size() if self.enabled else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def _create_backend(settings: Dict[str, Any]):
+    backend = settings["backend"]
+    if backend == "memory":
+        return MemoryBackend(settings["max_entries"], settings["ttl"])
+    if backend == "sqlite":
+        return SQLiteBackend(settings["path"], settings["max_entries"], settings["ttl"])
+    return None
+
+
+result_cache = ResultCache(_create_backend(get_result_cache_settings()))
@@ -0,0 +1,152 @@
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, List, Optional
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# <kb>/output 下的快照目录，每张表一个未压缩的 Arrow IPC 文件，可直接 mmap
+SNAPSHOT_DIR = "snapshot"
+FORMAT_VERSION = 1
+# 查询从不读取的大列
+DROP_COLUMNS = {
+    "community_reports": ["full_content_json"],
+    "entities": ["graph_embedding"],
+    "nodes": ["graph_embedding"],
+}
+# 长文本列以 Arrow 字符串保留在映射内存中，不转换为 Python 对象
+TEXT_COLUMNS = {
+    "community_reports": ["full_content", "summary"],
+    "text_units": ["text"],
+    "entities": ["description"],
+    "relationships": ["description"],
+}
+# 重复度高的引用列按字典编码存储
+DICTIONARY_COLUMNS = {
+    "entities": ["type"],
+    "relationships": ["source", "target"],
+}
+
+
+def _artifacts() -> Dict[str, str]:
+    from engine import ARTIFACTS, OPTIONAL_ARTIFACTS
+
+    return {**ARTIFACTS, **OPTIONAL_ARTIFACTS}
+
+
+def _source_fingerprint(output_dir: str) -> List[Any]:
+    """(file, mtime_ns, size) of the parquet artifacts the snapshot was taken from."""
+    fingerprint = []
+    for filename in sorted(_artifacts().values()):
+        try:
+            stat = os.stat(os.path.join(output_dir, filename))
+        except FileNotFoundError:
+            continue
+        fingerprint.append([filename, stat.st_mtime_ns, stat.st_size])
+    return fingerprint
+
+
+def _compact(name: str, table):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    drop = [c for c in DROP_COLUMNS.get(name, []) if c in table.column_names]
+    table = table.drop(drop)
+    for index, field in enumerate(table.schema):
+        column = table.column(index)
+        if field.name in TEXT_COLUMNS.get(name, []):
+            column = pc.fill_null(column.cast(pa.string()), "")
+        elif field.name in DICTIONARY_COLUMNS.get(name, []):
+            column = column.dictionary_encode()
+        elif field.name.endswith("_embedding") and pa.types.is_list(field.type):
+            # 向量按 float32 连续存放
+            column = column.cast(pa.list_(pa.float32()))
+        else:
+            continue
+        table = table.set_column(index, field.name, column)
+    return table.combine_chunks()
+
+
+def write_snapshot(root: str) -> Dict[str, Any]:
+    """
+    Write a query-optimised copy of a KB's output tables to <kb>/output/snapshot:
+    unused columns dropped, repeated references dictionary-encoded, embeddings as
+    float32, one uncompressed Arrow IPC file per table. Blocking.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    output_dir = os.path.join(root, "output")
+    started = time.perf_counter()
+    target = os.path.join(output_dir, SNAPSHOT_DIR)
+    tmp = f"{target}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    source = _source_fingerprint(output_dir)
+    tables: Dict[str, Dict[str, int]] = {}
+    for name, filename in _artifacts().items():
+        path = os.path.join(output_dir, filename)
+        if not os.path.exists(path):
+            continue
+        table = _compact(name, pq.read_table(path))
+        with pa.OSFile(os.path.join(tmp, f"{name}.arrow"), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        tables[name] = {"rows": table.num_rows, "bytes": table.nbytes}
+    meta = {
+        "version": FORMAT_VERSION,
+        "source": source,
+        "tables": tables,
+        "built_at": time.time(),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+    logger.info(
+        f"Wrote query snapshot for '{os.path.basename(root)}' in {meta['seconds']:.2f}s"
+    )
+    return meta
+
+
+def _to_pandas(name: str, table):
+    import pandas as pd
+
+    text = [c for c in TEXT_COLUMNS.get(name, []) if c in table.column_names]
+    frame = table.drop(text).to_pandas()
+    for column in text:
+        # ArrowStringArray 直接引用映射的缓冲区，不复制字符串
+        frame[column] = pd.arrays.ArrowStringArray(table.column(column))
+    return frame[table.column_names]
+
+
+def read_snapshot(output_dir: str) -> Optional[Dict[str, Any]]:
+    """
+    The KB's tables as DataFrames backed by the memory-mapped snapshot, or None
+    if there is no snapshot or the parquet artifacts changed since it was taken.
+    """
+    import pyarrow as pa
+
+    path = os.path.join(output_dir, SNAPSHOT_DIR)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta.get("version") != FORMAT_VERSION:
+        return None
+    if meta.get("source") != _source_fingerprint(output_dir):
+        logger.warning(f"Query snapshot in {path} is stale, reading parquet")
+        return None
+    tables: Dict[str, Any] = {}
+    for name in _artifacts():
+        if name not in meta["tables"]:
+            tables[name] = None
+            continue
+        with pa.memory_map(os.path.join(path, f"{name}.arrow")) as source:
+            table = pa.ipc.open_file(source).read_all()
+        tables[name] = _to_pandas(name, table)
+    return tables
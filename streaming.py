@@ -0,0 +1,85 @@
+import asyncio
+import codecs
+import time
+from typing import AsyncGenerator, AsyncIterator, List, Optional
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+READ_CHUNK_SIZE = 4096
+
+
+async def read_text_chunks(
+    stream: asyncio.StreamReader, size: int = READ_CHUNK_SIZE
+) -> AsyncGenerator[str, None]:
+    """Yield decoded text as soon as any bytes are available, without waiting for newlines."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = await stream.read(size)
+        if not data:
+            break
+        # 多字节字符可能被截断在两次读取之间，由增量解码器拼接
+        text = decoder.decode(data)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def coalesce_deltas(
+    deltas: AsyncIterator[str], interval: float
+) -> AsyncGenerator[str, None]:
+    """
+    Merge deltas that arrive within `interval` seconds of the last flush into one.
+    The first delta is always flushed immediately to keep time-to-first-byte low.
+    """
+    if interval <= 0:
+        async for delta in deltas:
+            yield delta
+        return
+    iterator = deltas.__aiter__()
+    buffer: List[str] = []
+    last_flush: Optional[float] = None
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if buffer:
+                timeout = max(0.0, last_flush + interval - time.monotonic())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if pending in done:
+                future, pending = pending, None
+                try:
+                    buffer.append(future.result())
+                except StopAsyncIteration:
+                    break
+                if last_flush is not None and time.monotonic() - last_flush < interval:
+                    continue
+            if buffer:
+                yield "".join(buffer)
+                buffer.clear()
+                last_flush = time.monotonic()
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+class TTFTRecorder:
+    """Measures the time between the request arriving and its first emitted token."""
+
+    def __init__(self, label: str, started: Optional[float] = None):
+        self.label = label
+        self.started = started if started is not None else time.perf_counter()
+        self.ttft: Optional[float] = None
+
+    def mark(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+            logger.info(
+                f"Time to first token for {self.label}: {self.ttft * 1000:.0f}ms"
+            )
@@ -0,0 +1,493 @@
+"""
+A small OpenAI-compatible stand-in for the LLM and embedding providers, so that
+indexing and queries can run offline. Outputs are deterministic and shaped to
+satisfy graphrag's prompt parsers (entity extraction tuples, community report
+JSON, global search map JSON). Latency, generation speed, rate limits and
+injected errors are configurable to load-test the API on a laptop.
+
+    python stub_llm.py --port 8900 --latency 0.8 --latency-dist lognormal \
+        --latency-spread 0.5 --tokens-per-second 40 --rpm 600 --error-rate 0.02
+
+Point graphrag at it with llm_api_base / embed_api_base = http://127.0.0.1:8900/v1
+in an IndexingRequest; queries on that KB then use it as well. Settings can be
+changed at runtime with POST /v1/stub/config and counters read from
+GET /v1/stub/stats.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import time
+import uuid
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Dict, List, Optional
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+EMBEDDING_DIM = 256
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal", "exponential")
+
+
+@dataclass
+class StubSettings:
+    # 首个 token 之前的延迟（秒），按 latency_dist 分布采样，latency 为均值/中位数
+    latency: float = 0.0
+    latency_dist: str = "fixed"
+    # uniform: 半宽; normal: 标准差; lognormal: 对数标准差
+    latency_spread: float = 0.0
+    # 生成速度，0 表示不限速
+    tokens_per_second: float = 0.0
+    # 每分钟请求数 / token 数上限，0 表示不限
+    rpm: int = 0
+    tpm: int = 0
+    max_concurrency: int = 0
+    # 注入错误的概率及返回的状态码
+    error_rate: float = 0.0
+    error_status: int = 500
+    seed: int = 0
+
+
+app = FastAPI()
+
+
+def _prompt_text(messages: List[Dict[str, Any]]) -> str:
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = " ".join(
+                c.get("text", "") for c in content if isinstance(c, dict)
+            )
+        parts.append(content or "")
+    return "\n".join(parts)
+
+
+def _names(text: str, limit: int = 8) -> List[str]:
+    """Deterministically pick capitalised words of the input text as entity names."""
+    seen: Dict[str, None] = {}
+    for word in re.findall(r"\b[A-Z][a-zA-Z]{2,}\b", text):
+        seen.setdefault(word.upper(), None)
+        if len(seen) >= limit:
+            break
+    return list(seen) or ["DOCUMENT"]
+
+
+def _extract_entities(prompt: str) -> str:
+    text = prompt.rsplit("Text:", 1)[-1]
+    names = _names(text)
+    records = [
+        f'("entity"<|>{name}<|>ORGANIZATION<|>{name} is mentioned in the text)'
+        for name in names
+    ]
+    for source, target in zip(names, names[1:]):
+        records.append(
+            f'("relationship"<|>{source}<|>{target}<|>{source} appears near {target}<|>5)'
+        )
+    return "##".join(records) + "<|COMPLETE|>"
+
+
+def _community_report(prompt: str) -> str:
+    names = _names(prompt.rsplit("Text:", 1)[-1], limit=4)
+    return json.dumps(
+        {
+            "title": f"Community around {names[0]}",
+            "summary": f"This community connects {', '.join(names)}.",
+            "rating": 5.0,
+            "rating_explanation": "Stub rating.",
+            "findings": [
+                {
+                    "summary": f"{name} is central",
+                    "explanation": f"{name} is linked to peers.",
+                }
+                for name in names
+            ],
+        }
+    )
+
+
+def respond(messages: List[Dict[str, Any]], json_mode: bool = False) -> str:
+    """Pick a canned answer matching the graphrag prompt being served."""
+    prompt = _prompt_text(messages)
+    if (
+        "Answer Y if there are still entities" in prompt
+        or "answer with a single letter Y or N" in prompt
+    ):
+        return "N"
+    if "MANY entities" in prompt and "were missed" in prompt:
+        return "<|COMPLETE|>"
+    if '"entity"<|>' in prompt or '("entity"' in prompt:
+        return _extract_entities(prompt)
+    if "findings" in prompt and "rating" in prompt:
+        return _community_report(prompt)
+    if '"points"' in prompt and "score" in prompt:
+        return json.dumps(
+            {
+                "points": [
+                    {"description": "Stub key point [Data: Reports (0)]", "score": 50}
+                ]
+            }
+        )
+    if "comprehensive summary" in prompt or "Description List" in prompt:
+        return "A concise summary of the provided descriptions."
+    if json_mode:
+        return json.dumps({"answer": "stub"})
+    digest = hashlib.sha256(prompt.encode()).hexdigest()[:8]
+    return (
+        f"This is a deterministic stub answer ({digest}). "
+        "The knowledge base mentions several organisations and how they relate. "
+        "Each point here stands in for a real model's summary of the retrieved context."
+    )
+
+
+def embed(text: str, dim: int = EMBEDDING_DIM) -> List[float]:
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    vector = [rng.uniform(-1, 1) for _ in range(dim)]
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+def _usage(prompt: str, completion: str) -> Dict[str, int]:
+    prompt_tokens = len(prompt.split())
+    completion_tokens = len(completion.split())
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class _Bucket:
+    """Token bucket refilled continuously to `per_minute` units per minute."""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def take(self, amount: float) -> Optional[float]:
+        """Consume `amount`, or return the seconds to wait until it would be available."""
+        if self.per_minute <= 0:
+            return None
+        now = time.monotonic()
+        rate = self.per_minute / 60
+        self.level = min(self.per_minute, self.level + (now - self.updated) * rate)
+        self.updated = now
+        amount = min(amount, self.per_minute)
+        if self.level >= amount:
+            self.level -= amount
+            return None
+        return (amount - self.level) / rate
+
+
+class StubState:
+    """Settings plus the seeded randomness, limiters and counters derived from them."""
+
+    def __init__(self, settings: StubSettings):
+        self.stats: Dict[str, int] = {
+            "requests": 0,
+            "chat": 0,
+            "embeddings": 0,
+            "rate_limited": 0,
+            "injected_errors": 0,
+            "active": 0,
+            "peak_active": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+        self.configure(settings)
+
+    def configure(self, settings: StubSettings) -> None:
+        if settings.latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"latency_dist must be one of {LATENCY_DISTRIBUTIONS}")
+        self.settings = settings
+        # 延迟与错误注入使用固定种子，相同的请求序列得到相同的结果
+        self.rng = random.Random(settings.seed)
+        self.requests = _Bucket(settings.rpm)
+        self.tokens = _Bucket(settings.tpm)
+
+    def sample_latency(self) -> float:
+        s = self.settings
+        if s.latency <= 0:
+            return 0.0
+        if s.latency_dist == "uniform":
+            value = self.rng.uniform(
+                s.latency - s.latency_spread, s.latency + s.latency_spread
+            )
+        elif s.latency_dist == "normal":
+            value = self.rng.gauss(s.latency, s.latency_spread)
+        elif s.latency_dist == "lognormal":
+            value = self.rng.lognormvariate(math.log(s.latency), s.latency_spread)
+        elif s.latency_dist == "exponential":
+            value = self.rng.expovariate(1 / s.latency)
+        else:
+            value = s.latency
+        return max(0.0, value)
+
+    def token_delay(self) -> float:
+        tps = self.settings.tokens_per_second
+        return 1 / tps if tps > 0 else 0.0
+
+    def admit(self, tokens: int) -> Optional[JSONResponse]:
+        """Apply concurrency/rate limits and error injection; a response means reject."""
+        s = self.settings
+        self.stats["requests"] += 1
+        if s.max_concurrency and self.stats["active"] >= s.max_concurrency:
+            retry_after = 1.0
+        else:
+            retry_after = self.requests.take(1)
+            if retry_after is None:
+                retry_after = self.tokens.take(tokens)
+        if retry_after is not None:
+            self.stats["rate_limited"] += 1
+            return _error_response(
+                429,
+                "Rate limit reached for stub model",
+                "rate_limit_exceeded",
+                {"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+        if s.error_rate > 0 and self.rng.random() < s.error_rate:
+            self.stats["injected_errors"] += 1
+            return _error_response(
+                s.error_status, "Injected stub error", "server_error"
+            )
+        return None
+
+    def enter(self) -> None:
+        self.stats["active"] += 1
+        self.stats["peak_active"] = max(self.stats["peak_active"], self.stats["active"])
+
+    def leave(self) -> None:
+        self.stats["active"] -= 1
+
+
+def _error_response(
+    status: int, message: str, code: str, headers: Optional[Dict[str, str]] = None
+) -> JSONResponse:
+    return JSONResponse(
+        status_code=status,
+        content={"error": {"message": message, "type": code, "code": code}},
+        headers=headers,
+    )
+
+
+app.state.stub = StubState(StubSettings())
+
+
+@app.get("/v1/models")
+async def models():
+    return {
+        "object": "list",
+        "data": [
+            {"id": "stub-chat", "object": "model"},
+            {"id": "stub-embed", "object": "model"},
+        ],
+    }
+
+
+@app.get("/v1/stub/stats")
+async def stub_stats():
+    state: StubState = app.state.stub
+    return {"settings": asdict(state.settings), **state.stats}
+
+
+@app.post("/v1/stub/config")
+async def stub_config(request: Request):
+    """Update some settings at runtime, e.g. to inject errors mid-run."""
+    state: StubState = app.state.stub
+    updates = await request.json()
+    known = {f.name for f in fields(StubSettings)}
+    unknown = set(updates) - known
+    if unknown:
+        return _error_response(400, f"Unknown settings: {sorted(unknown)}", "invalid")
+    try:
+        state.configure(StubSettings(**{**asdict(state.settings), **updates}))
+    except (TypeError, ValueError) as e:
+        return _error_response(400, str(e), "invalid")
+    return asdict(state.settings)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    state: StubState = app.state.stub
+    body = await request.json()
+    messages = body.get("messages", [])
+    prompt = _prompt_text(messages)
+    json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+    answer = respond(messages, json_mode)
+    usage = _usage(prompt, answer)
+    rejected = state.admit(usage["total_tokens"])
+    if rejected is not None:
+        return rejected
+    state.stats["chat"] += 1
+    state.stats["prompt_tokens"] += usage["prompt_tokens"]
+    state.stats["completion_tokens"] += usage["completion_tokens"]
+    model = body.get("model", "stub-chat")
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    tokens = re.findall(r"\S+\s*", answer)
+    latency = state.sample_latency()
+    token_delay = state.token_delay()
+    # 在返回流之前计入并发，避免流式请求绕过 max_concurrency
+    state.enter()
+    if not body.get("stream"):
+        try:
+            await asyncio.sleep(latency + token_delay * len(tokens))
+        finally:
+            state.leave()
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage,
+        }
+
+    def chunk(delta: Dict[str, str], finish_reason: Optional[str]) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    async def generate():
+        try:
+            await asyncio.sleep(latency)
+            for i, token in enumerate(tokens):
+                if i and token_delay:
+                    await asyncio.sleep(token_delay)
+                yield chunk({"content": token}, None)
+            yield chunk({}, "stop")
+            yield "data: [DONE]\n\n"
+        finally:
+            state.leave()
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    state: StubState = app.state.stub
+    body = await request.json()
+    inputs = body.get("input", [])
+    if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    tokens = sum(
+        len(text) if isinstance(text, list) else len(str(text).split())
+        for text in inputs
+    )
+    rejected = state.admit(tokens)
+    if rejected is not None:
+        return rejected
+    state.stats["embeddings"] += 1
+    state.stats["prompt_tokens"] += tokens
+    state.enter()
+    try:
+        await asyncio.sleep(state.sample_latency())
+    finally:
+        state.leave()
+    data = [
+        {
+            "object": "embedding",
+            "index": i,
+            "embedding": embed(text if isinstance(text, str) else json.dumps(text)),
+        }
+        for i, text in enumerate(inputs)
+    ]
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "stub-embed"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+if __name__ == "__main__":
+    defaults = StubSettings()
+    parser = argparse.ArgumentParser(description="Launch the stub LLM/embedding server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=defaults.latency,
+        help="Mean seconds before the first token",
+    )
+    parser.add_argument(
+        "--latency-dist",
+        type=str,
+        choices=LATENCY_DISTRIBUTIONS,
+        default=defaults.latency_dist,
+    )
+    parser.add_argument(
+        "--latency-spread",
+        type=float,
+        default=defaults.latency_spread,
+        help="Half-width (uniform), stddev (normal) or log-sigma (lognormal)",
+    )
+    parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=defaults.tokens_per_second,
+        help="0 for unlimited",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=defaults.rpm,
+        help="Requests per minute, 0 for unlimited",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=defaults.tpm,
+        help="Tokens per minute, 0 for unlimited",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=defaults.max_concurrency,
+        help="0 for unlimited",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=defaults.error_rate,
+        help="Probability of an injected error",
+    )
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args()
+    app.state.stub = StubState(
+        StubSettings(
+            latency=args.latency,
+            latency_dist=args.latency_dist,
+            latency_spread=args.latency_spread,
+            tokens_per_second=args.tokens_per_second,
+            rpm=args.rpm,
+            tpm=args.tpm,
+            max_concurrency=args.max_concurrency,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            seed=args.seed,
+        )
+    )
+    import uvicorn
+
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,188 @@
+import asyncio
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from http_client import http_client
+from kb_repository import kb_repository
+from models import IndexingRequest, PerformanceProfile
+from rate_limiter import rate_limiter
+from utils import normalize_api_base
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 性能配置字段与 graphrag settings.yaml 键的对应关系
+SETTINGS_KEYS = {
+    "embedding_batch_size": "embeddings.batch_size",
+    "embedding_batch_max_tokens": "embeddings.batch_max_tokens",
+    "llm_concurrent_requests": "llm.concurrent_requests",
+    "embedding_concurrent_requests": "embeddings.llm.concurrent_requests",
+    "chunk_size": "chunks.size",
+    "chunk_overlap": "chunks.overlap",
+    "parallel_workers": "parallelization.num_threads",
+}
+# 没有观测数据且探测失败时假设的单次 LLM 调用耗时（秒）
+DEFAULT_LATENCY = 2.0
+# 按语料 token 数（约 4 字节一个 token）选择分块大小
+CHUNK_SIZES = ((1_000_000, 1200), (10_000_000, 1600), (math.inf, 2400))
+MIN_CONCURRENCY, MAX_CONCURRENCY = 4, 64
+MAX_BATCH_TOKENS = 65536
+
+
+def _probe_target(
+    request: IndexingRequest, llm_config: Dict[str, Any]
+) -> Optional[Tuple[str, Dict[str, str], Dict[str, Any]]]:
+    """URL, headers and body of a one-token completion for the KB's LLM type."""
+    llm_type = str(llm_config.get("type") or "openai_chat").lower()
+    messages = [{"role": "user", "content": "ping"}]
+    if llm_type == "azure_openai_chat":
+        deployment = llm_config.get("deployment_name") or request.llm_model
+        api_version = llm_config.get("api_version")
+        if not api_version:
+            return None
+        url = (
+            f"{request.llm_api_base.rstrip('/')}/openai/deployments/{deployment}"
+            f"/chat/completions?api-version={api_version}"
+        )
+        return (
+            url,
+            {"api-key": request.api_key},
+            {"messages": messages, "max_tokens": 1},
+        )
+    if llm_type == "openai_chat":
+        url = f"{normalize_api_base(request.llm_api_base)}/v1/chat/completions"
+        payload = {"model": request.llm_model, "messages": messages, "max_tokens": 1}
+        return url, {"Authorization": f"Bearer {request.api_key}"}, payload
+    # 其他类型（如 static_response）没有可探测的聊天接口
+    return None
+
+
+async def _probe_latency(
+    request: IndexingRequest, llm_config: Dict[str, Any]
+) -> Optional[float]:
+    """Time a one-token chat completion against the indexing LLM."""
+    target = _probe_target(request, llm_config)
+    if target is None:
+        logger.info(
+            f"Not probing latency for LLM type '{llm_config.get('type')}', "
+            "using the default"
+        )
+        return None
+    url, headers, payload = target
+    started = time.perf_counter()
+    try:
+        response = await http_client.client.post(url, json=payload, headers=headers)
+        response.raise_for_status()
+    except Exception as e:
+        logger.warning(f"Latency probe against {request.llm_api_base} failed: {str(e)}")
+        return None
+    latency = time.perf_counter() - started
+    await rate_limiter.record(request.llm_api_base, request.llm_model, False, latency)
+    return latency
+
+
+async def observed_latency(
+    request: IndexingRequest,
+    probe: bool = True,
+    llm_config: Optional[Dict[str, Any]] = None,
+) -> Tuple[float, str]:
+    """
+    Seconds per LLM call for the request's model, and where the figure came from.
+    The latency EMA recorded by the rate limiter is preferred; the probe costs a
+    billed completion, so it only runs when nothing has been observed yet and
+    `probe` is set. `llm_config` is the KB's `llm` settings, which decide the
+    endpoint the probe calls.
+    """
+    latency = await asyncio.to_thread(
+        rate_limiter.latency, request.llm_api_base, request.llm_model
+    )
+    if latency is not None:
+        return latency, "observed"
+    if probe:
+        latency = await _probe_latency(request, llm_config or {})
+        if latency is not None:
+            return latency, "probe"
+    return DEFAULT_LATENCY, "default"
+
+
+def auto_profile(
+    corpus_bytes: int, latency: float, rpm: float, chunk_size: Optional[int] = None
+) -> Dict[str, int]:
+    """
+    Pick settings from corpus size and provider latency. Concurrency follows
+    Little's law: enough requests in flight to use the leased requests/min at the
+    observed latency, or latency-scaled when the budget is unlimited. Bigger
+    corpora get bigger chunks (fewer extraction calls) and bigger embedding
+    batches; a given `chunk_size` is used as is.
+    """
+    tokens = corpus_bytes / 4
+    if chunk_size is None:
+        chunk_size = next(size for limit, size in CHUNK_SIZES if tokens < limit)
+    if rpm:
+        concurrency = math.ceil(rpm / 60 * latency * 1.2)
+    else:
+        concurrency = math.ceil(8 * max(latency, 1.0))
+    concurrency = max(MIN_CONCURRENCY, min(MAX_CONCURRENCY, concurrency))
+    batch_size = 16 if tokens < 1_000_000 else 64
+    return {
+        "embedding_batch_size": batch_size,
+        "embedding_batch_max_tokens": min(batch_size * chunk_size, MAX_BATCH_TOKENS),
+        "llm_concurrent_requests": concurrency,
+        "embedding_concurrent_requests": concurrency,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_size // 12,
+        "parallel_workers": concurrency,
+    }
+
+
+async def resolve_profile(
+    request: IndexingRequest,
+    lease: Dict[str, Any],
+    probe: bool = True,
+    llm_config: Optional[Dict[str, Any]] = None,
+    indexed: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[Tuple[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    settings.yaml updates for the request's performance profile, and the
+    summary recorded in the job result. Values given explicitly always win over
+    auto-tuned ones; fields left unset keep the KB's current settings. Only
+    concurrency depends on latency, so probing (see observed_latency) does not
+    change the chunking an index plan is based on. `indexed` holds the settings
+    the KB's current index was built with (see incremental.indexed_settings):
+    auto mode keeps that chunking, since changing it forces a full rebuild.
+    """
+    profile: Optional[PerformanceProfile] = request.performance
+    if profile is None:
+        return [], None
+    values = {
+        field: value
+        for field, value in profile.model_dump(exclude={"mode"}).items()
+        if value is not None
+    }
+    summary: Dict[str, Any] = {"mode": profile.mode}
+    if profile.mode == "auto":
+        info = await kb_repository.get(request.root)
+        corpus_bytes = info["input_bytes"] if info is not None else 0
+        latency, source = await observed_latency(request, probe, llm_config)
+        kept = {
+            field: (indexed or {}).get(key)
+            for field, key in (
+                ("chunk_size", "chunks.size"),
+                ("chunk_overlap", "chunks.overlap"),
+            )
+            if field not in values and (indexed or {}).get(key) is not None
+        }
+        auto = auto_profile(corpus_bytes, latency, lease["rpm"], kept.get("chunk_size"))
+        values = {**auto, **kept, **values}
+        summary["inputs"] = {
+            "corpus_bytes": corpus_bytes,
+            "latency": round(latency, 3),
+            "latency_source": source,
+            "rpm": lease["rpm"],
+        }
+        if kept:
+            # 已有索引的分块配置不随语料增长自动改变，否则下次索引会变为全量重建
+            summary["inputs"]["kept_from_index"] = kept
+    summary["values"] = values
+    logger.info(f"Indexing profile for '{request.root}': {summary}")
+    return [(SETTINGS_KEYS[field], value) for field, value in values.items()], summary
@@ -1,36 +1,296 @@
+import asyncio
+import hashlib
 import os
 import shutil
+import tarfile
+import time
+import uuid
+import zipfile
+import aiofiles
+import aiofiles.os
 from fastapi import HTTPException, UploadFile
-from pathlib import Path
-from utils import get_kb_root
+from typing import Any, BinaryIO, Dict, List, Optional
+from utils import get_archive_limits, get_kb_root, get_upload_chunk_size
+from metrics import UPLOAD_BYTES, UPLOAD_SECONDS, UPLOAD_THROUGHPUT, error
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+ARCHIVE_SUFFIXES = (".zip", ".tar.gz", ".tgz", ".tar")
+
+
+class ArchiveLimitExceeded(Exception):
+    pass
+
+
+def _input_dir(root_path: str, kb_root: str) -> str:
+    input_dir = os.path.join(kb_root, root_path, "input")
+    if not os.path.exists(input_dir):
+        raise HTTPException(status_code=400, detail="input目录不存在")
+    return input_dir
+
+
+def _temp_path(target_path: str) -> str:
+    # 临时文件不以 .txt 结尾，索引时不会被 graphrag 读到
+    directory, name = os.path.split(target_path)
+    return os.path.join(directory, f".{name}.{uuid.uuid4().hex}.part")
+
+
+def _record_upload(kind: str, size: int, elapsed: float) -> None:
+    UPLOAD_BYTES.inc(kind, amount=size)
+    UPLOAD_SECONDS.inc(kind, amount=elapsed)
+    if elapsed > 0:
+        UPLOAD_THROUGHPUT.observe(size / 1024**2 / elapsed, kind)
+
+
+def _upload_stats(
+    filename: str, size: int, sha256: str, elapsed: float
+) -> Dict[str, Any]:
+    mb_per_s = size / 1024**2 / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"Stored {filename}: {size} bytes in {elapsed:.2f}s ({mb_per_s:.1f} MB/s)"
+    )
+    return {
+        "filename": filename,
+        "bytes": size,
+        "sha256": sha256,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(mb_per_s, 2),
+    }
 
 
 async def upload_file(
     file: UploadFile, root_path: str, kb_root: str = get_kb_root()
-) -> bool:
+) -> Optional[Dict[str, Any]]:
     """
-    上传文件到指定的input目录
+    以固定大小的块流式写入文件到指定的input目录，写完后原子地重命名
     Args:
         file: FastAPI的UploadFile对象
         root_path: 目标根目录路径
     Returns:
-        bool: 上传是否成功
+        Optional[Dict]: 上传成功时返回文件大小、sha256 和吞吐量，失败时返回 None
     """
     try:
         # 检查文件格式是否为txt
         if not file.filename.lower().endswith(".txt"):
-            return False
-        # 确保目标input目录存在
-        input_dir = os.path.join(kb_root, root_path, "input")
-        if not os.path.exists(input_dir):
-            raise HTTPException(status_code=400, detail="input目录不存在")
-        # 构建目标文件路径
-        target_path = os.path.join(input_dir, file.filename)
-        # 保存上传的文件
-        content = await file.read()
-        with open(target_path, "wb") as f:
-            f.write(content)
-        return True
+            error("upload_rejected")
+            return None
+        input_dir = _input_dir(root_path, kb_root)
+        filename = os.path.basename(file.filename)
+        target_path = os.path.join(input_dir, filename)
+        temp_path = _temp_path(target_path)
+        chunk_size = get_upload_chunk_size()
+        digest = hashlib.sha256()
+        size = 0
+        start = time.perf_counter()
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                while True:
+                    chunk = await file.read(chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await f.write(chunk)
+            await aiofiles.os.replace(temp_path, target_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                await aiofiles.os.remove(temp_path)
+            raise
+        elapsed = time.perf_counter() - start
+        _record_upload("file", size, elapsed)
+        return _upload_stats(filename, size, digest.hexdigest(), elapsed)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"上传文件时发生错误: {str(e)}")
-        return False
+        logger.error(f"上传文件时发生错误: {str(e)}")
+        error("upload_failed")
+        return None
+
+
+async def upload_files(
+    files: List[UploadFile], root_path: str, kb_root: str = get_kb_root()
+) -> List[Dict[str, Any]]:
+    """
+    依次上传多个文件，返回每个文件的结果
+    """
+    _input_dir(root_path, kb_root)
+    results = []
+    for file in files:
+        stats = await upload_file(file, root_path, kb_root)
+        if stats is None:
+            results.append({"filename": file.filename, "error": "仅支持txt格式文件"})
+        else:
+            results.append(stats)
+    return results
+
+
+def _store_member(
+    source: BinaryIO, input_dir: str, name: str, chunk_size: int, max_bytes: int
+):
+    target_path = os.path.join(input_dir, name)
+    temp_path = _temp_path(target_path)
+    digest = hashlib.sha256()
+    size = 0
+    start = time.perf_counter()
+    try:
+        with open(temp_path, "wb") as f:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                # 成员声明的大小可能是伪造的，按实际写入量限制
+                if size > max_bytes:
+                    raise ArchiveLimitExceeded(
+                        f"archive expands to more than the {max_bytes} bytes left"
+                    )
+                f.write(chunk)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return _upload_stats(name, size, digest.hexdigest(), time.perf_counter() - start)
+
+
+def _unique_name(name: str, used: set) -> str:
+    if name not in used:
+        return name
+    stem, ext = os.path.splitext(name)
+    index = 2
+    while f"{stem}-{index}{ext}" in used:
+        index += 1
+    return f"{stem}-{index}{ext}"
+
+
+def _extract_archive(
+    fileobj: BinaryIO,
+    filename: str,
+    input_dir: str,
+    chunk_size: int,
+    max_bytes: int,
+    max_members: int,
+) -> List[Dict[str, Any]]:
+    """
+    Extract the .txt members of a zip or tar(.gz) archive into input_dir, one member at
+    a time. Directory structure is flattened; members whose names collide with each
+    other or with files already in input_dir are renamed (`doc-2.txt`) and carry
+    `renamed_from`. Non-txt members are skipped. Members are staged next to
+    input_dir and moved in only once the whole archive is extracted, so more than
+    `max_members` files or `max_bytes` uncompressed raises ArchiveLimitExceeded
+    without touching input_dir.
+    """
+    results: List[Dict[str, Any]] = []
+    used: set = set(os.listdir(input_dir))
+    total = 0
+    # 暂存目录与 input 同在知识库目录下，保证能原子地重命名进去，且不会被索引读到
+    staging = os.path.join(os.path.dirname(input_dir), f".upload-{uuid.uuid4().hex}")
+    os.makedirs(staging)
+
+    def store(source: BinaryIO, path: str, declared: int) -> None:
+        nonlocal total
+        if len(results) >= max_members:
+            raise ArchiveLimitExceeded(f"archive has more than {max_members} files")
+        if total + declared > max_bytes:
+            raise ArchiveLimitExceeded(
+                f"archive expands to more than {max_bytes} bytes"
+            )
+        name = _unique_name(os.path.basename(path), used)
+        used.add(name)
+        stats = _store_member(source, staging, name, chunk_size, max_bytes - total)
+        total += stats["bytes"]
+        if name != os.path.basename(path):
+            stats["renamed_from"] = path
+        results.append(stats)
+
+    lower = filename.lower()
+    try:
+        if lower.endswith(".zip"):
+            with zipfile.ZipFile(fileobj) as archive:
+                members = [
+                    info
+                    for info in archive.infolist()
+                    if not info.is_dir()
+                    and os.path.basename(info.filename).lower().endswith(".txt")
+                ]
+                # zip 的目录在开头就能读到，解压前先检查声明的总量
+                if len(members) > max_members:
+                    raise ArchiveLimitExceeded(
+                        f"archive has more than {max_members} files"
+                    )
+                if sum(info.file_size for info in members) > max_bytes:
+                    raise ArchiveLimitExceeded(
+                        f"archive expands to more than {max_bytes} bytes"
+                    )
+                for info in members:
+                    with archive.open(info) as source:
+                        store(source, info.filename, info.file_size)
+        else:
+            # 以流模式顺序读取 tar，无需把整个归档解压到内存或磁盘
+            mode = "r|" if lower.endswith(".tar") else "r|gz"
+            with tarfile.open(fileobj=fileobj, mode=mode) as archive:
+                for member in archive:
+                    name = os.path.basename(member.name)
+                    if not member.isfile() or not name.lower().endswith(".txt"):
+                        continue
+                    store(archive.extractfile(member), member.name, member.size)
+        for stats in results:
+            os.replace(
+                os.path.join(staging, stats["filename"]),
+                os.path.join(input_dir, stats["filename"]),
+            )
+    finally:
+        # 超限或解析失败时 input 目录保持不变
+        shutil.rmtree(staging, ignore_errors=True)
+    return results
+
+
+async def upload_archive(
+    file: UploadFile, root_path: str, kb_root: str = get_kb_root()
+) -> Dict[str, Any]:
+    """
+    上传 zip/tar.gz 归档，并将其中的 txt 文件流式解压到 input 目录
+    """
+    if not file.filename.lower().endswith(ARCHIVE_SUFFIXES):
+        raise HTTPException(
+            status_code=400, detail="仅支持 zip、tar 或 tar.gz 格式的归档"
+        )
+    input_dir = _input_dir(root_path, kb_root)
+    limits = get_archive_limits()
+    start = time.perf_counter()
+    try:
+        await file.seek(0)
+        files = await asyncio.to_thread(
+            _extract_archive,
+            file.file,
+            file.filename,
+            input_dir,
+            get_upload_chunk_size(),
+            limits["max_bytes"],
+            limits["max_members"],
+        )
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        error("upload_rejected")
+        raise HTTPException(status_code=400, detail=f"无法解析归档文件: {str(e)}")
+    except ArchiveLimitExceeded as e:
+        error("upload_rejected")
+        raise HTTPException(status_code=413, detail=f"归档超出限制: {str(e)}")
+    elapsed = time.perf_counter() - start
+    total = sum(f["bytes"] for f in files)
+    _record_upload("archive", total, elapsed)
+    summary = _upload_stats(file.filename, total, "", elapsed)
+    return {
+        "archive": file.filename,
+        "files": files,
+        # 与归档内其他文件或 input 中已有文件重名而被改名的文件
+        "renamed": [
+            {"from": f["renamed_from"], "to": f["filename"]}
+            for f in files
+            if "renamed_from" in f
+        ],
+        "bytes": total,
+        "seconds": summary["seconds"],
+        "mb_per_s": summary["mb_per_s"],
+    }
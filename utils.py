@@ -2,7 +2,7 @@ from functools import lru_cache
 import os
 from typing import Dict, Any, List
 from logger import get_logger
-import requests
+import httpx
 
 logger = get_logger(__name__)
 
@@ -12,6 +12,246 @@ def get_kb_root() -> str:
     return os.getenv("KB_ROOT", "./kbs")
 
 
+@lru_cache()
+def get_state_dir() -> str:
+    """Local directory for the API's own databases, kept outside KB_ROOT."""
+    return os.getenv("STATE_DIR", "./.state")
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+@lru_cache()
+def get_query_mode() -> str:
+    """
+    Query execution mode: 'inprocess' (warm KB contexts in the API process),
+    'pool' (warm worker processes) or 'subprocess' (graphrag CLI per request).
+    """
+    return os.getenv("QUERY_MODE", "inprocess").lower()
+
+
+@lru_cache()
+def get_kb_cache_max_bytes() -> int:
+    """Memory budget for knowledge bases kept loaded by the in-process query engine."""
+    return env_int("KB_CACHE_MAX_BYTES", 2 * 1024**3)
+
+
+@lru_cache()
+def get_query_pool_settings() -> Dict[str, Any]:
+    """Worker pool size and admission limits for /v1/chat/completions."""
+    return {
+        "workers": env_int("QUERY_WORKERS", 4),
+        "max_concurrency": env_int("QUERY_MAX_CONCURRENCY", 8),
+        "max_per_kb": env_int("QUERY_MAX_PER_KB", 4),
+        "max_queue": env_int("QUERY_QUEUE_SIZE", 32),
+        "retry_after": env_int("QUERY_RETRY_AFTER", 5),
+    }
+
+
+@lru_cache()
+def get_result_cache_settings() -> Dict[str, Any]:
+    """Query result cache: backend is 'memory', 'sqlite' or 'none'."""
+    return {
+        "backend": os.getenv("RESULT_CACHE_BACKEND", "memory").lower(),
+        "path": os.getenv(
+            "RESULT_CACHE_PATH", os.path.join(get_state_dir(), "results.db")
+        ),
+        "ttl": env_float("RESULT_CACHE_TTL", 24 * 3600),
+        "max_entries": env_int("RESULT_CACHE_MAX_ENTRIES", 1000),
+    }
+
+
+@lru_cache()
+def get_stream_flush_interval() -> float:
+    """Seconds during which small streamed deltas are merged into one SSE chunk."""
+    return env_float("STREAM_FLUSH_INTERVAL", 0.05)
+
+
+@lru_cache()
+def get_query_limits() -> Dict[str, float]:
+    """Wall-clock timeout per query and SIGTERM-to-SIGKILL grace for abandoned children."""
+    return {
+        "timeout": env_float("QUERY_TIMEOUT", 300),
+        "kill_grace": env_float("QUERY_KILL_GRACE", 5),
+    }
+
+
+@lru_cache()
+def get_indexing_job_settings() -> Dict[str, Any]:
+    """Indexing job queue: global concurrency, poll interval and stale-heartbeat timeout."""
+    return {
+        "max_concurrent": env_int("INDEX_MAX_CONCURRENT", 1),
+        "poll_interval": env_float("INDEX_POLL_INTERVAL", 1),
+        "stale_after": env_float("INDEX_STALE_AFTER", 60),
+    }
+
+
+@lru_cache()
+def get_upload_chunk_size() -> int:
+    """Bytes copied per read/write when streaming uploads to disk."""
+    return env_int("UPLOAD_CHUNK_SIZE", 1024 * 1024)
+
+
+@lru_cache()
+def get_archive_limits() -> Dict[str, int]:
+    """Caps on the .txt files extracted from one uploaded archive."""
+    return {
+        "max_bytes": env_int("ARCHIVE_MAX_BYTES", 2 * 1024**3),
+        "max_members": env_int("ARCHIVE_MAX_MEMBERS", 10000),
+    }
+
+
+@lru_cache()
+def get_index_event_settings() -> Dict[str, int]:
+    """Progress events kept per indexing job and number of finished jobs retained."""
+    return {
+        "max_events": env_int("INDEX_EVENT_BUFFER", 500),
+        "max_jobs": env_int("INDEX_EVENT_JOBS", 50),
+    }
+
+
+@lru_cache()
+def get_kb_repository_settings() -> Dict[str, Any]:
+    """Thread pool size for KB filesystem work and KB catalogue polling interval."""
+    return {
+        "kb_root": get_kb_root(),
+        "max_workers": env_int("KB_FS_WORKERS", 8),
+        "poll_interval": env_float("KB_CATALOG_POLL_INTERVAL", 5),
+    }
+
+
+@lru_cache()
+def get_http_client_settings() -> Dict[str, float]:
+    """Timeouts and connection pool limits of the shared outbound HTTP client."""
+    return {
+        "timeout": env_float("HTTP_TIMEOUT", 10),
+        "connect_timeout": env_float("HTTP_CONNECT_TIMEOUT", 5),
+        "max_connections": env_int("HTTP_MAX_CONNECTIONS", 100),
+        "max_keepalive": env_int("HTTP_MAX_KEEPALIVE", 20),
+        "keepalive_expiry": env_float("HTTP_KEEPALIVE_EXPIRY", 30),
+    }
+
+
+@lru_cache()
+def get_model_catalog_settings() -> Dict[str, Any]:
+    """
+    Model list cache: freshness TTL, retry delay after failures, idle eviction,
+    entry bound and the provider hosts callers may point it at (empty = any).
+    """
+    hosts = os.getenv("MODEL_CATALOG_ALLOWED_HOSTS", "")
+    return {
+        "ttl": env_float("MODEL_CATALOG_TTL", 300),
+        "error_ttl": env_float("MODEL_CATALOG_ERROR_TTL", 15),
+        "idle_expiry": env_float("MODEL_CATALOG_IDLE_EXPIRY", 3600),
+        "max_entries": env_int("MODEL_CATALOG_MAX_ENTRIES", 256),
+        "allowed_hosts": [h.strip() for h in hosts.split(",") if h.strip()],
+    }
+
+
+@lru_cache()
+def get_batch_settings() -> Dict[str, Any]:
+    """Batch query limits and how long completed answers are kept for resuming."""
+    return {
+        "path": os.path.join(get_state_dir(), "batches.db"),
+        "max_items": env_int("BATCH_MAX_ITEMS", 10000),
+        "max_parallel": env_int("BATCH_MAX_PARALLEL", 4),
+        "max_retries": env_int("BATCH_MAX_RETRIES", 5),
+        "retention": env_float("BATCH_RETENTION", 7 * 86400),
+    }
+
+
+@lru_cache()
+def get_ann_settings() -> Dict[str, Any]:
+    """IVF index over entity embeddings: build parameters, lists probed per query, cache size."""
+    return {
+        "enabled": os.getenv("ANN_ENABLED", "true").lower() == "true",
+        "min_entities": env_int("ANN_MIN_ENTITIES", 20000),
+        "lists_factor": env_float("ANN_LISTS_FACTOR", 1.0),
+        "train_per_list": env_int("ANN_TRAIN_PER_LIST", 64),
+        "iterations": env_int("ANN_KMEANS_ITERATIONS", 10),
+        "seed": env_int("ANN_SEED", 0),
+        "nprobe": env_int("ANN_NPROBE", 16),
+        "cache_size": env_int("ANN_CACHE_SIZE", 1024),
+    }
+
+
+@lru_cache()
+def get_snapshot_settings() -> Dict[str, Any]:
+    """Whether indexing writes, and queries load, the memory-mapped table snapshot."""
+    return {"enabled": os.getenv("SNAPSHOT_ENABLED", "true").lower() == "true"}
+
+
+@lru_cache()
+def get_federation_settings() -> Dict[str, int]:
+    """Limits of federated (multi-KB) queries."""
+    return {
+        "max_kbs": env_int("FEDERATION_MAX_KBS", 50),
+        "max_parallel": env_int("FEDERATION_MAX_PARALLEL", 8),
+    }
+
+
+@lru_cache()
+def get_rate_limit_settings() -> Dict[str, Any]:
+    """
+    Shared LLM budget per (api_base, model): default requests/tokens per minute
+    (0 = unlimited), share leased to background indexing, bucket burst, AIMD steps.
+    """
+    return {
+        "path": os.path.join(get_state_dir(), "rate_limits.db"),
+        "rpm": env_float("RATE_LIMIT_RPM", 0),
+        "tpm": env_float("RATE_LIMIT_TPM", 0),
+        "background_share": env_float("RATE_LIMIT_BACKGROUND_SHARE", 0.5),
+        "burst_seconds": env_float("RATE_LIMIT_BURST_SECONDS", 10),
+        "decrease": env_float("RATE_LIMIT_DECREASE", 0.5),
+        "increase": env_float("RATE_LIMIT_INCREASE", 0.02),
+        "min_factor": env_float("RATE_LIMIT_MIN_FACTOR", 0.1),
+        "cooldown": env_float("RATE_LIMIT_COOLDOWN", 5),
+        "max_sleep": env_float("RATE_LIMIT_MAX_SLEEP", 1),
+        "lease_ttl": env_float("RATE_LIMIT_LEASE_TTL", 300),
+    }
+
+
+@lru_cache()
+def get_llm_cache_settings() -> Dict[str, Any]:
+    """Host-wide content-addressed LLM/embedding cache shared by all KBs."""
+    return {
+        "enabled": os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true",
+        "queries": os.getenv("LLM_CACHE_QUERIES", "true").lower() == "true",
+        "base_dir": os.getenv(
+            "LLM_CACHE_DIR", os.path.join(get_state_dir(), "llm_cache")
+        ),
+        "db_path": os.path.join(get_state_dir(), "llm_cache.db"),
+        "max_bytes": env_int("LLM_CACHE_MAX_BYTES", 10 * 1024**3),
+        "sweep_interval": env_float("LLM_CACHE_SWEEP_INTERVAL", 300),
+    }
+
+
+@lru_cache()
+def get_cluster_settings() -> Dict[str, Any]:
+    """
+    Multi-worker deployment: worker base URLs behind the KB-affinity router,
+    this worker's own name (the `worker` label on its metrics), virtual nodes
+    per worker on the hash ring, health check interval and how long shutdown
+    waits for in-flight requests.
+    """
+    workers = os.getenv("CLUSTER_WORKERS", "")
+    return {
+        "workers": [
+            url.strip().rstrip("/") for url in workers.split(",") if url.strip()
+        ],
+        "node": os.getenv("CLUSTER_NODE", ""),
+        "replicas": env_int("CLUSTER_HASH_REPLICAS", 128),
+        "health_interval": env_float("CLUSTER_HEALTH_INTERVAL", 2),
+        "connect_timeout": env_float("CLUSTER_CONNECT_TIMEOUT", 5),
+        "drain_timeout": env_float("CLUSTER_DRAIN_TIMEOUT", 30),
+    }
+
+
 def normalize_api_base(api_base: str) -> str:
     """Normalize the API base URL by removing trailing slashes and /v1 or /api suffixes."""
     api_base = api_base.rstrip("/")
@@ -31,24 +271,25 @@ def get_models_endpoint(api_base: str, api_type: str) -> str:
         return f"{normalized_base}/models"
 
 
-async def fetch_available_models(settings: Dict[str, Any]) -> List[str]:
-    """Fetch available models from the API."""
+async def request_available_models(
+    settings: Dict[str, Any], client: httpx.AsyncClient
+) -> List[str]:
+    """Fetch available models from the API, raising on HTTP or format errors."""
     api_base = settings["api_base"]
     api_type = settings["api_type"]
-    api_key = settings["api_key"]
+    api_key = settings.get("api_key")
     models_endpoint = get_models_endpoint(api_base, api_type)
     headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
-    try:
-        response = requests.get(models_endpoint, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if api_type.lower() == "openai":
-            return [model["id"] for model in data["data"]]
-        elif api_type.lower() == "azure":
-            return [model["id"] for model in data["value"]]
-        else:
-            # Adjust this based on the actual response format of your local LLM API
-            return [model["name"] for model in data["models"]]
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching models: {str(e)}")
-        return []
+    # 地址由调用方提供，不跟随重定向到其他主机
+    response = await client.get(
+        models_endpoint, headers=headers, follow_redirects=False
+    )
+    response.raise_for_status()
+    data = response.json()
+    if api_type.lower() == "openai":
+        return [model["id"] for model in data["data"]]
+    elif api_type.lower() == "azure":
+        return [model["id"] for model in data["value"]]
+    else:
+        # Adjust this based on the actual response format of your local LLM API
+        return [model["name"] for model in data["models"]]
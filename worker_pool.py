@@ -0,0 +1,192 @@
+import asyncio
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Any, AsyncGenerator, Dict, List, Optional, Set, Tuple
+from utils import get_kb_cache_max_bytes, get_query_pool_settings
+from metrics import SUBPROCESS_SPAWN
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 工作进程发回的消息类型，后三种表示任务结束
+CHUNK, DONE, RESULT, ERROR = "chunk", "done", "result", "error"
+TERMINAL = (DONE, RESULT, ERROR)
+# 任务结束前报告该进程缓存中仍保留的知识库，不转发给调用方
+LOADED = "loaded"
+
+
+async def _run_job(conn: Connection, job: Dict[str, Any]) -> None:
+    import engine
+    from llm_cache import llm_cache
+    from rate_limiter import rate_limiter
+
+    args = (
+        job["selected_folder"],
+        job["query_type"],
+        job["community_level"],
+        job["query"],
+    )
+    try:
+        if job["stream"]:
+            async for chunk in engine.stream_search(*args):
+                conn.send((CHUNK, chunk))
+            terminal = (DONE, None)
+        else:
+            terminal = (RESULT, await engine.search(*args))
+    except Exception as e:
+        terminal = (ERROR, str(e))
+    # 事件循环只在任务期间运行，后台的定时写入会停在两次任务之间，在此显式写入
+    await rate_limiter.flush()
+    await llm_cache.flush()
+    conn.send((LOADED, engine.kb_cache.keys()))
+    conn.send(terminal)
+
+
+def _worker_main(conn: Connection, cache_bytes: int) -> None:
+    """Worker process entry point: import graphrag once, then serve queries from the pipe."""
+    import engine
+
+    # 每个工作进程只使用 KB_CACHE_MAX_BYTES 的一份
+    engine.kb_cache.max_bytes = cache_bytes
+    engine.preload()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        loop.run_until_complete(_run_job(conn, job))
+    loop.close()
+
+
+async def _recv(conn: Connection) -> Tuple[str, Any]:
+    """Receive a message from a worker without blocking the event loop."""
+    if not conn.poll():
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        fd = conn.fileno()
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fd)
+    return conn.recv()
+
+
+class _Worker:
+    def __init__(self, context, cache_bytes: int):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, cache_bytes), daemon=True
+        )
+        with SUBPROCESS_SPAWN.time("query_worker"):
+            self.process.start()
+        child_conn.close()
+        # 该进程中已加载的知识库，用于亲和调度；每个任务结束时由工作进程更新
+        self.warm: Set[str] = set()
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class QueryWorkerPool:
+    """
+    A fixed set of warm query worker processes with KB-affinity scheduling.
+    `cache_bytes` is the KB cache budget shared by all workers.
+    """
+
+    def __init__(self, size: int, cache_bytes: int):
+        self.size = size
+        self.cache_bytes = max(1, cache_bytes // max(1, size))
+        self._context = multiprocessing.get_context("spawn")
+        self._idle: List[_Worker] = []
+        self._available: Optional[asyncio.Condition] = None
+        self.started = False
+        self.restarts = 0
+
+    def start(self) -> None:
+        self._available = asyncio.Condition()
+        self._idle = [
+            _Worker(self._context, self.cache_bytes) for _ in range(self.size)
+        ]
+        self.started = True
+        logger.info(f"Started {self.size} query workers")
+
+    async def stop(self) -> None:
+        self.started = False
+        workers, self._idle = self._idle, []
+        await asyncio.gather(*(asyncio.to_thread(w.stop) for w in workers))
+        logger.info("Stopped query workers")
+
+    async def _acquire(self, kb: str) -> _Worker:
+        async with self._available:
+            while not self._idle:
+                await self._available.wait()
+            # 优先选择已经加载了该知识库的工作进程
+            for i, worker in enumerate(self._idle):
+                if kb in worker.warm:
+                    return self._idle.pop(i)
+            return self._idle.pop(0)
+
+    async def _release(self, worker: _Worker) -> None:
+        async with self._available:
+            self._idle.append(worker)
+            self._available.notify()
+
+    async def _replace(self, worker: _Worker) -> None:
+        """Kill a worker that was abandoned mid-query or crashed and start a fresh one."""
+        await asyncio.to_thread(worker.kill)
+        self.restarts += 1
+        if self.started:
+            await self._release(_Worker(self._context, self.cache_bytes))
+
+    async def run(self, job: Dict[str, Any]) -> AsyncGenerator[Tuple[str, Any], None]:
+        """Run a query on an idle worker, yielding (kind, payload) messages."""
+        worker = await self._acquire(job["selected_folder"])
+        finished = False
+        try:
+            worker.conn.send(job)
+            while not finished:
+                kind, payload = await _recv(worker.conn)
+                if kind == LOADED:
+                    worker.warm = set(payload)
+                    continue
+                finished = kind in TERMINAL
+                if kind == ERROR:
+                    raise RuntimeError(payload)
+                yield kind, payload
+        except EOFError:
+            raise RuntimeError("Query worker exited unexpectedly")
+        finally:
+            if finished:
+                await self._release(worker)
+            else:
+                await self._replace(worker)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.size,
+            "cache_bytes_per_worker": self.cache_bytes,
+            "idle": len(self._idle),
+            "restarts": self.restarts,
+        }
+
+
+worker_pool = QueryWorkerPool(
+    get_query_pool_settings()["workers"], get_kb_cache_max_bytes()
+)